@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+The class containing the Polynomial Transform of arbitrary degree
+"""
+import tensorflow as tf
+import numpy as np
+
+from LeastSquares import lstsq, robust_lstsq
+
+class LinearModel(tf.keras.Model):
+    '''
+    The base class of the models that are linear in their coefficients, which are evaluated as 
+    design_matrix(pts) @ coefficients(). Subclasses implement both. The design matrix of an input 
+    that is used repeatedly (like during training) can be precomputed via prepare(pts)
+    '''
+    def prepare(self, pts):
+    # precomputes the design matrix of pts. Calling the model with the same pts object afterwards
+    # only multiplies it with the coefficients. prepare(None) clears the cache
+        if pts is None:
+            self._cache_ref, self._cache_design = (None, None)
+        else:
+            self._cache_ref=pts.ref()
+            self._cache_design=self.design_matrix(tf.reshape(pts, [-1,2]))
+
+
+    def call(self, pts):
+        if len(pts.shape)!=2 and len(pts.shape)!=3:
+            raise ValueError('Invalid input shape! ch1 has shape '+str(pts.shape) )
+
+        if self._cache_ref is not None and hasattr(pts, 'ref') and pts.ref()==self._cache_ref:
+            mapped = self._cache_design @ self.coefficients()
+        else: # transform vectors or matrices
+            mapped = self.design_matrix(tf.reshape(pts, [-1,2])) @ self.coefficients()
+        return tf.reshape(mapped, tf.shape(pts)) if len(pts.shape)==3 else mapped
+
+
+class PolynomialModel(LinearModel):
+    '''
+    Polynomial mapping of arbitrary degree, containing all monomials x1^i * x2^j with i+j<=degree.
+    The positions are first normalized as (pts-offset)/scale to keep high degrees well conditioned.
+    The model can be trained via Train_Model, but as it is linear in its coefficients it is
+    mostly fitted in closed form on linked pairs via fit()
+
+    Parameters
+    ----------
+    degree : int
+        The degree of the polynomial
+    offset : 2 np.array, scale : float
+        The normalization of the positions, fit() sets these to the center and extent of the input
+
+    Variables
+    ----------
+    C : Mx2 tf.float32
+        The coefficients of the M monomials, initialized as the identity mapping
+    '''
+    def __init__(self, degree=3, offset=[0,0], scale=1, name='Polynomial'):
+        super().__init__(name=name)
+        self.degree = degree
+        self.exponents = np.array([[i, n-i] for n in range(degree+1) for i in range(n,-1,-1)])
+        self.offset = tf.Variable(offset, dtype=tf.float32, trainable=False, name='offset')
+        self.scale = tf.Variable(scale, dtype=tf.float32, trainable=False, name='scale')
+        self.C = tf.Variable(self.identity(), dtype=tf.float32, trainable=True, name='C')
+        self.robust_weights = None
+        self.prepare(None)
+
+
+    def identity(self):
+    # the coefficients that map the normalized positions back onto themselves
+        C = np.zeros([self.exponents.shape[0], 2])
+        C[0,:] = self.offset.numpy()
+        C[np.all(self.exponents==[1,0], axis=1), 0] = self.scale.numpy()
+        C[np.all(self.exponents==[0,1], axis=1), 1] = self.scale.numpy()
+        return C
+
+
+    def coefficients(self):
+    # the Mx2 coefficient matrix, row m belongs to the monomial with exponents[m]
+        return self.C
+
+
+    @tf.function
+    def design_matrix(self, pts):
+    # the NxM matrix of monomials of the normalized positions
+        u = (pts - self.offset[None]) / self.scale
+        px = tf.stack([u[:,0]**i for i in range(self.degree+1)], axis=1)
+        py = tf.stack([u[:,1]**i for i in range(self.degree+1)], axis=1)
+        return tf.gather(px, self.exponents[:,0], axis=1) * tf.gather(py, self.exponents[:,1], axis=1)
+
+
+    def design_matrix_np(self, pts, offset, scale):
+    # the design matrix in float64
+        u = (np.reshape(np.asarray(pts, dtype=np.float64), [-1,2]) - offset) / scale
+        return u[:,0,None]**self.exponents[None,:,0] * u[:,1,None]**self.exponents[None,:,1]
+
+
+    def fit(self, pts, target, method='qr', weights=None, robust=None, c=None):
+        '''
+        Fits the mapping from pts onto target in closed form
+
+        Parameters
+        ----------
+        pts, target : Nx2 np.array
+            The linked pairs, pts is mapped onto target
+        method : 'qr', 'svd' or 'normal'
+            Solve via a QR decomposition, the SVD or the normal equations
+        weights : N np.array, optional
+            The weight of every pair, for example the inverse localization variance
+        robust : None, 'huber' or 'tukey'
+            Fit via iteratively reweighted least squares with the given loss, to suppress mislinked pairs.
+            The final robust weights are stored in self.robust_weights
+        c : float, optional
+            The tuning constant of the robust loss in units of the estimated localization error
+        '''
+        pts = np.reshape(np.asarray(pts, dtype=np.float64), [-1,2])
+        offset = np.mean(pts, axis=0)
+        scale = np.max(np.abs(pts-offset))
+        if scale==0: scale=1
+        X = self.design_matrix_np(pts, offset, scale)
+        target = np.reshape(np.asarray(target, dtype=np.float64), [-1,2])
+
+        if robust is None:
+            C = lstsq(X, target, weights, method)
+            self.robust_weights = None
+        else:
+            C, self.robust_weights = robust_lstsq(X, target, weights, method, loss=robust, c=c)
+        self.offset.assign(offset)
+        self.scale.assign(scale)
+        self.C.assign(C)
+        return self
@@ -5,18 +5,30 @@ Created on Thu Sep  9 16:07:41 2021
 @author: Mels
 """
 import tensorflow as tf
+import numpy as np
 
-class Polynomial3Model(tf.keras.Model):
+from LeastSquares import lstsq
+from Align_Modules.Polynomial import LinearModel
+
+class Polynomial3Model(LinearModel):
     '''
     Main Layer for calculating the relative entropy of a certain deformation
     ----------
     - it takes the pts, the [x1,x2] locations of all localizations
     - gives it a certain polynomial deformation via the Polynomial Class
-    - calculates the relative entropy via Rel_entropy()    
+    - calculates the relative entropy via Rel_entropy()
+
+    M1[i,j] and M2[i,j] are the coefficients of u1^i * u2^j of both output dimensions, with the
+    positions normalized as u=(pts-offset)/scale like in PolynomialModel. The defaults offset=[0,0] 
+    and scale=1 leave the positions as they are, fit() sets them to the center and extent of the input.
+    The mapping is evaluated as the Nx9 monomial design matrix times the 9x2 coefficient matrix. The 
+    design matrix of an input that is used repeatedly can be precomputed via prepare(pts)
     '''
-    
-    def __init__(self, name = 'Polynomial3'): 
+
+    def __init__(self, name = 'Polynomial3', offset=[0,0], scale=1):
         super().__init__(name=name)
+        self.offset = tf.Variable(offset, dtype=tf.float32, trainable=False, name='offset')
+        self.scale = tf.Variable(scale, dtype=tf.float32, trainable=False, name='scale')
         self.M1 = tf.Variable([[0.0, 0.0, 0.0],
                                [1.0, 0.0, 0.0],
                                [0.0, 0.0, 0.0]],
@@ -27,58 +39,35 @@ class Polynomial3Model(tf.keras.Model):
                                [0.0, 0.0, 0.0]],
                               dtype=tf.float32, trainable=True, name = 'M2'
                               )
-    
-    
-    @tf.function 
-    def call(self, pts):
-        if len(pts.shape)==2: # transform vectors
-            y = tf.stack([
-                tf.concat([self.M1[0,0]*tf.ones([pts.shape[0],1]), 
-                           self.M1[1,0]*pts[:,0][:,None],
-                           self.M1[0,1]*pts[:,1][:,None],
-                           self.M1[1,1]*(pts[:,0]*pts[:,1])[:,None],
-                           self.M1[2,1]*((pts[:,0]**2)*pts[:,1])[:,None],
-                           self.M1[2,2]*((pts[:,0]*pts[:,1])**2)[:,None],
-                           self.M1[1,2]*(pts[:,0]*(pts[:,1]**2))[:,None],
-                           self.M1[0,2]*(pts[:,1]**2)[:,None],
-                           self.M1[2,0]*(pts[:,0]**2)[:,None]
-                           ], axis = 1),
-                tf.concat([self.M2[0,0]*tf.ones([pts.shape[0],1]), 
-                           self.M2[1,0]*pts[:,0][:,None],
-                           self.M2[0,1]*pts[:,1][:,None],
-                           self.M2[1,1]*(pts[:,0]*pts[:,1])[:,None],
-                           self.M2[2,1]*((pts[:,0]**2)*pts[:,1])[:,None],
-                           self.M2[2,2]*((pts[:,0]*pts[:,1])**2)[:,None],
-                           self.M2[1,2]*(pts[:,0]*(pts[:,1]**2))[:,None],
-                           self.M2[0,2]*(pts[:,1]**2)[:,None],
-                           self.M2[2,0]*(pts[:,0]**2)[:,None]
-                           ], axis = 1),
-                ], axis = 2)
-            return tf.reduce_sum(y, axis = 1)
-        
-        elif len(pts.shape)==3: # transform matrices
-            y = tf.stack([
-                tf.concat([self.M1[0,0]*tf.ones([1, pts.shape[0], pts.shape[1]]), 
-                           self.M1[1,0]*pts[:,:,0][None],
-                           self.M1[0,1]*pts[:,:,1][None],
-                           self.M1[1,1]*(pts[:,:,0]*pts[:,:,1])[None],
-                           self.M1[2,1]*((pts[:,:,0]**2)*pts[:,:,1])[None],
-                           self.M1[2,2]*((pts[:,:,0]*pts[:,:,1])**2)[None],
-                           self.M1[1,2]*(pts[:,:,0]*(pts[:,:,1]**2))[None],
-                           self.M1[0,2]*(pts[:,:,1]**2)[None],
-                           self.M1[2,0]*(pts[:,:,0]**2)[None]
-                           ], axis = 0)[:,:,:,None],
-                tf.concat([self.M2[0,0]*tf.ones([1, pts.shape[0], pts.shape[1]]), 
-                           self.M2[1,0]*pts[:,:,0][None],
-                           self.M2[0,1]*pts[:,:,1][None],
-                           self.M2[1,1]*(pts[:,:,0]*pts[:,:,1])[None],
-                           self.M2[2,1]*((pts[:,:,0]**2)*pts[:,:,1])[None],
-                           self.M2[2,2]*((pts[:,:,0]*pts[:,:,1])**2)[None],
-                           self.M2[1,2]*(pts[:,:,0]*(pts[:,:,1]**2))[None],
-                           self.M2[0,2]*(pts[:,:,1]**2)[None],
-                           self.M2[2,0]*(pts[:,:,0]**2)[None]
-                           ], axis = 0)[:,:,:,None]
-                ], axis = 3)
-            return tf.reduce_sum(tf.reduce_sum(y, axis = 0), axis = 3)
-        
-        else: raise ValueError('Invalid input shape! ch1 has shape '+str(pts.shape) )
\ No newline at end of file
+        self.prepare(None)
+
+
+    def coefficients(self):
+    # the 9x2 coefficient matrix, row 3*i+j belongs to u1^i * u2^j
+        return tf.stack([tf.reshape(self.M1, [9]), tf.reshape(self.M2, [9])], axis=1)
+
+
+    @tf.function
+    def design_matrix(self, pts):
+    # the Nx9 matrix of monomials u1^i * u2^j of the normalized positions, with column 3*i+j
+        u = (pts - self.offset[None]) / self.scale
+        px = tf.stack([tf.ones_like(u[:,0]), u[:,0], u[:,0]**2], axis=1)
+        py = tf.stack([tf.ones_like(u[:,1]), u[:,1], u[:,1]**2], axis=1)
+        return tf.reshape(px[:,:,None] * py[:,None,:], [-1,9])
+
+
+    def fit(self, pts, target):
+    # the closed form least squares fit of the mapping from pts onto target, as the model is linear in M1 and M2.
+    # The fit is solved in float64 on the normalized positions, the variables are only cast when assigned
+        pts = np.reshape(np.asarray(pts, dtype=np.float64), [-1,2])
+        offset = np.mean(pts, axis=0)
+        scale = np.max(np.abs(pts-offset))
+        if scale==0: scale=1
+        u = (pts-offset)/scale
+        X = np.reshape((u[:,0,None]**np.arange(3))[:,:,None] * (u[:,1,None]**np.arange(3))[:,None,:], [-1,9])
+        C = lstsq(X, np.reshape(np.asarray(target, dtype=np.float64), [-1,2]))
+        self.offset.assign(offset)
+        self.scale.assign(scale)
+        self.M1.assign(np.reshape(C[:,0], [3,3]))
+        self.M2.assign(np.reshape(C[:,1], [3,3]))
+        return self
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+"""
+Regression check of the batched affine fit. Every group of a simulated dataset gets its own affine, 
+which should be recovered, and a group with fewer than 3 pairs should be refused instead of receiving 
+a degenerate affine. Raises an exception on a failure
+"""
+import numpy as np
+
+import sys
+sys.path.insert(0, '../..')
+from LeastSquares import affine_lstsq
+
+
+rng = np.random.default_rng(0)
+G, N = (4, 2000)
+A = np.stack([np.concatenate([np.eye(2)+rng.normal(0, 1e-3, (2,2)), rng.normal(0, 100, (2,1))], axis=1) for g in range(G)])
+groups = rng.integers(0, G, N)
+pts = rng.uniform(-20000, 20000, (N,2))
+target = np.einsum('nij,nj->ni', A[groups,:,:2], pts) + A[groups,:,2] + rng.normal(0, 1, (N,2))
+
+## the affines of every group are recovered
+err = np.max(np.abs(affine_lstsq(pts, target, groups=groups)-A)[:,:,2])
+print('Maximum error of the batched translations:', err, 'nm')
+if err>1: raise Exception('The batched affines are not recovered!')
+
+## groups with 1 or 2 pairs are refused
+for n in [1, 2]:
+    small = np.concatenate([groups, np.full(n, G)])
+    try:
+        affine_lstsq(np.concatenate([pts, pts[:n]]), np.concatenate([target, target[:n]]), groups=small)
+    except ValueError as e: print('Group with', n, 'pairs refused:', e)
+    else: raise Exception('A group with '+str(n)+' pairs was not refused!')
+print('Affine least squares check passed')
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the cold import time of the package modules, which fails if a module that is used for
+loading, linking or applying mappings imports TensorFlow or matplotlib again
+"""
+import os
+import sys
+import subprocess
+
+root=os.path.abspath(os.path.join(os.path.dirname(__file__), '../..'))
+modules=['Channel', 'Loaders', 'Neighbours', 'LeastSquares', 'Mapping', 'Cache', 'Sweep', 'Dataset']
+heavy=['tensorflow', 'matplotlib', 'photonpy']
+
+
+def import_time(module):
+# the cumulative import time in s via python -X importtime, and the heavy modules that were imported
+    code='import '+module+', sys; print(",".join(m for m in '+str(heavy)+' if m in sys.modules))'
+    out=subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=root,
+                       capture_output=True, text=True)
+    if out.returncode!=0: raise Exception('Importing '+module+' failed:\n'+out.stderr)
+    for line in out.stderr.splitlines(): # import time: self [us] | cumulative | imported package
+        fields=line.split('|')
+        if len(fields)==3 and fields[2].strip()==module: cumulative=int(fields[1])*1e-6
+    return cumulative, [m for m in out.stdout.strip().split(',') if m]
+
+
+#%% Benchmark
+print('{:>14} {:>12} {:>24}'.format('module', 'import [s]', 'heavy imports'))
+regressions=[]
+for module in modules:
+    t, imported = import_time(module)
+    print('{:>14} {:>12.3f} {:>24}'.format(module, t, ','.join(imported) if imported else '-'))
+    if imported: regressions.append(module)
+if regressions: raise Exception('The modules '+str(regressions)+' import '+str(heavy)+' at import time!')
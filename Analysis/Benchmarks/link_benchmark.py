@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the linking engine that turns the FindNeighbors output into pairs
+"""
+import time
+import numpy as np
+
+import sys
+sys.path.insert(0, '../..')
+from Neighbours import nearest_pairs, get_backend
+
+
+#%% the old linking loop
+def nearest_pairs_loop(pos1, pos2, counts, indices):
+    (idx1, idx2, pos, i) = ([], [], 0, 0)
+    for count in counts:
+        if count!=0:
+            idx=indices[pos:pos+count]
+            j=np.argmin( np.sum((pos1[i,:]-pos2[idx,:])**2, axis=1) )
+            idx1.append(i)
+            idx2.append(idx[j])
+        pos+=count
+        i+=1
+    return np.array(idx1), np.array(idx2)
+
+
+def generate_pairs(N, density=1e-4, loc_error=10, seed=0):
+# beads scattered with a fixed density, so the number of neighbours per point stays constant
+    rng=np.random.default_rng(seed)
+    L=np.sqrt(N/density)
+    pos1=np.float32(rng.uniform(0, L, (N,2)))
+    pos2=np.float32(pos1 + rng.normal(0, loc_error, (N,2)))
+    return pos1, pos2
+
+
+#%% Benchmark
+maxDistance=250
+backend=get_backend(sys.argv[1] if len(sys.argv)>1 else None)
+print('Linking via the',backend)
+print('{:>10} {:>12} {:>12} {:>12}'.format('N', 'FindNN [s]', 'loop [s]', 'vector [s]'))
+for N in [int(1e4), int(1e5), int(1e6), int(1e7)]:
+    pos1, pos2 = generate_pairs(N)
+    t0=time.time()
+    counts,indices = backend.FindNeighbors(pos1, pos2, maxDistance)
+    t_nn=time.time()-t0
+
+    t0=time.time()
+    idx1, idx2 = nearest_pairs(pos1, pos2, counts, indices)
+    t_vec=time.time()-t0
+
+    if N<=1e5: # the loop becomes impractically slow above this
+        t0=time.time()
+        idx1_loop, idx2_loop = nearest_pairs_loop(pos1, pos2, counts, indices)
+        t_loop=time.time()-t0
+        if not (np.array_equal(idx1, idx1_loop) and np.array_equal(idx2, idx2_loop)):
+            raise Exception('Vectorized linking returns different pairs than the loop!')
+    else: t_loop=np.nan
+    print('{:>10} {:>12.3f} {:>12.3f} {:>12.3f}'.format(N, t_nn, t_loop, t_vec))
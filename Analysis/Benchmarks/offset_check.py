@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+"""
+Regression check of offsetting a dataset after mappings have been applied. The splines are solved on a 
+small simulated dataset, after which zero_image should move both channels by the returned offset while 
+keeping the mapping. Raises an exception on a mismatch
+"""
+import numpy as np
+
+import sys
+sys.path.insert(0, '../..')
+from Dataset import dataset
+
+
+rng = np.random.default_rng(0)
+N = 5000
+pos1 = rng.uniform(-15000, 15000, (N,2)).astype(np.float32)
+pos2 = pos1 + np.float32(200*np.sin(pos1[:,::-1]/8000)) + rng.normal(0, 5, (N,2)).astype(np.float32)
+frame = np.arange(N, dtype=np.float32)
+
+DS = dataset('simulation', linked=True, NN_backend='cKDTree')
+DS.load_channels({'pos' : pos1, 'frame' : frame}, {'pos' : pos2, 'frame' : frame})
+DS.AffineLLS()
+DS.Train_Splines(None, None, gridsize=5000, method='lstsq')
+DS.Apply_Splines()
+pos1, pos2 = (DS.ch1.pos.copy(), DS.ch2.pos.copy())
+
+## both channels should move by the offset
+offset = DS.zero_image(2*DS.gridsize)
+err = max(np.max(np.abs(DS.ch1.pos-(pos1+offset))), np.max(np.abs(DS.ch2.pos-(pos2+offset))))
+print('Maximum error of the offset channels:', err, 'nm')
+if err>1e-2: raise Exception('zero_image did not move both channels by the offset!')
+
+## replaying the history from the offset originals gives the same positions
+DS.Replay_Transforms()
+err = np.max(np.abs(DS.ch2.pos-(pos2+offset)))
+print('Maximum error of the replayed channel:', err, 'nm')
+if err>1e-2: raise Exception('The transform history does not follow the offset!')
+print('Offset check passed')
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""
+Timing of the analytic spline gradient against autodiff, the gradient itself is checked by
+spline_gradient_check.py
+"""
+import time
+import numpy as np
+import tensorflow as tf
+tf.get_logger().setLevel('ERROR')
+
+import sys
+sys.path.insert(0, '../..')
+from CatmullRomSpline2D import CatmullRomSpline2D
+
+
+def loss_gradient(model, pts, target):
+    with tf.GradientTape() as tape:
+        loss = tf.reduce_sum(tf.square(target-model(pts)))
+    return tape.gradient(loss, model.ControlPoints)
+
+
+def generate(N, nx=40, ny=30):
+    CP = np.stack(np.meshgrid(np.arange(nx, dtype=np.float32), np.arange(ny, dtype=np.float32)), axis=-1)
+    CP += np.float32(0.1*np.random.randn(*CP.shape))
+    pts = tf.constant(np.random.uniform(0, min(nx,ny)-1, (N,2)), dtype=tf.float32)
+    target = pts + tf.constant(np.random.normal(0, 0.1, (N,2)), dtype=tf.float32)
+    return CP, pts, target
+
+
+#%% Timing
+print('\n{:>10} {:>14} {:>14}'.format('N', 'autodiff [ms]', 'analytic [ms]'))
+for N in [int(1e4), int(1e5), int(1e6), int(5e6)]:
+    CP, pts, target = generate(N)
+    times=[]
+    for analytic_gradient in [False, True]:
+        model = CatmullRomSpline2D(CP, analytic_gradient=analytic_gradient)
+        model.prepare(pts)
+        step = tf.function(lambda: loss_gradient(model, pts, target))
+        step() # tracing
+        t0 = time.time()
+        for i in range(20): step()
+        times.append((time.time()-t0)/20*1000)
+    print('{:>10} {:>14.1f} {:>14.1f}'.format(N, *times))
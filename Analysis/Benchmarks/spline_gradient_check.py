@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""
+Regression check of the analytic spline gradient against autodiff and finite differences on a small 
+random grid. Runs in a few seconds and raises an exception on a mismatch
+"""
+import numpy as np
+import tensorflow as tf
+tf.get_logger().setLevel('ERROR')
+
+import sys
+sys.path.insert(0, '../..')
+from CatmullRomSpline2D import CatmullRomSpline2D, spline_evaluate
+
+
+def loss_gradient(model, pts, target):
+    with tf.GradientTape() as tape:
+        loss = tf.reduce_sum(tf.square(target-model(pts)))
+    return tape.gradient(loss, model.ControlPoints)
+
+
+rng = np.random.default_rng(0)
+nx, ny, N = (12, 9, 500)
+CP = np.stack(np.meshgrid(np.arange(nx, dtype=np.float32), np.arange(ny, dtype=np.float32)), axis=-1)
+CP += np.float32(0.1*rng.standard_normal(CP.shape))
+pts = tf.constant(rng.uniform(0, min(nx,ny)-1, (N,2)), dtype=tf.float32)
+target = pts + tf.constant(rng.normal(0, 0.1, (N,2)), dtype=tf.float32)
+
+## analytic versus autodiff
+grad_analytic = loss_gradient(CatmullRomSpline2D(CP, analytic_gradient=True), pts, target)
+grad_autodiff = loss_gradient(CatmullRomSpline2D(CP, analytic_gradient=False), pts, target)
+err = np.max(np.abs(grad_analytic-grad_autodiff))/np.max(np.abs(grad_autodiff))
+print('Relative difference analytic and autodiff gradient:', err)
+if err>1e-5: raise Exception('Analytic gradient does not match autodiff!')
+
+## analytic versus finite differences
+ix, iy, cx, cy = CatmullRomSpline2D(CP).stencil(pts[:50])
+theoretical, numerical = tf.test.compute_gradient(lambda C: spline_evaluate(C, ix, iy, cx, cy), [tf.constant(CP)])
+err = np.max(np.abs(theoretical[0]-numerical[0]))/np.max(np.abs(numerical[0]))
+print('Relative difference analytic and finite difference gradient:', err)
+if err>1e-2: raise Exception('Analytic gradient does not match finite differences!')
+print('Gradient check passed')
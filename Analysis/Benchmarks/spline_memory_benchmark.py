@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the peak memory of evaluating CatmullRomSpline2D (and its gradient). Every
+configuration runs in a fresh process such that the peak resident memory can be compared
+"""
+import sys
+import subprocess
+import resource
+import numpy as np
+
+
+#%% the [N,4,4,2] gather evaluation that was used before
+def evaluate_gather4x4(model, pts):
+    import tensorflow as tf
+    ix, iy, cx, cy = model.stencil(pts)
+    ix = ix[:,None,:] * tf.ones(4,dtype=tf.int32)[None,:,None]
+    iy = iy[:,:,None] * tf.ones(4,dtype=tf.int32)[None,None,:]
+    idx = tf.stack([iy,ix],-1)
+    sel_ControlPoints = tf.gather_nd(model.ControlPoints, idx)
+    return tf.reduce_sum((sel_ControlPoints * cy[:,:,None,None] * cx[:,None,:,None]), axis=(1,2))
+
+
+def run(mode, N):
+# evaluates the spline and its gradient once and returns the peak memory in MB
+    import tensorflow as tf
+    sys.path.insert(0, '../..')
+    from CatmullRomSpline2D import CatmullRomSpline2D
+
+    CP = np.stack(np.meshgrid(np.arange(40, dtype=np.float32), np.arange(40, dtype=np.float32)), axis=-1)
+    pts = tf.constant(np.random.uniform(2, 37, (N,2)), dtype=tf.float32)
+    model = CatmullRomSpline2D(CP, chunk_size=int(1e6) if mode=='chunked' else None)
+    base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+    with tf.GradientTape() as tape:
+        mapped = evaluate_gather4x4(model, pts) if mode=='gather4x4' else model(pts)
+        loss = tf.reduce_sum(tf.square(mapped-pts))
+    tape.gradient(loss, model.trainable_weights)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024 - base
+
+
+#%% Benchmark
+if __name__=='__main__':
+    if len(sys.argv)==3:
+        print(run(sys.argv[1], int(sys.argv[2])))
+    else:
+        print('{:>10} {:>14} {:>14} {:>14}'.format('N', 'gather4x4 [MB]', 'separable [MB]', 'chunked [MB]'))
+        for N in [int(1e5), int(1e6), int(3e6), int(1e7)]:
+            mem = [float(subprocess.run([sys.executable, __file__, mode, str(N)], capture_output=True,
+                                        text=True).stdout.split()[-1])
+                   for mode in ['gather4x4', 'separable', 'chunked']]
+            print('{:>10} {:>14.0f} {:>14.0f} {:>14.0f}'.format(N, *mem))
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the epochs per second of the eager and the compiled training loop
+"""
+import time
+import numpy as np
+import tensorflow as tf
+tf.get_logger().setLevel('ERROR')
+
+import sys
+sys.path.insert(0, '../..')
+from dataset_simulation import dataset_simulation, Deform
+from CatmullRomSpline2D import CatmullRomSpline2D
+from Align_Modules.Affine import AffineModel
+from Align_Modules.Polynomial3 import Polynomial3Model
+
+
+#%% generate dataset
+DS1 = dataset_simulation(imgshape=[256, 512], loc_error=1.4, linked=True,
+                         pix_size=159, FrameLinking=False, BatchOptimization=False)
+DS1.generate_dataset_beads(N=10000, deform=Deform(random_deform=False))
+DS1.link_dataset(maxDistance=1000)
+epochs=300
+
+
+#%% Benchmark
+def benchmark(DS, model_fn, lr, ch1=None, ch2=None):
+    rates=[]
+    for compiled in [False, True]:
+        model=model_fn()
+        t0=time.time()
+        DS.Train_Model(model, lr=lr, epochs=epochs, opt_fn=tf.optimizers.SGD, ch1=ch1, ch2=ch2, compiled=compiled)
+        rates.append(epochs/(time.time()-t0))
+    return rates
+
+
+results={}
+results['Affine']=benchmark(DS1, AffineModel, 1e-12)
+results['Polynomial3']=benchmark(DS1, Polynomial3Model, 1e-12)
+ch1_input,ch2_input=DS1.InitializeSplines(gridsize=3000, edge_grids=1)
+results['Splines']=benchmark(DS1, lambda: CatmullRomSpline2D(DS1.ControlPoints), 1e-3, ch1_input, ch2_input)
+
+print('\n{:>12} {:>18} {:>18} {:>10}'.format('model', 'eager [epochs/s]', 'compiled [epochs/s]', 'speedup'))
+for name,(eager,compiled) in results.items():
+    print('{:>12} {:>18.1f} {:>18.1f} {:>10.1f}'.format(name, eager, compiled, compiled/eager))
@@ -85,7 +85,7 @@ if False: ## Grid
     deform=Affine_Deform(A=np.array([[ 1.0031357 ,  0.00181658, -1.3986971], 
                                   [-0.00123012,  0.9972918, 300.3556707 ]]))
     DS01.generate_dataset_grid(N=Num, deform=deform)
-    DS01.ch2.pos.assign(tf.stack([DS01.ch2.pos[:,0]+400,DS01.ch2.pos[:,1]],axis=1))
+    DS01.ch2.pos = tf.stack([DS01.ch2.pos[:,0]+400,DS01.ch2.pos[:,1]],axis=1)
     DS01=SplinesDeform(DS01, gridsize=1.5*gridsize, random_error=random_error)
     DS01, DS02=DS01.SplitDataset()
     
@@ -102,7 +102,7 @@ if False: ## Grid
 #%% functions
 def ErrorDistribution_r(DS1, simple_error=False, nbins=100, GaussianFit=True):
     if not DS1.linked: raise Exception('Dataset should first be linked before registration errors can be derived!')        
-    dist, avg, r = DS1.ErrorDist(DS1.ch1.pos.numpy(), DS1.ch2.pos.numpy())
+    dist, avg, r = DS1.ErrorDist(DS1.ch1.pos, DS1.ch2.pos)
     
     if simple_error:
         return np.std(dist), np.average(dist)
@@ -48,7 +48,7 @@ def SplinesDeform(DS, gridsize=3000, edge_grids=1, error=10, random_error=None):
 
 def ErrorDistribution_r(DS1, ch1=None,ch2=None, simple_error=False, nbins=100, GaussianFit=True):
     if not DS1.linked: raise Exception('Dataset should first be linked before registration errors can be derived!')        
-    if ch1 is None: dist, avg, r = DS1.ErrorDist(DS1.ch1.pos.numpy(), DS1.ch2.pos.numpy())
+    if ch1 is None: dist, avg, r = DS1.ErrorDist(DS1.ch1.pos, DS1.ch2.pos)
     else: dist, avg, r = DS1.ErrorDist(ch1, ch2)
     
     if simple_error:
@@ -112,7 +112,7 @@ if False: ## Grid
     deform=Affine_Deform(A=np.array([[ 1.0031357 ,  0.00181658, -1.3986971], 
                                   [-0.00123012,  0.9972918, 300.3556707 ]]))
     DS01.generate_dataset_grid(N=Num, deform=deform)
-    DS01.ch2.pos.assign(tf.stack([DS01.ch2.pos[:,0]+400,DS01.ch2.pos[:,1]],axis=1))
+    DS01.ch2.pos = tf.stack([DS01.ch2.pos[:,0]+400,DS01.ch2.pos[:,1]],axis=1)
     DS01=SplinesDeform(DS01, gridsize=deform_gridsize, error=CRS_error, random_error=random_error)
     DS01, DS02=DS01.SplitDataset()
     
@@ -115,7 +115,7 @@ if False: ## Grid
     deform=Affine_Deform(A=np.array([[ 1.0031357 ,  0.00181658, -1.3986971], 
                                   [-0.00123012,  0.9972918, 300.3556707 ]]))
     DS01.generate_dataset_grid(N=Num, deform=deform)
-    DS01.ch2.pos.assign(tf.stack([DS01.ch2.pos[:,0]+400,DS01.ch2.pos[:,1]],axis=1))
+    DS01.ch2.pos = tf.stack([DS01.ch2.pos[:,0]+400,DS01.ch2.pos[:,1]],axis=1)
     DS01=SplinesDeform(DS01, gridsize=deform_gridsize, error=CRS_error, random_error=random_error)
     
     ## optimization params
@@ -56,8 +56,8 @@ plt.close('all')
 def generate_2channels(temp, precision=10):
     # Generates the channels as matrix
     print('Generating Channels as matrix...') 
-    locs1=temp.ch1.pos.numpy()/precision
-    locs2=temp.ch2.pos.numpy()/precision
+    locs1=temp.ch1.pos/precision
+    locs2=temp.ch2.pos/precision
     temp.precision=precision
     # calculate bounds of the system
     bounds = np.empty([2,2], dtype = float) 
@@ -83,8 +83,8 @@ def generate_2channels(temp, precision=10):
 def plot_frame(DS1, frame=None):
     temp=copy.deepcopy(DS1)
     if frame is not None:
-        framepos1=tf.gather_nd(temp.ch1.pos.numpy(),np.argwhere(temp.ch1.frame==frame))
-        framepos2=tf.gather_nd(temp.ch2.pos.numpy(),np.argwhere(temp.ch2.frame==frame))
+        framepos1=tf.gather_nd(temp.ch1.pos,np.argwhere(temp.ch1.frame==frame))
+        framepos2=tf.gather_nd(temp.ch2.pos,np.argwhere(temp.ch2.frame==frame))
         del temp.ch1, temp.ch2
         temp.ch1=Channel(framepos1, frame*np.ones(framepos1.shape[0],dtype=float))
         temp.ch2=Channel(framepos2, frame*np.ones(framepos2.shape[0],dtype=float))
@@ -319,8 +319,8 @@ def ErrorDistribution_xy(DS1, fig, ax, nbins=30, xlim=31, error=None, mu=None, f
             return poptx, Nx, nx
             
         if mu is None: mu=0
-        pos1=DS1.ch1.pos.numpy()
-        pos2=DS1.ch2.pos.numpy()                
+        pos1=DS1.ch1.pos
+        pos2=DS1.ch2.pos                
         distx=pos1[:,0]-pos2[:,0]
         disty=pos1[:,1]-pos2[:,1]
         mask=np.where(distx<xlim,True, False)*np.where(disty<xlim,True,False)
@@ -501,15 +501,15 @@ def ErrorFOV(DS1, DS2, maxDistance=30, ps=1, cmap='seismic', figsize=None, title
         Y=np.linspace(min2,max2, N2)
         return X,Y,Z
     
-    pos1=DS1.ch1.pos.numpy()
-    pos2=DS1.ch2.pos.numpy()
+    pos1=DS1.ch1.pos
+    pos2=DS1.ch2.pos
     dist = pos1-pos2
     mask=np.where(np.sqrt(np.sum(dist**2,axis=1))<maxDistance,True, False)
     dist=dist[mask]
     pos1=pos1[mask]
     
-    pos11=DS2.ch1.pos.numpy()
-    pos21=DS2.ch2.pos.numpy()
+    pos11=DS2.ch1.pos
+    pos21=DS2.ch2.pos
     dist1 = pos11-pos21
     mask=np.where(np.sqrt(np.sum(dist1**2,axis=1))<maxDistance,True, False)
     dist1=dist1[mask]
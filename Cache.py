@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+The on-disk cache of intermediate dataset states
+"""
+import os
+import json
+import hashlib
+import numpy as np
+
+
+#%% Cache class
+class Cache:
+    '''
+    A directory of .npz files containing the arrays of intermediate dataset states, keyed by a hash
+    of the source files and all parameters of the steps that led to that state. The least recently
+    used entries are removed once the total size exceeds max_size. See dataset.Cached
+
+    Parameters
+    ----------
+    directory : str
+        The directory containing the cache
+    max_size : float
+        The maximum total size of the cache in bytes
+    '''
+    def __init__(self, directory='cache', max_size=10e9):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+
+    def fingerprint(self, path, sample_size=2**20):
+    # hashes the size, modification time and the first and last sample_size bytes of the file, which avoids
+    # reading multi-GB files completely while still noticing changes
+        h = hashlib.sha1()
+        stat = os.stat(path)
+        h.update(str((os.path.abspath(path), stat.st_size, stat.st_mtime_ns)).encode())
+        with open(path, 'rb') as f:
+            h.update(f.read(sample_size))
+            if stat.st_size>sample_size:
+                f.seek(max(stat.st_size-sample_size, sample_size))
+                h.update(f.read(sample_size))
+        return h.hexdigest()
+
+
+    def key(self, parent, stage, function=None, **params):
+    # the key of a stage, given the key of the state it started from (or the source files as a list) and 
+    # the name of the function that runs the stage
+        if isinstance(parent, (list, tuple)): parent = [self.fingerprint(path) for path in parent]
+        description = json.dumps([parent, stage, function, params], sort_keys=True, default=repr)
+        return stage+'_'+hashlib.sha1(description.encode()).hexdigest()
+
+
+    def path(self, key):
+        return os.path.join(self.directory, key+'.npz')
+
+
+    def load(self, key):
+    # the arrays of the entry or None if it does not exist. Loading marks the entry as recently used
+        if not os.path.exists(self.path(key)): return None
+        os.utime(self.path(key))
+        with np.load(self.path(key), allow_pickle=False) as f:
+            return {name : f[name] for name in f.files}
+
+
+    def save(self, key, arrays):
+    # stores the arrays uncompressed (fast to write and read) and evicts the least recently used entries
+        tmp = self.path(key)+'.tmp' # does not end in .npz, so evict and clear leave writes in progress alone
+        with open(tmp, 'wb') as f: np.savez(f, **arrays)
+        os.replace(tmp, self.path(key))
+        self.evict()
+
+
+    def evict(self):
+        entries = [os.path.join(self.directory, f) for f in os.listdir(self.directory) if f.endswith('.npz')]
+        entries.sort(key=lambda f: os.stat(f).st_mtime)
+        size = sum(os.stat(f).st_size for f in entries)
+        while size>self.max_size and len(entries)>1:
+            size -= os.stat(entries[0]).st_size
+            os.remove(entries.pop(0))
+
+
+    def clear(self):
+        for f in os.listdir(self.directory):
+            if f.endswith('.npz'): os.remove(os.path.join(self.directory, f))
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+The Catmull-Rom spline basis and stencils in NumPy, as used by CatmullRomSpline2D
+"""
+import numpy as np
+
+
+def spline_basis():
+# the matrix A such that [1, s, s^2, s^3] @ A gives the weights of the 4 neighbouring control points
+    hermiteBasis = np.array([
+         [2, -2, 1, 1],
+         [-3, 3,-2,-1],
+         [0,  0, 1, 0],
+         [1,  0, 0, 0]])
+
+    catmullRom = np.array([
+        [0,1,0,0],
+        [0,0,1,0],
+        [-0.5,0,0.5,0],
+        [0,-0.5,0,0.5]])
+    return (( hermiteBasis @ catmullRom )[::-1]).copy()
+
+
+def spline_stencil(pts, shape):
+    '''
+    Generates the 4x4 stencil of control points that every position in pts depends on.
+
+    Parameters
+    ----------
+    pts : Nx2 np.array
+        The positions in units of the gridsize (as given by InputSplines)
+    shape : tuple
+        The shape of the ControlPoints grid, (y-size, x-size)
+
+    Returns
+    ----------
+    ix, iy : Nx4 np.array int
+        The x- and y-indices of the stencil, clipped to the grid
+    cx, cy : Nx4 np.array
+        The spline weights in the x- and y-direction
+    '''
+    pts=np.asarray(pts, dtype=np.float64)
+    x = pts[:,0]
+    y = pts[:,1]
+
+    ix = x.astype(np.int64)
+    sx = np.clip(x-np.floor(x), 0, 1)
+    iy = y.astype(np.int64)
+    sy = np.clip(y-np.floor(y), 0, 1)
+
+    iy = np.clip((iy-1)[:,None] + np.arange(4)[None,:], 0, shape[0]-1)
+    ix = np.clip((ix-1)[:,None] + np.arange(4)[None,:], 0, shape[1]-1)
+
+    # compute sx^a * A
+    A = spline_basis()
+    cx = (sx[:,None]**np.arange(4)[None,:]) @ A
+    cy = (sy[:,None]**np.arange(4)[None,:]) @ A
+    return ix, iy, cx, cy
+
+
+def spline_weights(pts, shape):
+# the flattened control point indices and weights, such that the spline equals
+# sum(weights * ControlPoints.reshape(-1,2)[idx], axis=1)
+    ix, iy, cx, cy = spline_stencil(pts, shape)
+    idx = (iy[:,:,None]*shape[1] + ix[:,None,:]).reshape(-1,16)
+    weights = (cy[:,:,None]*cx[:,None,:]).reshape(-1,16)
+    return idx, weights
+
+
+def design_matrix(pts, shape):
+# the sparse NxM matrix that maps the M flattened control points onto the spline at pts
+    from scipy.sparse import csr_matrix
+    idx, weights = spline_weights(pts, shape)
+    rows = np.repeat(np.arange(idx.shape[0]), 16)
+    return csr_matrix((weights.ravel(), (rows, idx.ravel())), shape=(idx.shape[0], shape[0]*shape[1]))
+
+
+def smoothness_matrix(shape):
+# the second order finite differences along both axes of the control point grid
+    from scipy.sparse import csr_matrix, diags, kron, identity, vstack
+    def D2(n):
+        if n<3: return csr_matrix((0,n))
+        return diags([np.ones(n-2), -2*np.ones(n-2), np.ones(n-2)], [0,1,2], shape=(n-2,n))
+    return vstack([kron(identity(shape[0]), D2(shape[1])), kron(D2(shape[0]), identity(shape[1]))]).tocsr()
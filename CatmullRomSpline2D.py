@@ -7,24 +7,14 @@ Created on Thu Sep  9 16:23:12 2021
 import tensorflow as tf
 import numpy as np
 
+from CatmullRomBasis import spline_basis
+
 class _CatmullRomSplineBase(tf.keras.Model):
     
     def __init__(self):
         super(_CatmullRomSplineBase, self).__init__()
 
-        hermiteBasis = np.array([
-             [2, -2, 1, 1],
-             [-3, 3,-2,-1],
-             [0,  0, 1, 0],
-             [1,  0, 0, 0]])
-        
-        catmullRom = np.array([
-            [0,1,0,0],
-            [0,0,1,0],
-            [-0.5,0,0.5,0],
-            [0,-0.5,0,0.5]])
-    
-        A = (( hermiteBasis @ catmullRom )[::-1]).copy()
+        A = spline_basis()
         self.spline_basis  = tf.Variable(A, trainable=False, dtype=tf.float32)
         
     def __str__(self):
@@ -33,69 +23,104 @@ class _CatmullRomSplineBase(tf.keras.Model):
 
 class CatmullRomSpline2D(_CatmullRomSplineBase):
     """
-    Spline that maps a 2D coordinate onto a n-d output
+    Spline that maps a 2D coordinate onto a n-d output. The stencil of an input that is used 
+    repeatedly (like during training) can be precomputed via prepare(pts). If chunk_size is given,
+    inputs are evaluated in chunks of chunk_size positions to bound the memory of the temporaries.
+    The gradient towards the ControlPoints is analytic unless analytic_gradient=False
     """
-    def __init__(self, ControlPoints):
+    def __init__(self, ControlPoints, chunk_size=None, analytic_gradient=True):
         super(CatmullRomSpline2D, self).__init__()
         
         assert(len(ControlPoints.shape)==3)
         self.ControlPoints = tf.Variable(ControlPoints, trainable=True, dtype=tf.float32)
+        self.chunk_size = chunk_size
+        self.analytic_gradient = analytic_gradient   # use the analytic gradient instead of autodiff
+        self.prepare(None)
+        
+        
+    def prepare(self, pts):
+    # precomputes the stencils of pts. Calling the model with the same pts object afterwards only 
+    # gathers the ControlPoints and sums them. prepare(None) clears the cache
+        if pts is None:
+            self._cache_ref, self._cache_stencil = (None, None)
+        else:
+            self._cache_ref=pts.ref()
+            self._cache_stencil=self.stencil(tf.reshape(pts, [-1,2]))
         
         
-    @tf.function 
     def call(self, pts):
-        if len(pts.shape)==2: # transform vectors
-            x = pts[:,0]
-            y = pts[:,1]
-    
-            ix = tf.cast(x, tf.int32)
-            sx = tf.clip_by_value(x-tf.floor(x), 0, 1)
-    
-            iy = tf.cast(y, tf.int32)
-            sy = tf.clip_by_value(y-tf.floor(y), 0, 1)
+        if len(pts.shape)!=2 and len(pts.shape)!=3: 
+            raise ValueError('Invalid input shape! ch1 has shape '+str(pts.shape) )
+        
+        if self._cache_ref is not None and hasattr(pts, 'ref') and pts.ref()==self._cache_ref:
+            ix, iy, cx, cy = self._cache_stencil
+            mapped = self.chunked(lambda i,j: self.evaluate(ix[i:j], iy[i:j], cx[i:j], cy[i:j]), ix.shape[0])
+        else: # transform vectors or matrices
+            pts_flat = tf.reshape(pts, [-1,2])
+            mapped = self.chunked(lambda i,j: self.evaluate(*self.stencil(pts_flat[i:j])), pts_flat.shape[0])
+        return tf.reshape(mapped, tf.shape(pts)) if len(pts.shape)==3 else mapped
     
-            iy = tf.clip_by_value(((iy-1)[:,None] + tf.range(4)[None,:]), 0, self.ControlPoints.shape[0]-1)
-            ix = tf.clip_by_value(((ix-1)[:,None] + tf.range(4)[None,:]), 0, self.ControlPoints.shape[1]-1)
     
-            # compute sx^a * A
-            cx = (sx[:,None]**(tf.range(4,dtype=tf.float32)[None])) @ self.spline_basis
-            cy = (sy[:,None]**(tf.range(4,dtype=tf.float32)[None])) @ self.spline_basis
-            
-            ix = ix[:,None,:] * tf.ones(4,dtype=tf.int32)[None,:,None]
-            iy = iy[:,:,None] * tf.ones(4,dtype=tf.int32)[None,None,:]
-            #ix = tf.repeat(ix[:,None,:], 4, axis=1) # repeat x over y axis
-            #iy = tf.repeat(iy[:,:,None], 4, axis=2) # repeat y over x axis
-            idx = tf.stack([iy,ix],-1)
-            sel_ControlPoints = tf.gather_nd(self.ControlPoints, idx)
-            
-            # sel_ControlPoints shape is [#evals, y-index, x-index, dims]
-            return tf.reduce_sum((sel_ControlPoints * cy[:,:,None,None] * cx[:,None,:,None]), axis=(1,2))
+    def chunked(self, fn, N):
+    # evaluates fn(begin, end) over chunks of the input
+        if self.chunk_size is None or N is None or N<=self.chunk_size: return fn(0, N)
+        return tf.concat([fn(i, min(i+self.chunk_size, N)) for i in range(0, N, self.chunk_size)], axis=0)
+        
         
-        elif len(pts.shape)==3: # transform matrices
-            x = pts[:,:,0]
-            y = pts[:,:,1]
+    @tf.function
+    def stencil(self, pts):
+    # the indices of the 4x4 ControlPoints each position depends on and their weights, 
+    # the indices ix, iy and weights cx, cy each have shape [#evals, 4]
+        x = pts[:,0]
+        y = pts[:,1]
+
+        ix = tf.cast(x, tf.int32)
+        sx = tf.clip_by_value(x-tf.floor(x), 0, 1)
+
+        iy = tf.cast(y, tf.int32)
+        sy = tf.clip_by_value(y-tf.floor(y), 0, 1)
+
+        iy = tf.clip_by_value(((iy-1)[:,None] + tf.range(4)[None,:]), 0, self.ControlPoints.shape[0]-1)
+        ix = tf.clip_by_value(((ix-1)[:,None] + tf.range(4)[None,:]), 0, self.ControlPoints.shape[1]-1)
+
+        # compute sx^a * A
+        cx = (sx[:,None]**(tf.range(4,dtype=tf.float32)[None])) @ self.spline_basis
+        cy = (sy[:,None]**(tf.range(4,dtype=tf.float32)[None])) @ self.spline_basis
+        return ix, iy, cx, cy
     
-            ix = tf.cast(x, tf.int32)
-            sx = tf.clip_by_value(x-tf.floor(x), 0, 1)
     
-            iy = tf.cast(y, tf.int32)
-            sy = tf.clip_by_value(y-tf.floor(y), 0, 1)
+    @tf.function
+    def evaluate(self, ix, iy, cx, cy):
+        if self.analytic_gradient:
+            return spline_evaluate(tf.convert_to_tensor(self.ControlPoints), ix, iy, cx, cy)
+        return _spline_evaluate(self.ControlPoints, ix, iy, cx, cy)
     
-            iy = tf.clip_by_value(((iy-1)[:,:,None] + tf.range(4)[None,None,:]), 0, self.ControlPoints.shape[0]-1)
-            ix = tf.clip_by_value(((ix-1)[:,:,None] + tf.range(4)[None,None,:]), 0, self.ControlPoints.shape[1]-1)
     
-            # compute sx^a * A
-            cx = (sx[:,:,None]**(tf.range(4,dtype=tf.float32)[None,None,:])) @ self.spline_basis
-            cy = (sy[:,:,None]**(tf.range(4,dtype=tf.float32)[None,None,:])) @ self.spline_basis
-            
-            ix = ix[:,:,None,:] * tf.ones(4,dtype=tf.int32)[None,None,:,None]
-            iy = iy[:,:,:,None] * tf.ones(4,dtype=tf.int32)[None,None,None,:]
-            #ix = tf.repeat(ix[:,None,:], 4, axis=1) # repeat x over y axis
-            #iy = tf.repeat(iy[:,:,None], 4, axis=2) # repeat y over x axis
-            idx = tf.stack([iy,ix],-1)
-            sel_ControlPoints = tf.gather_nd(self.ControlPoints, idx)
-            
-            # sel_ControlPoints shape is [#evals, y-index, x-index, dims]
-            return tf.reduce_sum((sel_ControlPoints * cy[:,:,:,None,None] * cx[:,:,None,:,None]), axis=(2,3))
-        
-        else: raise ValueError('Invalid input shape! ch1 has shape '+str(pts.shape) )
\ No newline at end of file
+#%% evaluation
+def _spline_evaluate(ControlPoints, ix, iy, cx, cy):
+# evaluates the tensor product separably, first along x for every row of the stencil and then 
+# along y, such that the largest temporary has shape [#evals, 4, dims] 
+    ControlPoints_flat = tf.reshape(ControlPoints, [-1, ControlPoints.shape[2]])
+    mapped = 0.
+    for a in range(4):
+        row = tf.gather(ControlPoints_flat, iy[:,a:a+1]*ControlPoints.shape[1] + ix)
+        mapped += cy[:,a,None] * tf.reduce_sum(row * cx[:,:,None], axis=1)
+    return mapped
+
+
+@tf.custom_gradient
+def spline_evaluate(ControlPoints, ix, iy, cx, cy):
+# The spline evaluation with an analytic gradient. The output is linear in the ControlPoints with
+# weights cy*cx, so the gradient is the upstream gradient scattered back onto the stencils with these 
+# weights. Gradients are only given for the ControlPoints, not for the positions
+    mapped = _spline_evaluate(ControlPoints, ix, iy, cx, cy)
+    
+    def grad(dmapped):
+        dims = ControlPoints.shape[2]
+        dControlPoints = tf.zeros([ControlPoints.shape[0]*ControlPoints.shape[1], dims], dtype=dmapped.dtype)
+        for a in range(4):
+            idx = tf.reshape(iy[:,a:a+1]*ControlPoints.shape[1] + ix, [-1])
+            updates = tf.reshape((cy[:,a,None]*cx)[:,:,None] * dmapped[:,None,:], [-1, dims])
+            dControlPoints += tf.math.unsorted_segment_sum(updates, idx, ControlPoints.shape[0]*ControlPoints.shape[1])
+        return tf.reshape(dControlPoints, tf.shape(ControlPoints)), None, None, None, None
+    return mapped, grad
@@ -4,67 +4,158 @@ Created on Sun Oct  3 14:47:49 2021
 
 @author: Mels
 """
-import tensorflow as tf
+import numpy as np
 
-#%% Channel 
+def readonly(arr, dtype=None):
+# a read-only view of arr, which leaves the flags of arr itself untouched
+    arr = np.asarray(arr, dtype=dtype).view()
+    arr.flags.writeable = False
+    return arr
+
+
+#%% Channel
 class Channel:
-    def __init__(self, pos=None, frame=None, group=None):
-        self.pos = tf.Variable(pos, dtype=tf.float32, trainable=False) if pos is not None else {}
-        self.frame = (tf.Variable(frame, dtype=tf.float32, trainable=False) if frame is not None else 
-                      tf.ones(pos.shape[0], dtype=tf.float32))
-        self.group = tf.Variable(group, dtype=tf.int32, trainable=False) if group is not None else tf.zeros(self.frame.shape[0], dtype=tf.int32) 
-        
+    '''
+    The localizations of a single channel, stored as NumPy columns. The positions are only converted
+    to TensorFlow tensors at the training boundary (Registration.Train_Model), such that loading,
+    linking and filtering do not touch TensorFlow.
+
+    Parameters
+    ----------
+    pos : Nx2 float32
+        The positions
+    frame : N float32, optional
+        The frame of every localization, defaults to ones
+    group : N int32, optional
+        The group (cluster) of every localization, defaults to zeros
+    **columns : N np.array, optional
+        Extra columns like the photon count, sigma or intensity, which are kept aligned
+        with the positions by take and AppendChannel
+
+    The columns are stored as read-only arrays and every transformation assigns new arrays, so
+    Channels can share their columns (copy-on-write). copy() is therefore O(1)
+    '''
+    __slots__ = ('_pos', '_frame', '_group', 'columns')
+
+    def __init__(self, pos=None, frame=None, group=None, **columns):
+        self.pos = pos
+        self.frame = frame if frame is not None else np.ones(self.pos.shape[0], dtype=np.float32)
+        self.group = group if group is not None else np.zeros(self.frame.shape[0], dtype=np.int32)
+        self.columns = {key : readonly(col) for key, col in columns.items()}
+
         if self.pos.shape[0]!=self.frame.shape[0]: raise ValueError('Frame and Positions are not equal in size!')
-        self.img, self.imgsize, self.mid = self.imgparams()
-        
-        
+        for key, col in self.columns.items():
+            if col.shape[0]!=self.pos.shape[0]: raise ValueError('Column '+key+' and Positions are not equal in size!')
+
+
+    @property
+    def pos(self):
+        return self._pos
+
+    @pos.setter
+    def pos(self, pos):
+        self._pos = readonly(pos, np.float32)
+
+    @property
+    def frame(self):
+        return self._frame
+
+    @frame.setter
+    def frame(self, frame):
+        self._frame = readonly(frame, np.float32)
+
+    @property
+    def group(self):
+        return self._group
+
+    @group.setter
+    def group(self, group):
+        self._group = readonly(group, np.int32)
+
+
+    def __getattr__(self, key):
+    # the extra columns are accessible as attributes, ch.photons equals ch.columns['photons']
+        try: return object.__getattribute__(self, 'columns')[key]
+        except (KeyError, AttributeError): raise AttributeError(key) from None
+
+
+    def __getstate__(self):
+        return (self._pos, self._frame, self._group, self.columns)
+
+    def __setstate__(self, state):
+        self._pos, self._frame, self._group, self.columns = state
+
+
     def pos_all(self):
-        return self.pos.numpy() #tf.concat(self.pos, axis=0)
-        
-    
+        return self.pos
+
+
     def imgparams(self):
+    # the image borders, size and midpoint, calculated from the current positions when requested
         pos = self.pos_all()
         if len(pos.shape)==3: pos=pos[:,0,:]
         elif len(pos.shape)!=2: raise ValueError('Invalid input shape! ch1 has shape '+str(pos.shape) )
-        
-        img = tf.Variable([[ tf.reduce_min(pos[:,0]), tf.reduce_min(pos[:,1]) ],
-                           [ tf.reduce_max(pos[:,0]),  tf.reduce_max(pos[:,1]) ]], dtype=tf.float32)
+
+        img = np.array([np.min(pos, axis=0), np.max(pos, axis=0)], dtype=np.float32)
         return img, (img[1,:] - img[0,:]), (img[1,:] + img[0,:])/2
-        
-      
+
+    @property
+    def img(self):
+        return self.imgparams()[0]
+
+    @property
+    def imgsize(self):
+        return self.imgparams()[1]
+
+    @property
+    def mid(self):
+        return self.imgparams()[2]
+
+
+    def copy(self):
+    # a new Channel that shares the columns of this one
+        return Channel(self.pos, self.frame, self.group, **self.columns)
+
+
+    def take(self, idx):
+    # a new Channel containing the localizations at idx (indices or boolean mask), including the extra columns
+        idx = np.asarray(idx)
+        if idx.ndim==2: idx=idx[:,0] # the output of np.argwhere
+        return Channel(self.pos[idx], self.frame[idx], self.group[idx],
+                       **{key : col[idx] for key, col in self.columns.items()})
+
+
     def center(self):
-        self.pos.assign(self.pos - tf.reduce_mean(self.pos,axis=0))
-        
+        self.pos = self.pos - np.mean(self.pos, axis=0)
+
     def offset(self, os):
         if not isinstance(os, list): raise ValueError('Invalid input. Offset must be a list!')
-        self.pos=tf.stack([self.pos[:,0]+os[0],self.pos[:,1]+os[1]],axis=1)
-        
-        
+        self.pos = self.pos + np.array(os, dtype=np.float32)[None,:]
+
+
     def AppendChannel(self, other):
-        pos=self.pos
-        frame=self.frame
-        group=self.group
-        del self.pos,self.frame, self.group
-        self.pos=tf.Variable(tf.concat([pos,other.pos],axis=0), dtype=tf.float32, trainable=False) 
-        self.frame=tf.Variable(tf.concat([frame,other.frame],axis=0), dtype=tf.float32, trainable=False) 
-        self.group=tf.Variable(tf.concat([group,other.group],axis=0), dtype=tf.int32, trainable=False) 
-        
-        
+        self.pos = np.concatenate([self.pos, other.pos], axis=0)
+        self.frame = np.concatenate([self.frame, other.frame], axis=0)
+        self.group = np.concatenate([self.group, other.group], axis=0)
+        self.columns = {key : readonly(np.concatenate([col, other.columns[key]], axis=0))
+                        for key, col in self.columns.items() if key in other.columns}
+
+
     def ClusterCOM(self):
-        clust=[]
-        clustlist=tf.unique(self.group)[0]
-        for i in clustlist:
-            pos=tf.gather_nd(self.pos, tf.where(self.group==i))
-            clust.append(tf.reduce_sum(pos,axis=0)/pos.shape[0])
-        if len(clust)!=len(clustlist): raise Exception('The clusters have not been sorted!')
-        return tf.stack(clust, axis=0), clustlist
-        
+    # the center of mass of every cluster, in order of first appearance of the groups
+        _, first, inverse = np.unique(self.group, return_index=True, return_inverse=True)
+        order = np.argsort(first)
+        clustlist = self.group[first[order]]
+        counts = np.bincount(inverse)
+        clust = np.stack([np.bincount(inverse, self.pos[:,i]) for i in range(2)], axis=1) / counts[:,None]
+        return clust[order].astype(np.float32), clustlist
+
 
     def transpose_axis(self):
-        self.pos.assign(tf.Variable(self.pos.numpy()[:,[1,0]], dtype=tf.float32, trainable=False))
-        
+        self.pos = self.pos[:,[1,0]]
+
     def mirror_xaxis(self):
-        self.pos.assign(tf.stack([-self.pos.numpy()[:,0],self.pos.numpy()[:,1]], axis=1))
-        
+        self.pos = np.stack([-self.pos[:,0],self.pos[:,1]], axis=1)
+
     def mirror_yaxis(self):
-        self.pos.assign(tf.stack([self.pos.numpy()[:,0],-self.pos.numpy()[:,1]], axis=1))
\ No newline at end of file
+        self.pos = np.stack([self.pos[:,0],-self.pos[:,1]], axis=1)
@@ -5,19 +5,19 @@ Created on Sun Oct  3 14:17:52 2021
 @author: Mels
 """
 import copy
-import pandas as pd
-import tensorflow as tf
 import numpy as np
-from photonpy import PostProcessMethods, Context, Dataset
 
 from Registration import Registration
 from Channel import Channel 
+from Neighbours import frame_keys, get_backend
+from Loaders import read_locs_hdf5, read_locs_csv, rcc_shift
+from Mapping import Mapping
 
 
 #%% Dataset
 class dataset(Registration):
     def __init__(self, path, pix_size=1, loc_error=10, mu=0, coloc_error=None, imgshape=[512, 512],
-                 linked=False, FrameLinking=True, BatchOptimization=False, execute_linked=True):
+                 linked=False, FrameLinking=True, BatchOptimization=False, execute_linked=True, NN_backend=None):
         self.path=path            # the string or list containing the strings of the file location of the dataset
         self.pix_size=pix_size    # the multiplicationfactor to change the dataset into units of nm
         self.loc_error=loc_error  # localization error
@@ -29,35 +29,147 @@ class dataset(Registration):
         self.FrameLinking=FrameLinking              # will the dataset be linked or NN per frame?
         self.BatchOptimization=BatchOptimization    # will the dataset be optimized per frame
         self.execute_linked=execute_linked          # false if optimization via NN
+        self.NN_backend=NN_backend                  # the neighbour search, 'photonpy', 'cKDTree' or None for automatic
         self.counts_linked=None
         self.counts_Neighbours=None
+        self.cache_key=None     # the key of the last cached stage, see Cached
         Registration.__init__(self)
         
         
     def reload_dataset(self):
-        # reloads the original channels of the dataset
+        # reloads the original channels of the dataset, which share their arrays with the originals
         self.linked=self.linked_original
-        del self.ch1, self.ch2, self.ch20linked
-        self.ch1=copy.deepcopy(self.ch10)
-        self.ch2=copy.deepcopy(self.ch20) 
-        self.ch20linked=copy.deepcopy(self.ch20) 
-        try: 
-            del self.ch1NN, self.ch2NN
-        except: pass
-        self.Neighbours=False
+        self.ch1=self.ch10.copy()
+        self.ch2=self.ch20.copy()
+        self.rows2=None
+        self.transforms=[]
+        self.clear_neighbours()
         
         
     def save_dataset(self):
+    # the current positions become the originals
         self.linked_original=self.linked
-        del self.ch10, self.ch20
-        self.ch10=copy.deepcopy(self.ch1)
-        self.ch20=copy.deepcopy(self.ch2)  
+        self.ch10=self.ch1.copy()
+        self.ch20=self.ch2.copy()
+        self.rows2=None
+        self.transforms=[]
+        self.clear_neighbours()
+        
+        
+    def view(self):
+    # a shallow copy of the dataset whose channels share their arrays with this one. As the channels are 
+    # copy-on-write, transforming either dataset leaves the other intact. The models are shared as well,
+    # and are only replaced by training, use copy_models to copy them
+        other=copy.copy(self)
+        for name in ['ch1', '_ch2', 'ch10', 'ch20', 'ch1NN', '_ch2NN']:
+            if getattr(self, name, None) is not None: setattr(other, name, getattr(self, name).copy())
+        other._stale=set(self._stale)
+        other.loss=list(self.loss)
+        other.transforms=list(self.transforms)
+        return other
+        
+        
+    #%% Cache
+    def Cached(self, cache, stage, fn, **params):
+    # runs fn(**params) (for example self.link_dataset) unless the Cache contains the state after this stage.
+    # The key of a stage depends on the source files, the dataset settings and the stages before it, so a
+    # rerun with the same parameters loads the state of every stage from disk until the first changed stage.
+    # A state whose transform history contains a generic model (Apply_Model) cannot be stored, such stages 
+    # are not cached and always rerun
+        if self.cache_key is None:
+            paths = [self.path] if isinstance(self.path, str) else list(self.path)
+            settings = {'pix_size' : self.pix_size, 'imgshape' : self.imgshape, 'linked' : self.linked_original,
+                        'FrameLinking' : self.FrameLinking, 'NN_backend' : self.NN_backend, 'state' : self.state_version}
+            self.cache_key = cache.key(paths, 'source', **settings)
+        key = cache.key(self.cache_key, stage, getattr(fn, '__qualname__', repr(fn)), **params)
+        
+        state = cache.load(key)
+        if state is not None:
+            print('Loading the',stage,'stage from the cache...')
+            self.set_state(state)
+        else:
+            fn(**params)
+            if self.cacheable(): cache.save(key, self.get_state())
+            else: print('The',stage,'stage applied a model that cannot be cached, it will rerun next time')
+        self.cache_key = key
+        
+        
+    state_version = 2   # the layout of get_state, entries of older layouts are not loaded
+    state_channels = ['ch1', 'ch2', 'ch10', 'ch20', 'ch1NN', 'ch2NN']
+    state_attributes = ['linked', 'linked_original', 'Neighbours', 'rows2', 'counts_linked', 'counts_Neighbours', 
+                        'AffineMat', 'robust_weights', 'NN_pos1', 'NN_pos2', 'NN_mask', 'NN_idx', 'NN_maxDistance',
+                        'gridsize', 'edge_grids', 'x1_min', 'x2_min', 'x1_max', 'x2_max']
+    
+    def cacheable(self):
+    # whether get_state can store the complete state, generic models are not stored
+        return all(kind!='model' for kind, _ in self.transforms)
+        
+        
+    def get_state(self):
+    # the arrays of the channels, the neighbours, the trained affine and splines and the transform history, 
+    # which is everything the later stages read
+        if not self.cacheable(): raise ValueError('The transform history contains a model, which cannot be stored')
+        state = {}
+        for name in self.state_attributes:
+            if getattr(self, name, None) is not None: state[name] = np.asarray(getattr(self, name))
+        for name in self.state_channels:
+            ch = getattr(self, name, None)
+            if ch is None: continue
+            state.update({name+'_pos' : ch.pos, name+'_frame' : ch.frame, name+'_group' : ch.group})
+            state.update({name+'_col_'+key : col for key, col in ch.columns.items()})
+        if self.SplinesControlPoints() is not None: state['SplinesModel'] = self.SplinesControlPoints()
+        
+        state['transforms'] = np.array([kind for kind, _ in self.transforms])
+        for i, (kind, params) in enumerate(self.transforms):
+            prefix = 'transform'+str(i)+'_'
+            if kind=='affine':
+                state[prefix+'AffineMat'] = params[0]
+                if params[1] is not None: state[prefix+'groups'] = np.asarray(params[1])
+            elif kind=='splines':
+                state[prefix+'ControlPoints'] = params[0]
+                state[prefix+'grid'] = np.array(params[1:], dtype=np.float64)
+            elif kind=='mapping':
+                state.update({prefix+key : arr for key, arr in params.arrays().items()})
+        return state
+        
+        
+    def set_state(self, state):
+        for name in self.state_attributes:
+            value = state[name] if name in state else None
+            if value is not None and value.ndim==0: value = value.item()
+            setattr(self, name, value)
+        if self.counts_linked is not None: self.counts_linked = list(self.counts_linked)
+        if self.counts_Neighbours is not None: self.counts_Neighbours = list(self.counts_Neighbours)
+        if self.AffineMat is not None: self.AffineMat = np.float32(self.AffineMat)
+        for name in self.state_channels:
+            columns = {key[len(name+'_col_'):] : col for key, col in state.items() if key.startswith(name+'_col_')}
+            ch = Channel(state[name+'_pos'], state[name+'_frame'], state[name+'_group'], **columns) if name+'_pos' in state else None
+            setattr(self, name, ch)
+        self.SplinesModel, self.ControlPoints = (None, None)
+        if 'SplinesModel' in state: # the model (and TensorFlow) is only loaded when the splines are used
+            self.ControlPoints = np.float32(state['SplinesModel'])
+            self._SplinesControlPoints = self.ControlPoints
+        
+        self.transforms = []
+        for i, kind in enumerate(state['transforms']):
+            prefix = 'transform'+str(i)+'_'
+            if kind=='affine':
+                self.transforms.append(('affine', (state[prefix+'AffineMat'], state.get(prefix+'groups', None))))
+            elif kind=='splines':
+                gridsize, x1_min, x2_min, edge_grids = state[prefix+'grid']
+                self.transforms.append(('splines', (state[prefix+'ControlPoints'], gridsize, x1_min, x2_min, int(edge_grids))))
+            elif kind=='mapping':
+                arrays = {key[len(prefix):] : arr for key, arr in state.items() if key.startswith(prefix)}
+                self.transforms.append(('mapping', Mapping.from_arrays(arrays)))
+        self._stale = set() # the stored ch2 and neighbours are those of the stored history
+        self.img, self.imgsize, self.mid = self.imgparams()
         
         
     def ClusterDataset(self, loc_error=None, linked=None, FrameLinking=None, 
                        BatchOptimization=None, execute_linked=None):
-        # outputs a dataset of cluster center of masses
-        other=copy.deepcopy(self)        
+        # outputs a dataset of cluster center of masses, which are its originals as they are 
+        # calculated from the current (transformed) positions
+        other=self.view()
         other.loc_error=loc_error if loc_error is not None else None
         other.coloc_error=np.sqrt(2)*loc_error if loc_error is not None else None
         other.linked=linked if linked is not None else self.linked
@@ -67,108 +179,82 @@ class dataset(Registration):
         
         pos1=self.ch1.ClusterCOM()[0]
         pos2=self.ch2.ClusterCOM()[0]
-        del other.ch1, other.ch2, other.ch20linked, other.ch10, other.ch20
         other.ch1=Channel(pos1, np.ones(pos1.shape[0]))
         other.ch2=Channel(pos2, np.ones(pos2.shape[0]))
-        other.ch10=Channel(pos1, np.ones(pos1.shape[0]))
-        other.ch20=Channel(pos2, np.ones(pos2.shape[0]))
-        other.ch20linked=Channel(pos2, np.ones(pos2.shape[0]))
+        other.save_dataset()
         return other
         
         
     #%% load_dataset
-    def load_dataset_excel(self, transpose=False, mirror_xaxis=False, mirror_yaxis=False):
-        data = pd.read_csv(self.path)
-        grouped = data.groupby(data.Channel)
-        ch1 = grouped.get_group(1)
-        ch2 = grouped.get_group(2)
-        
-        data1 = np.array(ch1[['X(nm)','Y(nm)', 'Pos','Int (Apert.)']])
-        data1 = np.column_stack((data1, np.arange(data1.shape[0])))
-        data2 = np.array(ch2[['X(nm)','Y(nm)', 'Pos','Int (Apert.)']])
-        data2 = np.column_stack((data2, np.arange(data2.shape[0])))
+    def load_dataset_excel(self, transpose=False, mirror_xaxis=False, mirror_yaxis=False, channels=(1,2), 
+                           chunk_size=None):
+    # reads the csv via Loaders.read_locs_csv, which parses only the position, frame and intensity columns.
+    # channels gives the channel ids that become ch1 and ch2. Returns all channels in the file (which can 
+    # contain more than two channel ids) as a dict of Channels
+        columns={'x':'Y(nm)', 'y':'X(nm)'} if transpose else {'x':'X(nm)', 'y':'Y(nm)'}
+        data = read_locs_csv(self.path, {**columns, 'frame':'Pos', 'intensity':'Int (Apert.)'}, 
+                             pix_size=self.pix_size, chunk_size=chunk_size)
+        for ch in channels: 
+            if ch not in data: raise ValueError('Channel '+str(ch)+' is not in '+str(self.path))
+        self.load_channels(data[channels[0]], data[channels[1]], mirror_xaxis, mirror_yaxis,
+                           others=[cols for i, cols in data.items() if i not in channels[:2]])
+        return {i : Channel(**cols) for i, cols in data.items()}
     
-        self.ch1 = Channel(pos = data1[:,:2]* self.pix_size, frame = data1[:,2])
-        self.ch2 = Channel(pos = data2[:,:2]* self.pix_size, frame = data2[:,2])
-        self.ch10=copy.deepcopy(self.ch1)
-        self.ch20=copy.deepcopy(self.ch2)
-        self.ch20linked=copy.deepcopy(self.ch2)
-        if transpose:
-            self.ch1.transpose_axis()
-            self.ch2.transpose_axis()
-            self.ch10.transpose_axis()
-            self.ch20.transpose_axis()
-            self.ch20linked.transpose_axis()
-        if mirror_xaxis:
-            self.ch1.mirror_xaxis()
-            self.ch2.mirror_xaxis()
-            self.ch10.mirror_xaxis()
-            self.ch20.mirror_xaxis()
-            self.ch20linked.mirror_xaxis()
-        if mirror_yaxis:
-            self.ch1.mirror_yaxis()
-            self.ch2.mirror_yaxis()
-            self.ch10.mirror_yaxis()
-            self.ch20.mirror_yaxis()
-            self.ch20linked.mirror_yaxis()
-        
-        self.img, self.imgsize, self.mid = self.imgparams()      # loading the image parameters
-        self.center_image()
+    
+    def load_channels(self, cols1, cols2, mirror_xaxis=False, mirror_yaxis=False, others=[]):
+    # mirrors and centres the columns of both channels in place and creates the channels and their originals.
+    # The columns of the other channels in the file are mirrored and shifted along
+        for pos in [cols1['pos'], cols2['pos']]+[cols['pos'] for cols in others]:
+            if mirror_xaxis: pos[:,0] *= -1
+            if mirror_yaxis: pos[:,1] *= -1
+        
+        ## centring the image
+        pos1, pos2 = (cols1['pos'], cols2['pos'])
+        mid = (np.minimum(np.min(pos1, axis=0), np.min(pos2, axis=0)) + 
+               np.maximum(np.max(pos1, axis=0), np.max(pos2, axis=0)))/2
+        for pos in [pos1, pos2]+[cols['pos'] for cols in others]: pos -= mid.astype(pos.dtype)
+        
+        self.ch1 = Channel(**cols1)
+        self.ch2 = Channel(**cols2)
+        self.ch10=self.ch1.copy()
+        self.ch20=self.ch2.copy()
+        self.rows2=None
+        self.img, self.imgsize, self.mid = self.imgparams()                     # loading the image parameters
+        self.mid = np.zeros(2, dtype=np.float32)
     
     
-    def load_dataset_hdf5(self, align_rcc=True, transpose=False, mirror_xaxis=False, mirror_yaxis=False):
-        ## Loading dataset
-        if len(self.path)==1 or isinstance(self.path,str):
+    def load_dataset_hdf5(self, align_rcc=True, transpose=False, mirror_xaxis=False, mirror_yaxis=False,
+                          chunk_size=int(1e6), mmap_dir=None):
+    # reads the x, y, frame and group columns of the locs table(s) in chunks. If mmap_dir is given, the 
+    # positions are stored as memory-mapped files in that directory. The scaling, RCC shift, mirroring 
+    # and centring are applied in place, before the channels are created. photonpy is only used for the RCC
+        paths = [self.path] if isinstance(self.path, str) else self.path
+        print('Loading dataset...')
+        if len(paths)==1:
             # Dataset is grouped, meaning it has to be split manually
-            print('Loading dataset...')
-            print(self.path[0])
-            ds = Dataset.load(self.path[0],saveGroups=True)
-            print('\n Grouping...')
-            ch1 = ds[ds.group==0]
-            ch2 = ds[ds.group==1]
-        elif len(self.path)==2:
+            print(paths[0])
+            pos1, frame1, group1 = read_locs_hdf5(paths[0], self.pix_size, transpose, 0, chunk_size, mmap_dir)
+            pos2, frame2, group2 = read_locs_hdf5(paths[0], self.pix_size, transpose, 1, chunk_size, mmap_dir)
+        elif len(paths)==2:
             # Dataset consists over 2 files
-            print('Loading dataset...')
-            print(self.path[0])
-            print(self.path[1])
-            ch1 = Dataset.load(self.path[0])
-            ch2 = Dataset.load(self.path[1])
+            print(paths[0])
+            print(paths[1])
+            pos1, frame1, group1 = read_locs_hdf5(paths[0], self.pix_size, transpose, None, chunk_size, mmap_dir)
+            pos2, frame2, group2 = read_locs_hdf5(paths[1], self.pix_size, transpose, None, chunk_size, mmap_dir)
         else:
             raise TypeError('Path invalid')
-            
-        if transpose:
-            ch1.pos=ch1.pos[:,[1,0]]
-            ch2.pos=ch2.pos[:,[1,0]]
         
         if align_rcc:
             print('Alignning both datasets')
-            shift = Dataset.align(ch1, ch2)
+            shift = rcc_shift(pos1/self.pix_size, frame1, pos2/self.pix_size, frame2, self.imgshape)
             print('RCC shift equals', shift*self.pix_size)
             if not np.isnan(shift).any():
-                ch1.pos+= shift
+                pos1 += np.float32(shift*self.pix_size)
             else: 
                 print('Warning: Shift contains infinities')
         
-        self.ch1 = Channel(pos = ch1.pos* self.pix_size, frame = ch1.frame, group=ch1.group)
-        self.ch2 = Channel(pos = ch2.pos* self.pix_size, frame = ch2.frame, group=ch2.group)
-        self.ch10=copy.deepcopy(self.ch1)
-        self.ch20=copy.deepcopy(self.ch2)
-        self.ch20linked=copy.deepcopy(self.ch2)
-        if mirror_xaxis:
-            self.ch1.mirror_xaxis()
-            self.ch2.mirror_xaxis()
-            self.ch10.mirror_xaxis()
-            self.ch20.mirror_xaxis()
-            self.ch20linked.mirror_xaxis()
-        if mirror_yaxis:
-            self.ch1.mirror_yaxis()
-            self.ch2.mirror_yaxis()
-            self.ch10.mirror_yaxis()
-            self.ch20.mirror_yaxis()
-            self.ch20linked.mirror_yaxis()
-        
-        self.img, self.imgsize, self.mid = self.imgparams()                     # loading the image parameters
-        self.center_image()
+        self.load_channels({'pos' : pos1, 'frame' : frame1, 'group' : group1}, 
+                           {'pos' : pos2, 'frame' : frame2, 'group' : group2}, mirror_xaxis, mirror_yaxis)
         
 
     #%% functions    
@@ -179,55 +265,75 @@ class dataset(Registration):
         img1, _, _ = self.ch1.imgparams()
         img2, _, _ = self.ch2.imgparams()
         
-        img = tf.Variable([[ tf.reduce_min([img1[0,0], img2[0,0]]), tf.reduce_min([img1[0,1], img2[0,1]]) ],
-                           [ tf.reduce_max([img1[1,0], img2[1,0]]),  tf.reduce_max([img1[1,1], img2[1,1]]) ]], 
-                          dtype=tf.float32)
+        img = np.array([np.minimum(img1[0,:], img2[0,:]), np.maximum(img1[1,:], img2[1,:])], dtype=np.float32)
 
         return img, (img[1,:] - img[0,:]), (img[1,:] + img[0,:])/2
     
     
+    def offset_dataset(self, offset1, offset2=None):
+    # offsets channel 1 by offset1 and channel 2 by offset2 (defaults to offset1). The originals are offset
+    # once and ch2 follows from them, ch1 keeps sharing its array with ch10 if it did. As the mappings in the 
+    # history work in the previous coordinates, they are wrapped in translations by -offset2 and +offset2
+        if offset2 is None: offset2=offset1
+        pos10=self.ch10.pos + np.asarray(offset1, dtype=np.float32)
+        if self.ch1.pos.shape==pos10.shape and np.shares_memory(self.ch1.pos, self.ch10.pos): self.ch1.pos=pos10
+        else: self.ch1.pos=self.ch1.pos + np.asarray(offset1, dtype=np.float32)
+        self.ch10.pos=pos10
+        self.ch20.pos=self.ch20.pos + np.asarray(offset2, dtype=np.float32)
+        if len(self.transforms)>0:
+            shift=np.concatenate([np.eye(2), np.asarray(offset2, dtype=np.float64).reshape(2,1)], axis=1)
+            unshift=np.concatenate([np.eye(2), -shift[:,2:]], axis=1)
+            self.transforms=[('affine', (unshift, None))]+self.transforms+[('affine', (shift, None))]
+        self.invalidate_positions()
+        self.clear_neighbours()
+        
+        
     def center_image(self):
         self.img, self.imgsize, self.mid = self.imgparams() 
-        self.ch1.pos.assign(self.ch1.pos - self.mid[None,:])
-        self.ch2.pos.assign(self.ch2.pos - self.mid[None,:])
-        self.ch10.pos.assign(self.ch10.pos - self.mid[None,:])
-        self.ch20.pos.assign(self.ch20.pos - self.mid[None,:])
-        self.ch20linked.pos.assign(self.ch20linked.pos - self.mid[None,:])
+        self.offset_dataset(-self.mid)
         self.img, self.imgsize, self.mid = self.imgparams() 
-        self.mid = tf.Variable([0,0], dtype=tf.float32)
+        self.mid = np.zeros(2, dtype=np.float32)
         
         
     def zero_image(self, offsetx=0, offsety=None):
         if offsety is None: offsety=offsetx
-        x1_min = np.min([np.min(tf.reduce_min((self.ch1.pos[:,0]))),
-                                  np.min(tf.reduce_min((self.ch2.pos[:,0])))])
-        x2_min = np.min([np.min(tf.reduce_min((self.ch1.pos[:,1]))),
-                                  np.min(tf.reduce_min((self.ch2.pos[:,1])))]) 
-        self.ch1.offset([-x1_min+offsetx, -x2_min+offsety])
-        self.ch2.offset([-x1_min+offsetx, -x2_min+offsety])
-        self.ch10.offset([-x1_min+offsetx, -x2_min+offsety])
-        self.ch20.offset([-x1_min+offsetx, -x2_min+offsety])
-        self.ch20linked.offset([-x1_min+offsetx, -x2_min+offsety])
+        x1_min = min(np.min(self.ch1.pos[:,0]), np.min(self.ch2.pos[:,0]))
+        x2_min = min(np.min(self.ch1.pos[:,1]), np.min(self.ch2.pos[:,1]))
+        self.offset_dataset([-x1_min+offsetx, -x2_min+offsety])
         self.img, self.imgsize, self.mid = self.imgparams() 
         return np.array([-x1_min+offsetx, -x2_min+offsety])
         
     def center_channels(self):
-        self.ch1.center()
-        self.ch2.center()
-        self.ch10.center()
-        self.ch20.center()
-        self.ch20linked.center()
+    # centres both channels on the mean of their originals
+        self.offset_dataset(-np.mean(self.ch10.pos, axis=0), -np.mean(self.ch20.pos, axis=0))
         
         
     #%% Split dataset or load subset
     def AppendDataset(self, other):
-        self1=copy.deepcopy(self)
+    # appends the localizations and originals of other. ch2 stays derived from the appended originals, 
+    # so both datasets should share their transform history (as the outputs of gather or view do)
+        if len(self.transforms)!=len(other.transforms): raise Exception('Only datasets that share their transform history can be appended!')
+        transforms=[]
+        for t1, t2 in zip(self.transforms, other.transforms):
+            if t1 is t2: transforms.append(t1)
+            elif t1[0]=='affine' and t2[0]=='affine' and t1[1][0] is t2[1][0] and t1[1][1] is not None:
+                transforms.append(('affine', (t1[1][0], np.concatenate([t1[1][1], t2[1][1]]))))
+            else: raise Exception('Only datasets that share their transform history can be appended!')
+        
+        self1=self.view()
+        ch2=self1.ch2
+        ch2.AppendChannel(other.ch2)
         self1.ch1.AppendChannel(other.ch1)
-        if self1.ch10 is not None and other.ch10 is not None: self1.ch10.AppendChannel(other.ch10)
-        if self1.ch2 is not None and other.ch2 is not None: self1.ch2.AppendChannel(other.ch2)
-        if self1.ch20 is not None and other.ch20 is not None: self1.ch20.AppendChannel(other.ch20)
-        if self1.ch20linked is not None and other.ch20linked is not None:
-            self1.ch20linked.AppendChannel(other.ch20linked)
+        self1.ch10.AppendChannel(other.ch10)
+        N20=self1.ch20.pos.shape[0]
+        if self.rows2 is not None or other.rows2 is not None:
+            rows1=np.arange(N20) if self.rows2 is None else self.rows2
+            rows2=np.arange(other.ch20.pos.shape[0]) if other.rows2 is None else other.rows2
+            self1.rows2=np.concatenate([rows1, rows2+N20])
+        self1.ch20.AppendChannel(other.ch20)
+        self1.transforms=transforms
+        self1.ch2=ch2
+        self1.clear_neighbours()
         return self1
     
     
@@ -242,14 +348,14 @@ class dataset(Registration):
         elif window is None:
             raise Exception('No window or subset selected')
             
-        idx1=(np.where(self.ch1.pos.numpy()[:,0]>window[0,0],True,False)
-             *np.where(self.ch1.pos.numpy()[:,0]<window[0,1],True,False)
-             *np.where(self.ch1.pos.numpy()[:,1]>window[1,0],True,False)
-             *np.where(self.ch1.pos.numpy()[:,1]<window[1,1],True,False))
-        idx2=(np.where(self.ch2.pos.numpy()[:,0]>window[0,0],True,False)
-             *np.where(self.ch2.pos.numpy()[:,0]<window[0,1],True,False)
-             *np.where(self.ch2.pos.numpy()[:,1]>window[1,0],True,False)
-             *np.where(self.ch2.pos.numpy()[:,1]<window[1,1],True,False))
+        idx1=(np.where(self.ch1.pos[:,0]>window[0,0],True,False)
+             *np.where(self.ch1.pos[:,0]<window[0,1],True,False)
+             *np.where(self.ch1.pos[:,1]>window[1,0],True,False)
+             *np.where(self.ch1.pos[:,1]<window[1,1],True,False))
+        idx2=(np.where(self.ch2.pos[:,0]>window[0,0],True,False)
+             *np.where(self.ch2.pos[:,0]<window[0,1],True,False)
+             *np.where(self.ch2.pos[:,1]>window[1,0],True,False)
+             *np.where(self.ch2.pos[:,1]<window[1,1],True,False))
         
         if self.gridsize is not None:
             self.x1_min=window[0,0]/self.gridsize
@@ -301,43 +407,38 @@ class dataset(Registration):
         if not FrameLinking:
             if self.linked:
                 batches=np.random.randint(0,Nbatches,self.ch1.frame.shape[0])
-                self.ch1.frame.assign(batches)
-                self.ch2.frame.assign(batches)
-                self.ch20linked.frame.assign(batches)
+                self.ch1.frame = batches
+                self.ch2.frame = batches
             else:
                 batches1=np.random.randint(0,Nbatches,self.ch1.frame.shape[0])
                 batches2=np.random.randint(0,Nbatches,self.ch2.frame.shape[0])
-                self.ch1.frame.assign(batches1)
-                self.ch2.frame.assign(batches2)
-                self.ch20linked.frame.assign(batches2)
+                self.ch1.frame = batches1
+                self.ch2.frame = batches2
             if self.Neighbours:
                 batches=np.random.randint(0,Nbatches,self.ch1NN.frame.shape[0])
-                self.ch1NN.frame.assign(batches)
-                self.ch2NN.frame.assign(batches)
+                self.ch1NN.frame = batches
+                self.ch2NN.frame = batches
                 
         else: # keeps the positions that are in the same frame within the same frame
             frame1=np.zeros((self.ch1.frame).shape[0])
             frame2=np.zeros((self.ch2.frame).shape[0])
-            frame20=np.zeros((self.ch20linked.frame).shape[0])
             if self.Neighbours:
                 frameNN1=np.zeros((self.ch1NN.frame).shape[0])
                 frameNN2=np.zeros((self.ch2NN.frame).shape[0])
 
-            for frame in tf.unique(self.ch1.frame)[0]:
+            for frame in np.unique(self.ch1.frame):
                 batch=np.random.randint(0,Nbatches)                
                 frame1[np.argwhere(self.ch1.frame==frame)]=batch
                 frame2[np.argwhere(self.ch2.frame==frame)]=batch
-                frame20[np.argwhere(self.ch20linked.frame==frame)]=batch
                 if self.Neighbours:      
                     frameNN1[np.argwhere(self.ch1NN.frame==frame)]=batch
                     frameNN2[np.argwhere(self.ch2NN.frame==frame)]=batch
                     
-            self.ch1.frame.assign(tf.Variable(frame1,dtype=tf.float32,trainable=False))
-            self.ch2.frame.assign(tf.Variable(frame2,dtype=tf.float32,trainable=False))
-            self.ch20linked.frame.assign(tf.Variable(frame20,dtype=tf.float32,trainable=False))
+            self.ch1.frame = frame1
+            self.ch2.frame = frame2
             if self.Neighbours:
-                self.ch1NN.frame.assign(tf.Variable(frameNN1,dtype=tf.float32,trainable=False))
-                self.ch2NN.frame.assign(tf.Variable(frameNN2,dtype=tf.float32,trainable=False))
+                self.ch1NN.frame = frameNN1
+                self.ch2NN.frame = frameNN2
                     
         
     def SplitDataset(self, linked=None):
@@ -398,20 +499,17 @@ class dataset(Registration):
         
     
     def gather(self, idx1, idx2):
-    # gathers the indexes of both Channels
+    # gathers the indexes of both Channels. The originals of the new dataset are the original positions 
+    # of the gathered localizations, from which its ch2 is derived via the shared transform history
         if len(idx1)==0 or len(idx2)==0: raise ValueError('Cannot gather a zeros sized array')
-        other = copy.deepcopy(self)
-        del other.ch1, other.ch2, other.ch20linked
-        other.ch1 = Channel(pos=tf.gather_nd(self.ch1.pos,idx1), frame=tf.gather_nd(self.ch1.frame,idx1), 
-                            group=tf.gather_nd(self.ch1.group,idx1))
-        other.ch2 = Channel(pos=tf.gather_nd(self.ch2.pos,idx2), frame=tf.gather_nd(self.ch2.frame,idx2), 
-                            group=tf.gather_nd(self.ch2.group,idx2))
-        other.ch10 = Channel(pos=tf.gather_nd(self.ch10.pos,idx1), frame=tf.gather_nd(self.ch10.frame,idx1), 
-                            group=tf.gather_nd(self.ch10.group,idx1))
-        other.ch20 = Channel(pos=tf.gather_nd(self.ch20.pos,idx2), frame=tf.gather_nd(self.ch20.frame,idx2), 
-                            group=tf.gather_nd(self.ch20.group,idx2))
-        other.ch20linked = Channel(pos=tf.gather_nd(self.ch20linked.pos,idx2), frame=tf.gather_nd(self.ch20linked.frame,idx2), 
-                            group=tf.gather_nd(self.ch20linked.group,idx2))
+        other = self.view()
+        other.ch1 = self.ch1.take(idx1)
+        other.select_ch2(idx2)
+        other.ch10 = other.ch1.copy()
+        other.ch20 = other.ch20linked
+        other.rows2 = None
+        other.linked_original = self.linked
+        other.clear_neighbours()
         return other
     
     
@@ -425,146 +523,70 @@ class dataset(Registration):
             print('Linking Datasets for localizations within a distance of',maxDistance,'nm...')
             if self.linked: print('WARNING: Dataset already linked')
             if FrameLinking is None: FrameLinking=self.FrameLinking
-            ch1_frame=self.ch1.frame.numpy()
-            ch2_frame=self.ch2.frame.numpy()
-            ch20_frame=self.ch20linked.frame.numpy()
-            ch1_pos=self.ch1.pos.numpy()
-            ch2_pos=self.ch2.pos.numpy()
-            ch20_pos=self.ch20linked.pos.numpy()
-            ch1_group=self.ch1.group.numpy()
-            ch2_group=self.ch2.group.numpy()
-            ch20_group=self.ch20linked.group.numpy()
+            ch1_frame=self.ch1.frame
+            ch2_frame=self.ch2.frame
+            ch1_pos=self.ch1.pos
+            ch2_pos=self.ch2.pos
             
-            (pos1, frame1, pos2, frame2, pos20, frame20, group1, group2, group20) = ([],[],[],[],[],[],[],[],[])
-            if FrameLinking: ## Linking per frame
-                frame,_=tf.unique(self.ch1.frame)
-                self.counts_linked=[]
-                for fr in frame:
-                    # Generate neighbouring indices per frame
-                    framepos1=ch1_pos[ch1_frame==fr,:]
-                    framepos2=ch2_pos[ch2_frame==fr,:]
-                    framepos20=ch20_pos[ch20_frame==fr,:]
-                    framegroup1=ch1_group[ch1_frame==fr]
-                    framegroup2=ch2_group[ch2_frame==fr]
-                    framegroup20=ch20_group[ch20_frame==fr]
-                    
-                    with Context() as ctx: # loading all NN
-                        counts,indices = PostProcessMethods(ctx).FindNeighbors(framepos1, framepos2, maxDistance)
+            if FrameLinking: ## Linking all frames in a single pass
+                # sorting ch1 by frame keeps the pairs of every frame together
+                order1=np.argsort(ch1_frame, kind='stable')
+                key1,key2=frame_keys(ch1_pos[order1,:], ch1_frame[order1], ch2_pos, ch2_frame, maxDistance)
+                i1,idx2=get_backend(self.NN_backend).nearest(key1, key2, maxDistance)
+                idx1=order1[i1]
                 
-                    ## putting all idx in a list 
-                    (idxlist, pos, i) = ([], 0,0)
-                    for count in counts:
-                        idxlist.append( np.stack([
-                            i * np.ones([count], dtype=int),
-                            indices[pos:pos+count] 
-                            ]) )
-                        pos+=count
-                        i+=1
-                    
-                    for idx in idxlist:
-                        if len(idx[0])!=0:
-                            posA=framepos1[idx[0][0],:]
-                            posB=framepos2[idx[1],:]
-                            posB0=framepos20[idx[1],:]
-                            ii=np.argmin( np.sum((posA-posB)**2) )
-                            
-                            frame1.append(fr)
-                            frame2.append(fr)
-                            frame20.append(fr)
-                            pos1.append(posA)
-                            pos2.append(posB[ ii ,:])
-                            pos20.append(posB0[ ii ,:])
-                            group1.append(framegroup1[idx[0][0]])
-                            group2.append(framegroup2[idx[1]][ii])
-                            group20.append(framegroup20[idx[1]][ii])
-                            
-                self.counts_linked.append(tf.reduce_sum(counts))
+                # the number of pairs per frame via the frame boundaries
+                linked_frame=ch1_frame[idx1]
+                bounds=np.searchsorted(linked_frame, np.unique(linked_frame))
+                self.counts_linked=list(np.diff(np.append(bounds, linked_frame.shape[0])))
                 
             else: ## taking the whole dataset as a single batch
-                with Context() as ctx: # loading all NN
-                    counts,indices = PostProcessMethods(ctx).FindNeighbors(ch1_pos, ch2_pos, maxDistance)
+                idx1,idx2=get_backend(self.NN_backend).nearest(ch1_pos, ch2_pos, maxDistance)
             
-                ## putting all NNidx in a list 
-                (idxlist, pos, i) = ([], 0,0)
-                for count in counts:
-                    idxlist.append( np.stack([
-                        i * np.ones([count], dtype=int),
-                        indices[pos:pos+count] 
-                        ]) )
-                    pos+=count
-                    i+=1
-                
-                for idx in idxlist:
-                    if len(idx[0])!=0:
-                        i=idx[0][0]
-                        posB=ch2_pos[idx[1],:]
-                        posB0=ch20_pos[idx[1],:]
-                        j=np.argmin( np.sum((ch1_pos[i,:]-posB)**2) )
-                        
-                        frame1.append(ch1_frame[i])
-                        frame2.append(ch2_frame[idx[1][j]])
-                        frame20.append(ch20_frame[idx[1][j]])
-                        pos1.append(ch1_pos[i,:])
-                        pos2.append(posB[j,:])
-                        pos20.append(posB0[j,:])
-                        group1.append(ch1_group[i])
-                        group2.append(ch2_group[idx[1][j]])
-                        group20.append(ch20_group[idx[1][j]])
-            
-            if len(pos1)==0 or len(pos2)==0: raise ValueError('When Coupling Datasets, one or both of the Channels returns empty')
+            if len(idx1)==0 or len(idx2)==0: raise ValueError('When Coupling Datasets, one or both of the Channels returns empty')
             
-            del self.ch1, self.ch2, self.ch20linked
-            self.ch1 = Channel( np.array(pos1) , np.array(frame1), np.array(group1) )
-            self.ch2 = Channel( np.array(pos2) , np.array(frame2), np.array(group2) )
-            self.ch20linked = Channel( np.array(pos20) , np.array(frame20), np.array(group20) )
+            self.ch1 = self.ch1.take(idx1)
+            self.select_ch2(idx2)
             self.linked = True       
         
         
     def link_clusters(self, clusterpos1, clusterlist1, clusterpos2, clusterlist2, maxDistance=5000):
-        with Context() as ctx: # loading all NN
-            counts,indices = PostProcessMethods(ctx).FindNeighbors(clusterpos1, clusterpos2, maxDistance)
-            
-        pos,i=(0,0)
-        clust1,clust2=([],[])
-        for count in counts:
-            if count!=0:
-                pos1=tf.gather(clusterpos1, i * np.ones([count], dtype=int))
-                pos2=tf.gather(clusterpos2, indices[pos:pos+count])
-                lst1=tf.gather(clusterlist1, i * np.ones([count], dtype=int))
-                lst2=tf.gather(clusterlist2, indices[pos:pos+count])
-                indx=np.argmin( tf.reduce_sum(tf.pow(pos1-pos2,2), axis=1) )
-                clust1.append(tf.gather(lst1,indx))
-                clust2.append(tf.gather(lst2,indx))
-            pos+=count
-            i+=1
-        return tf.stack(clust1), tf.stack(clust2)
+        idx1,idx2=get_backend(self.NN_backend).nearest(clusterpos1, clusterpos2, maxDistance)
+        return np.asarray(clusterlist1)[idx1], np.asarray(clusterlist2)[idx2]
         
         
     #%% Generate 
     def kNearestNeighbour(self, pos1=None, pos2=None, k=8, maxDistance=2000):
+    # generates the k nearest neighbours (k<1 for all) within maxDistance via a single query. They are 
+    # stored as padded Nxkx2 arrays NN_pos1 and NN_pos2 with the Nxk NN_mask of the valid entries, 
+    # padded entries of NN_pos2 equal NN_pos1. ch1NN and ch2NN contain the valid pairs only. 
+    # If pos2 is ch2, the neighbours are stored as rows of ch2 and follow its transforms
         print('Generating',k,'nearest neighbours within ', maxDistance,'nm')
-        if pos1 is None: pos1=self.ch1.pos.numpy()
-        if pos2 is None: pos2=self.ch2.pos.numpy()
-        with Context() as ctx: # loading all NN
-            counts,indices = PostProcessMethods(ctx).FindNeighbors(pos1, pos2, maxDistance)
-    
-        pos,i=(0,0)
-        pos1NN,pos2NN=([],[])
-        for count in counts:
-            if count!=0:
-                pos1sbs=tf.gather(pos1, i * np.ones([count], dtype=int))
-                pos2sbs=tf.gather(pos2, indices[pos:pos+count])
-                indx=np.argsort( tf.reduce_sum(tf.pow(pos1sbs-pos2sbs,2), axis=1) )[:k]
-                pos1NN.append(tf.gather(pos1sbs,indx))
-                pos2NN.append(tf.gather(pos2sbs,indx))
-            pos+=count
-            i+=1
-        self.ch1NN=Channel(tf.reshape(tf.concat(pos1NN,axis=0), [-1,2]))
-        self.ch2NN=Channel(tf.reshape(tf.concat(pos2NN,axis=0), [-1,2]))
+        if pos1 is None: pos1=self.ch1.pos
+        derived=pos2 is None
+        if pos2 is None: pos2=self.ch2.pos
+        pos1=np.asarray(pos1, dtype=np.float32)
+        pos2=np.asarray(pos2, dtype=np.float32)
+        idx,mask=get_backend(self.NN_backend).kNearest(pos1, pos2, k, maxDistance)
+        
+        self.NN_idx=idx if derived else None
+        self._stale.discard('NN')
+        self.NN_pos1=np.repeat(pos1[:,None,:], idx.shape[1], axis=1)
+        self.NN_pos2=np.where(mask[:,:,None], pos2[idx,:], self.NN_pos1)
+        self.NN_mask=mask
+        self.NN_maxDistance=maxDistance
+        self.ch1NN=Channel(self.NN_pos1[mask])
+        self.ch2NN=Channel(self.NN_pos2[mask])
         self.Neighbours=True
         return self.ch1NN, self.ch2NN
     
     
+    def clear_neighbours(self):
+        self.ch1NN, self.ch2NN = (None, None)
+        self.NN_pos1, self.NN_pos2, self.NN_mask, self.NN_idx = (None, None, None, None)
+        self.Neighbours=False
+    
+    
     def random_choice(self,original_length, final_length):
         if original_length<final_length: raise ValueError('Invalid Input')
         lst=[]
@@ -588,21 +610,8 @@ class dataset(Registration):
             if not self.linked: raise Exception('Dataset should be linked before filtering pairs!')
             N0=self.ch1.pos.shape[0]
             
-            dists = np.sqrt(np.sum( (self.ch1.pos.numpy() - self.ch2.pos.numpy())**2 , axis=1))
-            idx = np.argwhere(dists<maxDistance)
-            
-            ch1_pos = self.ch1.pos.numpy()[idx[:,0],:]
-            ch2_pos = self.ch2.pos.numpy()[idx[:,0],:]
-            ch20_pos = self.ch20linked.pos.numpy()[idx[:,0],:]
-            ch1_frame = self.ch1.frame.numpy()[idx[:,0]]
-            ch2_frame = self.ch2.frame.numpy()[idx[:,0]]
-            ch20_frame = self.ch20linked.frame.numpy()[idx[:,0]]
-            
-            if ch1_pos.shape[0]==0: raise Exception('All positions will be filtered out in current settings!')
-            del self.ch1, self.ch2
-            self.ch1 = Channel(ch1_pos, ch1_frame)
-            self.ch2 = Channel(ch2_pos, ch2_frame)
-            self.ch20linked = Channel(ch20_pos, ch20_frame)
+            dists = np.sqrt(np.sum( (self.ch1.pos - self.ch2.pos)**2 , axis=1))
+            self.Select_Pairs(dists<maxDistance)
             N1=self.ch1.pos.shape[0]
             print('Out of the '+str(N0)+' pairs localizations, '+str(N0-N1)+' have been filtered out ('+str(round((1-(N1/N0))*100,1))+'%)')
         else:
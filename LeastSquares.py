@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+The linear least squares solvers used for the closed form fitting of the mappings
+"""
+import numpy as np
+
+
+def lstsq(X, Y, weights=None, method='svd'):
+    '''
+    Solves X @ C = Y in the (weighted) least squares sense in float64. The columns of X are scaled
+    to unit norm before solving, which keeps the problem well conditioned for monomials of positions in nm.
+
+    Parameters
+    ----------
+    X : NxM np.array
+        The design matrix
+    Y : NxD np.array
+        The targets
+    weights : N np.array, optional
+        The weight of every row, for example the inverse localization variance
+    method : 'svd', 'qr' or 'normal'
+        Solve via the SVD (np.linalg.lstsq), a QR decomposition or the normal equations. The normal
+        equations are fastest but square the condition number
+
+    Returns
+    ----------
+    C : MxD np.array
+        The coefficients
+    '''
+    X=np.asarray(X, dtype=np.float64)
+    Y=np.asarray(Y, dtype=np.float64)
+    if weights is not None:
+        sqrtw=np.sqrt(np.asarray(weights, dtype=np.float64))
+        X=X*sqrtw[:,None]
+        Y=Y*sqrtw.reshape((-1,)+(1,)*(Y.ndim-1))
+    norm=np.linalg.norm(X, axis=0)
+    norm[norm==0]=1
+    X=X/norm
+
+    if method=='svd':
+        C=np.linalg.lstsq(X, Y, rcond=None)[0]
+    elif method=='qr':
+        Q,R=np.linalg.qr(X)
+        C=np.linalg.solve(R, Q.T@Y)
+    elif method=='normal':
+        C=np.linalg.solve(X.T@X, X.T@Y)
+    else: raise ValueError('Invalid method '+str(method)+', choose svd, qr or normal')
+    return C/norm.reshape((-1,)+(1,)*(C.ndim-1))
+
+
+def robust_weights(r, loss='huber', c=None):
+    '''
+    The IRLS weights of the residual norms r, which are first scaled by a robust estimate of the
+    standard deviation per dimension (the median of r/sqrt(2ln2) for 2D Gaussian errors).
+    loss='huber' downweights residuals above c (default 1.345) times the standard deviation,
+    loss='tukey' sets the weights of residuals above c (default 4.685) to zero
+    '''
+    sigma=np.median(r)/np.sqrt(2*np.log(2))
+    if sigma==0: sigma=np.finfo(np.float64).eps
+    u=r/sigma
+    if loss=='huber':
+        if c is None: c=1.345
+        return np.where(u<=c, 1., c/np.maximum(u, c))
+    elif loss=='tukey':
+        if c is None: c=4.685
+        return np.where(u<c, (1-(u/c)**2)**2, 0.)
+    else: raise ValueError('Invalid loss '+str(loss)+', choose huber or tukey')
+
+
+def robust_lstsq(X, Y, weights=None, method='svd', loss='huber', c=None, max_iter=50, tol=1e-6, C0=None):
+    '''
+    Solves X @ C = Y via iteratively reweighted least squares, starting from C0 or else from the 
+    ordinary least squares solution.
+
+    Returns
+    ----------
+    C : MxD np.array
+        The coefficients
+    w : N np.array
+        The final robust weights, which are zero for the rejected rows when loss='tukey'
+    '''
+    Y=np.asarray(Y, dtype=np.float64)
+    w0=np.ones(Y.shape[0]) if weights is None else np.asarray(weights, dtype=np.float64)
+    C=lstsq(X, Y, w0, method) if C0 is None else np.asarray(C0, dtype=np.float64)
+    for i in range(max_iter):
+        r=np.linalg.norm((Y-X@C).reshape(Y.shape[0],-1), axis=1)
+        w=robust_weights(r, loss, c)
+        C_new=lstsq(X, Y, w0*w, method)
+        converged=np.max(np.abs(C_new-C))<=tol*np.max(np.abs(C_new))
+        C=C_new
+        if converged: break
+    return C, w
+
+
+def affine_lstsq(pts, target, weights=None, groups=None, method='svd'):
+    '''
+    Fits the affine mapping target = A[:,:2] @ pts + A[:,2] in float64. The positions are centred
+    on their (weighted) mean and scaled by their spread before solving, so the result does not
+    depend on where the field of view lies.
+
+    Parameters
+    ----------
+    pts, target : Nx2 np.array
+        The linked pairs, pts is mapped onto target
+    weights : N np.array, optional
+        The weight of every pair, for example the inverse localization variance
+    groups : N int np.array, optional
+        Solves an independent affine for every group (tile, FOV, channel) in a single batched
+        call, the groups should be labeled 0 to G-1. Every group needs at least 3 pairs
+    method : 'svd', 'qr' or 'normal'
+        The solver of the single affine, see lstsq. The batched solve always uses the pseudo-inverse
+        of the centred 2x2 normal equations per group
+
+    Returns
+    ----------
+    A : 2x3 np.array, or Gx2x3 when groups are given
+        The affine matrices
+    '''
+    pts = np.reshape(np.asarray(pts, dtype=np.float64), [-1,2])
+    target = np.reshape(np.asarray(target, dtype=np.float64), [-1,2])
+    w = np.ones(pts.shape[0]) if weights is None else np.asarray(weights, dtype=np.float64)
+
+    if groups is None:
+        mu_x = np.average(pts, axis=0, weights=w)
+        mu_y = np.average(target, axis=0, weights=w)
+        scale = np.std(pts-mu_x)
+        if scale==0: scale=1
+        L = lstsq((pts-mu_x)/scale, target-mu_y, w, method).T/scale
+        return np.concatenate([L, (mu_y-L@mu_x)[:,None]], axis=1)
+
+    # batched, via the weighted moments of every group
+    groups = np.asarray(groups, dtype=np.int64)
+    G = groups.max()+1
+    counts = np.bincount(groups[w>0], minlength=G)
+    underdetermined = np.flatnonzero((counts>0) & (counts<3))
+    if underdetermined.size>0: raise ValueError('The groups '+str(underdetermined.tolist())+' contain fewer than 3 pairs, '+
+                                                'which do not determine an affine')
+    wsum = np.bincount(groups, w, G)
+    wsum[wsum==0] = 1
+    mu_x = np.stack([np.bincount(groups, w*pts[:,i], G) for i in range(2)], axis=1)/wsum[:,None]
+    mu_y = np.stack([np.bincount(groups, w*target[:,i], G) for i in range(2)], axis=1)/wsum[:,None]
+    dx = pts-mu_x[groups]
+    dy = target-mu_y[groups]
+    Sxx = np.stack([np.bincount(groups, w*dx[:,i]*dx[:,j], G) for i in range(2) for j in range(2)], axis=1)
+    Syx = np.stack([np.bincount(groups, w*dy[:,i]*dx[:,j], G) for i in range(2) for j in range(2)], axis=1)
+    L = np.reshape(Syx, [G,2,2]) @ np.linalg.pinv(np.reshape(Sxx, [G,2,2]), rcond=1e-12)
+    return np.concatenate([L, (mu_y-(L@mu_x[:,:,None])[:,:,0])[:,:,None]], axis=2)
+
+
+def robust_affine(pts, target, weights=None, loss='tukey', c=None, ransac=True, n_trials=500, 
+                  n_sample=10000, seed=None):
+    '''
+    Fits the affine mapping target = A[:,:2] @ pts + A[:,2] robustly, without a distance threshold.
+    If ransac, n_trials minimal sets of 3 pairs are solved at once and the hypothesis with the least
+    median residual on a random subset of n_sample pairs (LMedS) is used as starting point, which
+    handles up to half of the pairs being mislinked. This start is refined via IRLS on all pairs.
+
+    Returns
+    ----------
+    A : 2x3 np.array
+        The affine matrix
+    w : N np.array
+        The final robust weights, with loss='tukey' the outliers have weight zero
+    '''
+    pts = np.reshape(np.asarray(pts, dtype=np.float64), [-1,2])
+    target = np.reshape(np.asarray(target, dtype=np.float64), [-1,2])
+    N = pts.shape[0]
+    mu = np.mean(pts, axis=0)
+    scale = np.std(pts-mu)
+    if scale==0: scale=1
+    X = np.concatenate([(pts-mu)/scale, np.ones([N,1])], axis=1)
+
+    C0 = None
+    if ransac and N>3:
+        rng = np.random.default_rng(seed)
+        sets = rng.integers(0, N, [n_trials, 3])                # degenerate sets are discarded below
+        Xs, Ys = X[sets], target[sets]                          # n_trials x 3 x 3, n_trials x 3 x 2
+        valid = np.abs(np.linalg.det(Xs))>1e-9
+        C = np.linalg.solve(Xs[valid], Ys[valid])               # n_trials x 3 x 2
+        sub = rng.choice(N, min(N, n_sample), replace=False)
+        r = np.linalg.norm(X[sub][None] @ C - target[sub][None], axis=2)
+        if C.shape[0]>0: C0 = C[np.argmin(np.median(r, axis=1))]
+
+    C, w = robust_lstsq(X, target, weights, 'svd', loss, c, C0=C0)
+    L = C[:2].T/scale
+    return np.concatenate([L, (C[2]-L@mu)[:,None]], axis=1), w
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+The loaders of localization files, which read only the needed columns in chunks
+"""
+import os
+import importlib.util
+import numpy as np
+
+
+#%% HDF5
+def read_locs_hdf5(path, pix_size=1, transpose=False, channel=None, chunk_size=int(1e6), mmap_dir=None):
+    '''
+    Reads the x, y, frame and group columns of a Picasso-style locs table. The table is read in
+    chunks of chunk_size rows and only the selected columns are read, such that the memory needed
+    is that of the output arrays (16 bytes per localization) plus a single chunk.
+
+    Parameters
+    ----------
+    path : str
+        The hdf5 file containing the 'locs' table
+    pix_size : float
+        The positions are multiplied by pix_size while reading
+    transpose : bool
+        Swap the x and y columns
+    channel : int, optional
+        Only read the localizations whose group equals channel, for files that contain both channels
+    chunk_size : int
+        The number of rows that are read at once
+    mmap_dir : str, optional
+        If given, the output arrays are memory-mapped .npy files in this directory instead of arrays in RAM
+
+    Returns
+    ----------
+    pos : Nx2 float32, frame : N float32, group : N int32
+        Writable arrays (or memory maps), such that they can be transformed in place
+    '''
+    import h5py
+    with h5py.File(path, 'r') as f:
+        locs = f['locs']
+        names = locs.dtype.names
+        N = locs.shape[0]
+        has_group = 'group' in names
+
+        ## select the rows of the channel via the group column
+        if channel is not None:
+            if not has_group: raise ValueError('The locs table of '+path+' does not contain groups')
+            select = np.concatenate([locs.fields('group')[i:i+chunk_size]==channel for i in range(0, N, chunk_size)])
+            Nout = int(np.sum(select))
+        else: select, Nout = (None, N)
+
+        name = os.path.splitext(os.path.basename(path))[0] + ('' if channel is None else '_ch'+str(channel))
+        pos = allocate(mmap_dir, name+'_pos', (Nout,2), np.float32)
+        frame = allocate(mmap_dir, name+'_frame', (Nout,), np.float32)
+        group = allocate(mmap_dir, name+'_group', (Nout,), np.int32)
+
+        columns = ['y','x'] if transpose else ['x','y']
+        j = 0
+        for i in range(0, N, chunk_size):
+            chunk = locs.fields(columns+['frame']+(['group'] if has_group else []))[i:i+chunk_size]
+            if select is not None: chunk = chunk[select[i:i+chunk_size]]
+            n = chunk.shape[0]
+            pos[j:j+n,0] = chunk[columns[0]]
+            pos[j:j+n,1] = chunk[columns[1]]
+            pos[j:j+n] *= pix_size
+            frame[j:j+n] = chunk['frame']
+            group[j:j+n] = chunk['group'] if has_group else 0
+            j += n
+    return pos, frame, group
+
+
+def allocate(mmap_dir, name, shape, dtype):
+# an empty array, or the memory-mapped file mmap_dir/name.npy
+    if mmap_dir is None: return np.empty(shape, dtype=dtype)
+    os.makedirs(mmap_dir, exist_ok=True)
+    return np.lib.format.open_memmap(os.path.join(mmap_dir, name+'.npy'), mode='w+', dtype=dtype, shape=shape)
+
+
+#%% CSV
+def read_locs_csv(path, columns={'x':'X(nm)', 'y':'Y(nm)', 'frame':'Pos', 'intensity':'Int (Apert.)'},
+                  channel_column='Channel', pix_size=1, chunk_size=None):
+    '''
+    Reads the given columns of a (Niekamp-style) localization csv as float32 and splits them per
+    channel id. Only the needed columns are parsed, via the pyarrow engine when available. If
+    chunk_size is given the file is read in chunks of chunk_size rows instead, which keeps the
+    parsing overhead bounded for multi-GB files.
+
+    Parameters
+    ----------
+    path : str
+        The csv file
+    columns : dict
+        The names of the output columns and the csv columns they are read from. x and y are required
+    channel_column : str
+        The csv column containing the channel id of every localization
+    pix_size : float
+        The positions are multiplied by pix_size
+
+    Returns
+    ----------
+    channels : dict
+        Per channel id a dict with the Nx2 float32 pos and the other columns as N float32 arrays.
+        The arrays of a channel are slices of a single array sorted by channel, so they are writable
+        and can be transformed in place
+    '''
+    import pandas as pd
+    usecols = list(columns.values())+[channel_column]
+    dtype = {**{col : np.float32 for col in columns.values()}, channel_column : np.int32}
+    if chunk_size is None:
+        engine = 'pyarrow' if importlib.util.find_spec('pyarrow') is not None else 'c'
+        data = pd.read_csv(path, usecols=usecols, dtype=dtype, engine=engine)
+        ids = data[channel_column].to_numpy()
+        values = data[list(columns.values())].to_numpy(dtype=np.float32)
+    else:
+        ids, values = ([], [])
+        for chunk in pd.read_csv(path, usecols=usecols, dtype=dtype, chunksize=chunk_size):
+            ids.append(chunk[channel_column].to_numpy())
+            values.append(chunk[list(columns.values())].to_numpy(dtype=np.float32))
+        ids, values = (np.concatenate(ids), np.concatenate(values))
+    
+    ## split the channels via a single sort
+    order = np.argsort(ids, kind='stable')
+    ids, values = (ids[order], values[order])
+    unique, starts = np.unique(ids, return_index=True)
+    ends = np.append(starts[1:], ids.shape[0])
+    keys = list(columns.keys())
+    ix, iy = (keys.index('x'), keys.index('y'))
+    
+    channels = {}
+    for i, start, end in zip(unique, starts, ends):
+        pos = np.stack([values[start:end,ix], values[start:end,iy]], axis=1)*np.float32(pix_size)
+        channels[int(i)] = {'pos' : pos, **{key : values[start:end,j] for j, key in enumerate(keys) if key not in ['x','y']}}
+    return channels
+
+
+#%% RCC
+def rcc_shift(pos1, frame1, pos2, frame2, imgshape):
+# the shift between two channels via redundant cross-correlation of photonpy, in the units of the positions
+    from photonpy import Dataset
+    ds1 = Dataset(pos1.shape[0], 2, imgshape)
+    ds1.pos, ds1.frame = (pos1, frame1)
+    ds2 = Dataset(pos2.shape[0], 2, imgshape)
+    ds2.pos, ds2.frame = (pos2, frame2)
+    return Dataset.align(ds1, ds2)
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+The trained registration mapping in NumPy, which can be saved, loaded and applied without TensorFlow
+"""
+import importlib.util
+import numpy as np
+
+from CatmullRomBasis import spline_basis, spline_weights
+
+FORMAT = 'channel-registration-mapping'
+VERSION = 1
+
+
+#%% Mapping class
+class Mapping:
+    '''
+    The affine transform followed by the Catmull-Rom splines, as trained by Registration. A mapping is
+    calibrated once (for example on beads) and stored via save, after which it can be loaded and applied
+    to the positions of other acquisitions in plain NumPy.
+
+    Parameters
+    ----------
+    AffineMat : 2x3 np.array, optional
+        The affine transform, applied first
+    ControlPoints : YxXx2 np.array, optional
+        The ControlPoints of the splines, applied after the affine
+    gridsize : float
+        The size of the spline grid in nm
+    edge_grids : int
+        The number of grids outside the borders
+    bounds : tuple
+        (x1_min, x2_min, x1_max, x2_max), the borders of the grid in units of the gridsize
+
+    Example
+    ----------
+    DS1.save_mapping('beads_mapping.npz')
+    ...
+    mapping = Mapping.load('beads_mapping.npz')
+    pos2 = mapping.apply(pos2)
+    '''
+    def __init__(self, AffineMat=None, ControlPoints=None, gridsize=None, edge_grids=None, bounds=None):
+        self.AffineMat = None if AffineMat is None else np.asarray(AffineMat, dtype=np.float64)
+        self.ControlPoints = None if ControlPoints is None else np.asarray(ControlPoints, dtype=np.float64)
+        self.gridsize = gridsize
+        self.edge_grids = edge_grids
+        self.bounds = None if bounds is None else tuple(float(b) for b in bounds)
+
+        if self.AffineMat is not None and self.AffineMat.shape!=(2,3):
+            raise ValueError('Only a single 2x3 AffineMat can be stored, got shape '+str(self.AffineMat.shape))
+        if self.ControlPoints is not None and (gridsize is None or edge_grids is None or bounds is None):
+            raise ValueError('The gridsize, edge_grids and bounds of the ControlPoints should be given')
+
+
+    @classmethod
+    def from_registration(cls, reg):
+    # the mapping of the transform history of reg (a dataset). Consecutive affines are composed like in
+    # transform_positions and can be followed by a single splines transform. Histories that the format 
+    # cannot hold (generic models, batched affines or transforms after the splines) raise a ValueError
+        steps = []
+        for kind, params in reg.transforms:
+            if kind=='model': raise ValueError('The transform history contains a model, which cannot be stored as a Mapping')
+            elif kind=='affine' and np.ndim(params[0])!=2: 
+                raise ValueError('The transform history contains batched affines, which cannot be stored as a Mapping')
+            elif kind=='affine': steps.append(('affine', params[0]))
+            elif kind=='splines': steps.append(('splines', params))
+            elif kind=='mapping':
+                if params.AffineMat is not None: steps.append(('affine', params.AffineMat))
+                if params.ControlPoints is not None: steps.append(('splines', (params.ControlPoints, params.gridsize, 
+                                                                               *params.bounds[:2], params.edge_grids)))
+            else: raise ValueError('Invalid transform '+str(kind))
+        
+        AffineMat, splines = (None, None)
+        for kind, params in steps:
+            if splines is not None: raise ValueError('Only affines followed by a single splines transform can be stored as a Mapping')
+            if kind=='affine': AffineMat = compose_affines(AffineMat, params)
+            else: splines = params
+        if splines is None: return cls(AffineMat)
+        
+        ControlPoints, gridsize, x1_min, x2_min, edge_grids = splines
+        ny, nx = np.shape(ControlPoints)[:2] # the grid spans x1_min-1-edge_grids up to x1_max+2+edge_grids
+        bounds = (x1_min, x2_min, x1_min+nx-3-2*edge_grids, x2_min+ny-3-2*edge_grids)
+        return cls(AffineMat, ControlPoints, gridsize, edge_grids, bounds)
+
+
+    #%% saving and loading
+    def arrays(self):
+    # the arrays that describe the mapping, as stored by save and by the dataset cache
+        arrays = {}
+        if self.AffineMat is not None: arrays['AffineMat'] = self.AffineMat
+        if self.ControlPoints is not None:
+            arrays.update({'ControlPoints' : self.ControlPoints, 'gridsize' : np.array(self.gridsize, dtype=np.float64),
+                           'edge_grids' : np.array(self.edge_grids), 'bounds' : np.array(self.bounds)})
+        return arrays
+    
+    
+    @classmethod
+    def from_arrays(cls, arrays):
+        AffineMat = arrays['AffineMat'] if 'AffineMat' in arrays else None
+        if 'ControlPoints' not in arrays: return cls(AffineMat)
+        return cls(AffineMat, arrays['ControlPoints'], float(arrays['gridsize']), int(arrays['edge_grids']), arrays['bounds'])
+    
+    
+    def save(self, path):
+    # stores the mapping as an uncompressed .npz, only containing arrays, together with its format version
+        np.savez(path, format=np.array(FORMAT), version=np.array(VERSION), **self.arrays())
+
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as f:
+            if 'format' not in f.files or str(f['format'])!=FORMAT: raise ValueError(str(path)+' does not contain a mapping')
+            version = int(f['version'])
+            if version>VERSION: raise ValueError(str(path)+' has mapping version '+str(version)+
+                                                 ', which is newer than the supported version '+str(VERSION))
+            return cls.from_arrays({name : f[name] for name in f.files})
+
+
+    #%% applying
+    def apply(self, pos, chunk_size=int(1e6), backend=None):
+    # maps the Nx2 positions in nm, see apply_mapping
+        origin = None
+        if self.ControlPoints is not None:
+            origin = (self.bounds[0]-1-self.edge_grids, self.bounds[1]-1-self.edge_grids)
+        return apply_mapping(pos, self.AffineMat, self.ControlPoints, self.gridsize, origin, chunk_size, backend)
+
+
+#%% apply engine
+def compose_affines(A, B):
+# the 2x3 affine that applies A followed by B, A=None is the identity
+    A, B = (None if A is None else np.asarray(A, dtype=np.float64), np.asarray(B, dtype=np.float64))
+    if A is None: return B
+    return np.concatenate([B[:,:2]@A[:,:2], (B[:,:2]@A[:,2]+B[:,2])[:,None]], axis=1)
+
+
+def apply_mapping(pos, AffineMat=None, ControlPoints=None, gridsize=None, origin=None, chunk_size=int(1e6), backend=None):
+    '''
+    Maps the positions through the affine followed by the splines in a single pass over the positions,
+    without TensorFlow. The numpy backend works in chunks of chunk_size positions to bound the memory 
+    of the stencils, the numba backend evaluates every position in a parallel compiled loop.
+
+    Parameters
+    ----------
+    pos : Nx2 np.array
+        The positions in nm
+    AffineMat : 2x3 np.array, optional
+        The affine, applied first
+    ControlPoints : YxXx2 np.array, optional
+        The ControlPoints of the splines
+    gridsize : float
+        The size of the spline grid in nm
+    origin : tuple
+        The position of ControlPoints[0,0] in units of the gridsize, (x1_min-1-edge_grids, x2_min-1-edge_grids)
+    backend : 'numpy', 'numba' or None
+        None uses numba when it is installed and numpy otherwise
+
+    Returns
+    ----------
+    pos : Nx2 float32
+        The mapped positions
+    '''
+    if backend is None: backend = 'numba' if importlib.util.find_spec('numba') is not None else 'numpy'
+    pos = np.asarray(pos, dtype=np.float64).reshape(-1,2)
+    A = np.array([[1.,0,0],[0,1,0]]) if AffineMat is None else np.asarray(AffineMat, dtype=np.float64)
+    if ControlPoints is not None:
+        ControlPoints = np.ascontiguousarray(ControlPoints, dtype=np.float64)
+        origin = np.asarray(origin, dtype=np.float64)
+
+    if backend=='numba':
+        out = np.empty(pos.shape, dtype=np.float32)
+        if ControlPoints is None: _numba_kernels()['affine'](pos, A, out)
+        else: _numba_kernels()['splines'](pos, A, ControlPoints, float(gridsize), origin, np.asarray(spline_basis(), dtype=np.float64), out)
+    elif backend=='numpy':
+        out = np.empty(pos.shape, dtype=np.float32)
+        for i in range(0, pos.shape[0], chunk_size):
+            chunk = pos[i:i+chunk_size]@A[:,:2].T + A[:,2]
+            if ControlPoints is not None:
+                idx, weights = spline_weights(chunk/gridsize - origin, ControlPoints.shape[:2])
+                chunk = (np.einsum('nk,nkd->nd', weights, ControlPoints.reshape(-1,2)[idx]) + origin) * gridsize
+            out[i:i+chunk_size] = chunk
+    else: raise ValueError('Invalid backend '+str(backend)+', choose numpy or numba')
+    if not np.all(np.isfinite(out)): raise ValueError('ch2 contains infinities. The mapping likely exploded.')
+    return out
+
+
+_kernels = {}
+
+def _numba_kernels():
+# compiles the numba kernels on first use, such that importing this module does not import numba. The
+# compiled kernels are cached on disk (cache=True), so only the first process pays the compilation
+    if _kernels: return _kernels
+    import numba
+
+    @numba.njit(parallel=True, cache=True)
+    def affine(pos, A, out):
+        for n in numba.prange(pos.shape[0]):
+            for d in range(2):
+                out[n,d] = A[d,0]*pos[n,0] + A[d,1]*pos[n,1] + A[d,2]
+
+    @numba.njit(cache=True)
+    def weights(s, basis):
+    # the weights [1, s, s^2, s^3] @ basis of the 4 neighbouring control points, as scalars
+        s2, s3 = s*s, s*s*s
+        return (basis[0,0] + s*basis[1,0] + s2*basis[2,0] + s3*basis[3,0],
+                basis[0,1] + s*basis[1,1] + s2*basis[2,1] + s3*basis[3,1],
+                basis[0,2] + s*basis[1,2] + s2*basis[2,2] + s3*basis[3,2],
+                basis[0,3] + s*basis[1,3] + s2*basis[2,3] + s3*basis[3,3])
+
+    @numba.njit(parallel=True, cache=True)
+    def splines(pos, A, ControlPoints, gridsize, origin, basis, out):
+        ny, nx = ControlPoints.shape[0], ControlPoints.shape[1]
+        for n in numba.prange(pos.shape[0]):
+            x = (A[0,0]*pos[n,0] + A[0,1]*pos[n,1] + A[0,2]) / gridsize - origin[0]
+            y = (A[1,0]*pos[n,0] + A[1,1]*pos[n,1] + A[1,2]) / gridsize - origin[1]
+            ix, iy = int(x), int(y)
+            cx = weights(min(max(x-np.floor(x), 0.), 1.), basis)
+            cy = weights(min(max(y-np.floor(y), 0.), 1.), basis)
+            m0, m1 = 0., 0.
+            for a in range(4):
+                j = min(max(iy-1+a, 0), ny-1)
+                for b in range(4):
+                    i = min(max(ix-1+b, 0), nx-1)
+                    m0 += cy[a]*cx[b]*ControlPoints[j,i,0]
+                    m1 += cy[a]*cx[b]*ControlPoints[j,i,1]
+            out[n,0] = (m0 + origin[0]) * gridsize
+            out[n,1] = (m1 + origin[1]) * gridsize
+
+    _kernels.update({'affine' : affine, 'splines' : splines})
+    return _kernels
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+The functions used for turning neighbour searches into localization pairs
+"""
+import abc
+import importlib.util
+import numpy as np
+
+
+#%% pair functions
+def neighbour_pairs(counts, indices):
+# unrolls the ragged (counts, indices) output of FindNeighbors into index pairs
+    counts=np.asarray(counts, dtype=np.int64)
+    indices=np.asarray(indices, dtype=np.int64)
+    idx1=np.repeat(np.arange(counts.shape[0], dtype=np.int64), counts)
+    return idx1, indices[:idx1.shape[0]]
+
+
+def nearest_pairs(pos1, pos2, counts, indices):
+    '''
+    Links every localization in pos1 that has neighbours to its nearest neighbour in pos2.
+    The segment-wise argmin is done in one pass over the neighbour list.
+
+    Parameters
+    ----------
+    pos1, pos2 : Nx2 and Mx2 np.array
+        The positions of both channels
+    counts, indices : np.array
+        The output of FindNeighbors, counts[i] neighbours of pos1[i] are stored
+        consecutively in indices
+
+    Returns
+    ----------
+    idx1, idx2 : np.array int
+        The indices of the linked pairs in pos1 and pos2, sorted by idx1
+    '''
+    idx1, idx2 = neighbour_pairs(counts, indices)
+    if idx1.shape[0]==0: return idx1, idx2
+    dists=np.sum((np.asarray(pos1)[idx1,:]-np.asarray(pos2)[idx2,:])**2, axis=1)
+
+    ## minimum distance of every segment
+    counts=np.asarray(counts, dtype=np.int64)
+    nonzero=counts[counts!=0]
+    starts=np.concatenate([[0], np.cumsum(nonzero)[:-1]])
+    dmin=np.minimum.reduceat(dists, starts)
+
+    ## select the first neighbour within each segment that reaches the minimum
+    ismin=np.flatnonzero(dists==np.repeat(dmin, nonzero))
+    first=np.ones(ismin.shape[0], dtype=bool)
+    first[1:]=idx1[ismin[1:]]!=idx1[ismin[:-1]]
+    sel=ismin[first]
+    return idx1[sel], idx2[sel]
+
+
+def knearest_pairs(pos1, pos2, counts, indices, k):
+    '''
+    Selects the k nearest neighbours out of the FindNeighbors output, sorted by distance.
+
+    Parameters
+    ----------
+    k : int
+        The number of neighbours. If k<1 all neighbours are kept
+
+    Returns
+    ----------
+    idx : Nxk np.array int
+        The indices in pos2 of the neighbours of every position in pos1, padded with 0
+    mask : Nxk np.array bool
+        True for the entries of idx that are an actual neighbour
+    '''
+    idx1, idx2 = neighbour_pairs(counts, indices)
+    counts=np.asarray(counts, dtype=np.int64)
+    if k<1: k=max(int(np.max(counts, initial=0)), 1)
+    dists=np.sum((np.asarray(pos1)[idx1,:]-np.asarray(pos2)[idx2,:])**2, axis=1)
+    
+    ## the rank of every neighbour within its segment
+    order=np.lexsort((dists, idx1))
+    starts=np.repeat(np.cumsum(counts)-counts, counts)
+    rank=np.arange(order.shape[0])-starts
+    keep=rank<k
+    
+    idx=np.zeros((counts.shape[0], k), dtype=np.int64)
+    mask=np.zeros((counts.shape[0], k), dtype=bool)
+    idx[idx1[order][keep], rank[keep]]=idx2[order][keep]
+    mask[idx1[order][keep], rank[keep]]=True
+    return idx, mask
+
+
+def frame_keys(pos1, frame1, pos2, frame2, maxDistance):
+    '''
+    Appends the frame as a third coordinate to the positions of both channels. The frames
+    are spaced 2*maxDistance apart, such that localizations of different frames can never 
+    be neighbours and all frames can be linked in a single neighbour search.
+
+    Returns
+    ----------
+    key1, key2 : Nx3 and Mx3 np.array
+        The (x, y, frame) keys of both channels
+    '''
+    frame1=np.asarray(frame1)
+    frame2=np.asarray(frame2)
+    frames=np.unique(np.concatenate([frame1, frame2]))
+    offset=2*np.float64(maxDistance)
+    key1=np.column_stack([pos1, offset*np.searchsorted(frames, frame1)])
+    key2=np.column_stack([pos2, offset*np.searchsorted(frames, frame2)])
+    return key1, key2
+
+
+#%% Neighbour search backends
+class NeighbourSearch(abc.ABC):
+    '''
+    The base class of the neighbour search backends. A backend needs to implement 
+    FindNeighbors, which returns for every position in pos1 the number of positions in pos2 
+    within maxDistance (counts) together with their concatenated indices (indices).
+    Positions at exactly maxDistance count as neighbours in every method and backend.
+    '''
+    name=None
+    
+    @abc.abstractmethod
+    def FindNeighbors(self, pos1, pos2, maxDistance):
+        pass
+        
+        
+    def nearest(self, pos1, pos2, maxDistance):
+    # links every position in pos1 to its nearest neighbour in pos2 within maxDistance
+        counts,indices=self.FindNeighbors(pos1, pos2, maxDistance)
+        return nearest_pairs(pos1, pos2, counts, indices)
+    
+    
+    def kNearest(self, pos1, pos2, k, maxDistance):
+    # the k nearest neighbours in pos2 within maxDistance of every position in pos1
+        counts,indices=self.FindNeighbors(pos1, pos2, maxDistance)
+        return knearest_pairs(pos1, pos2, counts, indices, k)
+    
+    
+    def __str__(self):
+        return f'{self.name} neighbour search'
+        
+
+class PhotonpyNeighbours(NeighbourSearch):
+    '''
+    Neighbour search via the PostProcessMethods of photonpy
+    '''
+    name='photonpy'
+    
+    def FindNeighbors(self, pos1, pos2, maxDistance):
+        from photonpy import PostProcessMethods, Context
+        with Context() as ctx: # loading all NN
+            counts,indices = PostProcessMethods(ctx).FindNeighbors(pos1, pos2, maxDistance)
+        return counts, indices
+    
+    
+class cKDTreeNeighbours(NeighbourSearch):
+    '''
+    Neighbour search via the scipy.spatial.cKDTree
+    '''
+    name='cKDTree'
+    
+    def FindNeighbors(self, pos1, pos2, maxDistance):
+        from scipy.spatial import cKDTree
+        pos1=np.asarray(pos1, dtype=np.float64)
+        pos2=np.asarray(pos2, dtype=np.float64)
+        pairs=cKDTree(pos1).sparse_distance_matrix(cKDTree(pos2), maxDistance, output_type='ndarray')
+        order=np.lexsort((pairs['j'], pairs['i']))
+        counts=np.bincount(pairs['i'], minlength=pos1.shape[0])
+        return counts, pairs['j'][order]
+    
+    
+    def nearest(self, pos1, pos2, maxDistance):
+        from scipy.spatial import cKDTree
+        pos2=np.asarray(pos2, dtype=np.float64)
+        dists,idx2=cKDTree(pos2).query(np.asarray(pos1, dtype=np.float64), k=1, 
+                                         distance_upper_bound=upper_bound(maxDistance))
+        idx1=np.flatnonzero(np.isfinite(dists))
+        return idx1, idx2[idx1]
+    
+    
+    def kNearest(self, pos1, pos2, k, maxDistance):
+        from scipy.spatial import cKDTree
+        pos1=np.asarray(pos1, dtype=np.float64)
+        pos2=np.asarray(pos2, dtype=np.float64)
+        tree=cKDTree(pos2)
+        if k<1: k=max(int(np.max(tree.query_ball_point(pos1, maxDistance, return_length=True), initial=0)), 1)
+        dists,idx=tree.query(pos1, k=k, distance_upper_bound=upper_bound(maxDistance))
+        dists,idx=(dists.reshape(pos1.shape[0], k), idx.reshape(pos1.shape[0], k))
+        mask=np.isfinite(dists)
+        return np.where(mask, idx, 0), mask
+    
+
+def upper_bound(maxDistance):
+# query excludes neighbours at exactly distance_upper_bound while sparse_distance_matrix and 
+# query_ball_point include them, so the bound is moved up by one ulp to include them as well
+    return np.nextafter(np.float64(maxDistance), np.inf)
+
+
+backends={'photonpy' : PhotonpyNeighbours, 'cKDTree' : cKDTreeNeighbours}
+def get_backend(backend=None):
+    '''
+    Returns the neighbour search backend. If backend is None or 'auto', photonpy is used 
+    when it is installed and the cKDTree otherwise.
+    '''
+    if isinstance(backend, NeighbourSearch): return backend
+    if backend is None or backend=='auto':
+        backend='photonpy' if importlib.util.find_spec('photonpy') is not None else 'cKDTree'
+    if backend not in backends: raise ValueError('Invalid neighbour search backend '+str(backend)
+                                                 +', choose from '+str(list(backends)))
+    return backends[backend]()
@@ -11,12 +11,6 @@ Created on Fri Sep 10 15:03:46 2021
 @author: Mels
 """
 import numpy as np
-import matplotlib.pyplot as plt
-from scipy.optimize import curve_fit
-import scipy.special as scpspc
-import matplotlib as mpl
-from matplotlib.patches import Rectangle
-import tensorflow as tf
 
 class Plot:
     def __init__(self):
@@ -64,6 +58,7 @@ class Plot:
     
     #%% Plotting the error
     def ErrorPlot(self, nbins=30):
+        import matplotlib.pyplot as plt
         ## Coupling Datasets if not done already
         if not self.linked: raise Exception('Dataset should first be linked before registration errors can be derived!')
         pos1_original=self.ch1.pos_all()
@@ -152,6 +147,7 @@ class Plot:
 
     def ErrorDistribution(self, nbins=30):
     # just plots the error distribution after mapping
+        import matplotlib.pyplot as plt
         if not self.linked: raise Exception('Dataset should first be linked before registration errors can be derived!')
         pos1=self.ch1.pos_all()
         pos2=self.ch2.pos_all()
@@ -170,14 +166,16 @@ class Plot:
         
         
     def ErrorDistribution_xy(self, nbins=30, xlim=31, error=None, mu=None, fit_data=True, clusters=False):
+        import matplotlib.pyplot as plt
+        from scipy.optimize import curve_fit
         if not self.linked: raise Exception('Dataset should first be linked before registration errors can be derived!')
         if mu is None: mu=0
         if clusters:
             pos1=self.ch1.ClusterCOM()[0]
             pos2=self.ch2.ClusterCOM()[0]
             pos1, pos2=self.kNearestNeighbour(pos1, pos2, k=-1, maxDistance=5000)
-            pos1=pos1.numpy()
-            pos2=pos2.numpy()
+            pos1=pos1.pos
+            pos2=pos2.pos
         else:
             pos1=self.ch1.pos_all()
             pos2=self.ch2.pos_all()
@@ -247,14 +245,17 @@ class Plot:
         
         
     def ErrorDistribution_r(self, nbins=30, xlim=31, error=None, mu=None, fit_data=True, plot_on=True, clusters=False):
+        import matplotlib.pyplot as plt
+        from scipy.optimize import curve_fit
+        import scipy.special as scpspc
         if not self.linked: raise Exception('Dataset should first be linked before registration errors can be derived!')
         if mu is None: mu=0
         if clusters:
             pos1=self.ch1.ClusterCOM()[0]
             pos2=self.ch2.ClusterCOM()[0]
             pos1, pos2=self.kNearestNeighbour(pos1, pos2, k=-1, maxDistance=5000)
-            pos1=pos1.numpy()
-            pos2=pos2.numpy()
+            pos1=pos1.pos
+            pos2=pos2.pos
         else:
             pos1=self.ch1.pos_all()
             pos2=self.ch2.pos_all()
@@ -312,6 +313,8 @@ class Plot:
     #%% plotting the error in a [x1, x2] plot like in the paper        
     def ErrorFOV(self, other=None, maxDistance=30, ps=1, cmap='seismic', figsize=None, title=None, precision=750,
                  placement='right', colorbar=True, center=[3,3], clusters=False, text=True, alpha=.8, norm=1):
+        import matplotlib.pyplot as plt
+        import matplotlib as mpl
         def prepdata(pos, z, precision=750):
             min1=np.min(pos[:,0])/1000
             min2=np.min(pos[:,1])/1000
@@ -342,11 +345,11 @@ class Plot:
             pos1=self.ch1.ClusterCOM()[0]
             pos2=self.ch2.ClusterCOM()[0]
             pos1, pos2=self.kNearestNeighbour(pos1, pos2, k=-1, maxDistance=5000)
-            pos1=pos1.numpy()
-            pos2=pos2.numpy()
+            pos1=pos1.pos
+            pos2=pos2.pos
         else:
-            pos1=self.ch1.pos.numpy()
-            pos2=self.ch2.pos.numpy()
+            pos1=self.ch1.pos
+            pos2=self.ch2.pos
         dist = (pos1-pos2)/norm
             
         if not self.linked and not clusters: raise Exception('Dataset should first be linked before registration errors can be derived!')
@@ -354,8 +357,8 @@ class Plot:
           
         if figsize is None: figsize=(14,6)
         fig, ax = plt.subplots(1,2, figsize=figsize,sharex = False,sharey=False,constrained_layout=True)
-        xlim=(tf.reduce_min(pos1[:,0]/1000),tf.reduce_max(pos1[:,0]/1000))
-        ylim=(tf.reduce_min(pos1[:,1]/1000),tf.reduce_max(pos1[:,1]/1000))
+        xlim=(np.min(pos1[:,0]/1000),np.max(pos1[:,0]/1000))
+        ylim=(np.min(pos1[:,1]/1000),np.max(pos1[:,1]/1000))
         
         X1,Y1,Z1=prepdata(pos1, dist[:,0], precision=precision)
         X2,Y2,Z2=prepdata(pos1, dist[:,1], precision=precision)
@@ -404,22 +407,23 @@ class Plot:
     
     
     def ErrorFOVr(self, fig, ax1, ax2, ps=7, cmap='seismic', placement='right', colorbar=True, clusters=False):
+        import matplotlib as mpl
         if clusters:
             pos1=self.ch1.ClusterCOM()[0]
             pos2=self.ch2.ClusterCOM()[0]
             pos1, pos2=self.kNearestNeighbour(pos1, pos2, k=-1, maxDistance=5000)
-            pos1=pos1.numpy()
-            pos2=pos2.numpy()
+            pos1=pos1.pos
+            pos2=pos2.pos
         else:
-            pos1=self.ch1.pos.numpy()
-            pos2=self.ch2.pos.numpy()
-        dist = tf.sqrt(tf.reduce_sum(tf.square(pos1-pos2),axis=1))
+            pos1=self.ch1.pos
+            pos2=self.ch2.pos
+        dist = np.sqrt(np.sum(np.square(pos1-pos2),axis=1))
             
         if not self.linked and not clusters: raise Exception('Dataset should first be linked before registration errors can be derived!')
         if dist.shape==(0,): raise ValueError('No neighbours found for channel 1')
           
-        xlim=(tf.reduce_min(pos1[:,0]/1000),tf.reduce_max(pos1[:,0]/1000))
-        ylim=(tf.reduce_min(pos1[:,1]/1000),tf.reduce_max(pos1[:,1]/1000))
+        xlim=(np.min(pos1[:,0]/1000),np.max(pos1[:,0]/1000))
+        ylim=(np.min(pos1[:,1]/1000),np.max(pos1[:,1]/1000))
         
         vmax=np.max(dist)
         norm=mpl.colors.Normalize(vmin=0, vmax=vmax, clip=False)
@@ -491,6 +495,8 @@ class Plot:
     #%% Plotting Channels
     def show_channel(self, pos, color='red', ps=3, alpha=1, fig=None,  ax=None,
                      figsize=(3,6), addpatch=True, lims=None):
+        import matplotlib.pyplot as plt
+        from matplotlib.patches import Rectangle
         print('Plotting...')
         if figsize is None: figsize=(4,int(self.imgshape[0]/self.imgshape[1])*4)
         if fig is None: fig=plt.figure(figsize=figsize)
@@ -515,6 +521,7 @@ class Plot:
     
     
     def plot_channel(self, colormap='viridis'):
+        import matplotlib.pyplot as plt
         print('Plotting...')
         label=['y-position [\u03bcm]', 'x-position [\u03bcm]']
             
@@ -546,6 +553,7 @@ class Plot:
         
         
     def plot_1channel(self, channel1=None, figsize=None, title=None, colormap='viridis'):
+        import matplotlib.pyplot as plt
         if channel1 is None: channel1=self.channel1
         # plotting all channels
         if figsize is None: fig=plt.figure() 
@@ -588,6 +596,8 @@ class Plot:
         None.
     
         '''
+        import matplotlib.pyplot as plt
+        import tensorflow as tf
         print('Plotting the Spline Grid...')
         if ch1 is None:
             ch1=self.ch1.pos
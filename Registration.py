@@ -3,30 +3,45 @@
 The align class
 """
 import numpy as np
-import tensorflow as tf
-tf.get_logger().setLevel('ERROR')
 import copy
-from photonpy import PostProcessMethods, Context, Dataset
+import time
 
-from CatmullRomSpline2D import CatmullRomSpline2D
+from CatmullRomBasis import design_matrix, smoothness_matrix
+from LeastSquares import affine_lstsq, robust_affine
+from Mapping import Mapping, apply_mapping, compose_affines
 
 from Plot import Plot
 from Channel import Channel
 
 
+def import_tensorflow():
+# TensorFlow is imported on first use by the training functions, such that loading, linking, filtering 
+# and applying mappings do not import it
+    import tensorflow as tf
+    tf.get_logger().setLevel('ERROR')
+    return tf
+
+
 #%% Align class
 class Registration(Plot):
     '''
     The AlignModel Class is a class used for the optimization of a certain Dataset class. Important is 
     that the loaded class contains the next variables:
-        ch1, ch2, ch20 : Nx2 float32
-            The two channels (and original channel2) that both contain positions callable by .pos
+        ch1, ch20 : Channel
+            Channel 1 and the immutable original positions of channel 2
+        rows2 : np.array int
+            The rows of ch20 that ch2 contains (None for all rows). ch2 and ch2NN are not stored but derived 
+            from these rows of ch20 via the transform history, see the ch2 property
         linked : bool
             True if the dataset is linked (points are one-to-one)
         img, imgsize, mid: np.array
             The image borders, size and midpoint. Generated by self.imgparams            
     '''
     def __init__(self):
+        self._stale=set()   # the derived positions ('ch2', 'NN') that are outdated, see invalidate_positions
+        self._ch2=None
+        self._ch2NN=None
+        self.rows2=None     # the rows of ch20 that ch2 contains, None for all rows
         self.AffineMat=None #LLS affine
         self.AffineMatClusters=None #LLS affine
         
@@ -39,62 +54,105 @@ class Registration(Plot):
         self.ControlPoints=None
         self.NN_maxDistance=None
         self.NN_threshold=None
+        self.NN_pos1=None   # padded Nxkx2 neighbour arrays
+        self.NN_pos2=None
+        self.NN_mask=None   # Nxk mask of the valid neighbours
+        self.NN_idx=None    # Nxk rows of ch2 of the neighbours, None if they are not derived from ch2
+        self.robust_weights=None # the IRLS weights of the pairs of RobustAffineLLS
+        self.transforms=[]  # the chain of transforms that has been applied to ch2, see transform_positions
         self.Neighbours=False        
         self.loss=[]
         Plot.__init__(self)
         
         
-    def AffineLLS(self, maxDistance=None, k=-1):
-    # linear least squares for affine     
-        def p_inv(matrix):
-            """Returns the Moore-Penrose pseudo-inverse
-            (https://gist.github.com/popcornell/502f42666496c5bf9f7266bc42758761)"""
-            s, u, v = tf.linalg.svd(matrix)
-            threshold = tf.reduce_max(s) * 1e-5
-            s_mask = tf.boolean_mask(s, s > threshold)
-            s_inv = tf.linalg.diag(tf.concat([1. / s_mask, tf.zeros([tf.size(s) - tf.size(s_mask)])], 0))
-            return tf.matmul(v, tf.matmul(s_inv, tf.transpose(u)))
-        
-        
-        def LLS(X, Y, SVD=False):
-            Y1=Y[:,0][None]
-            Y2=Y[:,1][None]
-            if SVD: # use Moore-Penrose pseudo inverse
-                Xinv=p_inv(X)
-                M1=Y1@Xinv
-                M2=Y1@Xinv
-            else:
-                MatInv=tf.linalg.inv(X@tf.transpose(X))
-                M1=Y1@(tf.transpose(X))@MatInv
-                M2=Y2@(tf.transpose(X))@MatInv
-            return tf.concat([M1,M2], axis=0)
+    def AffineLLS(self, maxDistance=None, k=-1, weights=None, groups=None, method='svd'):
+    # linear least squares for affine, solved in float64 on the centred and scaled positions.
+    # weights gives the weight of every pair, groups fits an independent affine per group of 
+    # the linked pairs (for example per tile or FOV), which makes AffineMat Gx2x3
+        if self.execute_linked:
+            self.AffineMat=np.float32(affine_lstsq(self.ch2.pos, self.ch1.pos, weights, groups, method))
+        else:
+            if maxDistance is None: raise ValueError("No maxdistance selected yet")
+            if groups is not None: raise ValueError("Grouped affines can only be fitted on linked datasets")
+            if not self.Neighbours: self.kNearestNeighbour(k=k, maxDistance=maxDistance)
+            self.AffineMat=np.float32(affine_lstsq(self.ch2NN.pos, self.ch1NN.pos, weights, None, method))
+        self.Apply_Affine(self.AffineMat, groups)
         
-        X=tf.concat([tf.transpose(self.ch2.pos), tf.ones((1,self.ch2.pos.shape[0]),dtype=tf.float32)], axis=0)
+        
+    def RobustAffineLLS(self, maxDistance=None, k=-1, loss='tukey', ransac=True, filter_pairs=True):
+    # robust affine fit that needs no distance threshold. A RANSAC (least median) start is refined via 
+    # Huber or Tukey IRLS, which rejects the mislinked pairs in the same pass. With loss='tukey' the inliers
+    # are the pairs with a nonzero weight, with loss='huber' the pairs whose scaled residual lies below the 
+    # Huber threshold (weight one). If filter_pairs, the rejected pairs are removed from a linked dataset, 
+    # which needs loss='tukey' as Huber only downweights them. Returns the inlier statistics
+        if filter_pairs and loss!='tukey': raise ValueError("Pairs can only be filtered with loss='tukey', "+
+                                                           "use filter_pairs=False for the Huber loss")
         if self.execute_linked:
-            self.AffineMat=LLS(X,self.ch1.pos)
-            self.ch2.pos.assign(tf.transpose(self.AffineMat@X))
+            if not self.linked: raise Exception('Dataset should be linked before fitting the affine!')
+            pos1, pos2 = self.ch1.pos, self.ch2.pos
         else:
             if maxDistance is None: raise ValueError("No maxdistance selected yet")
-            if not self.Neighbours: self.kNearestNeighbour(self.ch1.pos.numpy(), self.ch2.pos.numpy(), 
-                                                                        k=k, maxDistance=maxDistance)
-            XNN=tf.concat([tf.transpose(self.ch2NN.pos), tf.ones((1,self.ch2NN.pos.shape[0]),dtype=tf.float32)], axis=0)
-            self.AffineMat=LLS(XNN,self.ch1NN.pos)
-            self.ch2.pos.assign(tf.transpose(self.AffineMat@X))
+            if not self.Neighbours: self.kNearestNeighbour(k=k, maxDistance=maxDistance)
+            pos1, pos2 = self.ch1NN.pos, self.ch2NN.pos
+        
+        AffineMat, self.robust_weights = robust_affine(pos2, pos1, loss=loss, ransac=ransac)
+        self.AffineMat=np.float32(AffineMat)
+        self.Apply_Affine(self.AffineMat)
+        
+        inliers=self.robust_weights>0 if loss=='tukey' else self.robust_weights>=1
+        dists=np.linalg.norm(pos1-(pos2@AffineMat[:,:2].T + AffineMat[:,2]), axis=1)
+        stats={'pairs' : inliers.size, 'inliers' : int(np.sum(inliers)), 
+               'inlier_fraction' : np.mean(inliers), 'rmse_inliers' : np.sqrt(np.mean(dists[inliers]**2)),
+               'max_inlier_distance' : np.max(dists[inliers])}
+        print('Robust affine: '+str(stats['inliers'])+' out of '+str(stats['pairs'])+' pairs are inliers ('+
+              str(round(stats['inlier_fraction']*100,1))+'%), with an rmse of '+str(round(stats['rmse_inliers'],2))+
+              'nm and a maximum distance of '+str(round(stats['max_inlier_distance'],2))+'nm')
+        if filter_pairs and self.execute_linked and not np.all(inliers): self.Select_Pairs(inliers)
+        return stats
+        
+        
+    def Select_Pairs(self, mask):
+    # keeps only the linked pairs where mask is True
+        if not np.any(mask): raise Exception('All positions will be filtered out in current settings!')
+        self.ch1 = self.ch1.take(mask)
+        self.select_ch2(mask)
+        
         
+    def select_ch2(self, idx):
+    # keeps the rows idx (indices or boolean mask) of ch2. Its rows of ch20 and the group labels of the 
+    # batched affines in the transform history are selected along, such that ch2 stays derived from ch20.
+    # Neighbours generated in ch2 are cleared
+        idx = np.asarray(idx)
+        if idx.ndim==2: idx=idx[:,0] # the output of np.argwhere
+        self.ch2 = self.ch2.take(idx)
+        if self.NN_idx is not None: self.clear_neighbours() # they refer to the previous rows of ch2
+        self.rows2 = (np.arange(self.ch20.pos.shape[0]) if self.rows2 is None else self.rows2)[idx]
+        self.transforms = [('affine', (t[1][0], np.asarray(t[1][1])[idx])) if t[0]=='affine' and t[1][1] is not None
+                           else t for t in self.transforms]
         
-    def Apply_Affine(self, AffineMat):
+        
+    def Apply_Affine(self, AffineMat, groups=None):
+    # applies the 2x3 AffineMat to ch2, or the Gx2x3 AffineMat with a group label per localization
         if AffineMat is None: raise Exception("AffineLLS has not been trained yet")
-    
-        X=tf.concat([tf.transpose(self.ch2.pos), tf.ones((1,self.ch2.pos.shape[0]),dtype=tf.float32)], axis=0)
-        self.ch2.pos.assign(tf.transpose(AffineMat@X))
+        if groups is not None and np.shape(groups)[0]!=self.ch2.pos.shape[0]: 
+            raise ValueError('groups should contain a label for every localization of ch2')
+        self.append_transform(('affine', (np.asarray(AffineMat, dtype=np.float64), groups)))
             
         
         
     #%% Optimization functions
-    def Train_Model(self, model, lr=1, epochs=100, opt_fn=tf.optimizers.Adagrad,
-                    ch1=None, ch2=None, opt=None, maxDistance=1000):
+    def Train_Model(self, model, lr=1, epochs=100, opt_fn=None,
+                    ch1=None, ch2=None, opt=None, maxDistance=1000, batch_size=None, stream=None, compiled=True):
+    # trains the model on ch1 and ch2. If batch_size is given, every epoch streams shuffled mini-batches
+    # of the pairs, a stream (generated via PairStream) can also be given directly to train on pairs 
+    # that do not fit in memory. If compiled, the training loop runs as a single tf.function.
+    # opt_fn defaults to tf.optimizers.Adagrad
+        tf=import_tensorflow()
         if epochs!=0 and epochs is not None:
-            if self.BatchOptimization:
+            if stream is not None or batch_size is not None:
+                print('Training '+model.name+' Mapping with (lr,#it)='+str((lr,epochs))+' in mini-batches...')
+                batches=None
+            elif self.BatchOptimization:
                 if self.execute_linked: batches=self.counts_linked
                 else: batches=self.counts_Neighbours
                 if batches is None: raise Exception('Batches have not been initialized yet!')
@@ -105,7 +163,7 @@ class Registration(Plot):
                 batches=None                                             # take whole dataset as single batch
             
             ## Initialize Variables
-            if ch1 is None and ch2 is None:
+            if stream is None and ch1 is None and ch2 is None:
                 if self.execute_linked and self.linked:
                     ch1, ch2 = self.ch1, self.ch2
                 elif (not self.execute_linked):
@@ -116,23 +174,132 @@ class Registration(Plot):
                     raise Exception('Dataset is not linked but no Neighbours have been generated yet')
     
             ## The training loop
-            if opt is None: opt=opt_fn(lr)
-            for i in range(epochs):
-                loss=self.train_step(model, epochs, opt, ch1, ch2, batches)
-                if i%100==0 and i!=0: print('iteration='+str(i)+'/'+str(epochs))
+            if opt is None: opt=(tf.optimizers.Adagrad if opt_fn is None else opt_fn)(lr)
+            if stream is None and batch_size is not None: stream=self.PairStream(ch1.pos, ch2.pos, batch_size)
+            if stream is None: # the channels are moved to TF only here
+                pos1, pos2 = (tf.constant(ch1.pos, dtype=tf.float32), tf.constant(ch2.pos, dtype=tf.float32))
+            else: pos1, pos2 = (None, None)
+            if stream is None and batches is None and hasattr(model, 'prepare'): 
+                model.prepare(pos2) # the input stays fixed during training
+            if compiled:
+                train=self.compile_training(model, opt, pos1, pos2, batches, stream)
+                i=0
+                while i<epochs: # run the compiled loop in blocks of 100 epochs to report progress
+                    loss=train(tf.constant(min(100, epochs-i)))
+                    i+=min(100, epochs-i)
+                    if i<epochs: print('iteration='+str(i)+'/'+str(epochs))
+            else:
+                for i in range(epochs):
+                    if stream is not None: 
+                        loss=0
+                        for pos1, pos2 in stream: loss+=self.train_step_batch(model, opt, pos1, pos2)
+                    else: loss=self.train_step(model, epochs, opt, pos1, pos2, batches)
+                    if i%100==0 and i!=0: print('iteration='+str(i)+'/'+str(epochs))
+            if hasattr(model, 'prepare'): model.prepare(None)
             return loss
+
     
     
-    def train_step(self, model, epochs, opt, ch1, ch2, batches=None):
+    def compile_training(self, model, opt, pos1=None, pos2=None, batches=None, stream=None):
+    # Traces the loss, gradient and optimizer update into a single tf.function. The branching on 
+    # execute_linked and the batches is resolved while tracing and the loops over epochs and batches 
+    # run as tf.while_loops. Returns the function train(epochs), which returns the loss of the last epoch
+        tf=import_tensorflow()
+        execute_linked=self.execute_linked
+        
+        def step(pos1, pos2, batched=False):
+            with tf.GradientTape() as tape: # calculate loss
+                if execute_linked:
+                    loss=tf.reduce_sum(tf.square(pos1-model(pos2)))
+                elif batched:
+                    loss=-tf.reduce_sum(tf.exp(-1*tf.reduce_sum(tf.square(pos1-model(pos2))/(1e6),axis=-1)))
+                else:
+                    loss=-tf.math.log(
+                        tf.reduce_sum(tf.exp(-1*tf.reduce_sum(tf.square(pos1-model(pos2))/(1e6),axis=-1)))
+                        )
+            # calculate and apply gradients
+            grads = tape.gradient(loss, model.trainable_weights)
+            opt.apply_gradients(zip(grads, model.trainable_weights))
+            return loss
+        
+        if stream is not None: ## mini-batches from a tf.data pipeline
+            def epoch():
+                loss=tf.constant(0, dtype=tf.float32)
+                for pos1, pos2 in stream: loss+=step(pos1, pos2)
+                return loss
+            
+        elif batches is not None: ## contiguous batches of frames
+            offsets=tf.constant(np.cumsum(np.concatenate([[0],batches])), dtype=tf.int32)
+            def epoch():
+                loss=tf.constant(0, dtype=tf.float32)
+                for i in tf.range(len(batches)):
+                    loss+=step(pos1[offsets[i]:offsets[i+1]], pos2[offsets[i]:offsets[i+1]], batched=True)
+                return loss
+            
+        else: ## take whole dataset as single batch
+            def epoch():
+                return step(pos1, pos2)
+            
+        @tf.function
+        def train(epochs):
+            loss=tf.constant(0, dtype=tf.float32)
+            for i in tf.range(epochs): loss=epoch()
+            return loss
+        return train
+    
+    
+    def PairStream(self, pos1, pos2, batch_size=10000, chunk_size=None, shuffle=True):
+    # A tf.data pipeline of shuffled mini-batches of the pairs (pos1, pos2). The pairs are read one chunk of 
+    # chunk_size at a time, such that pos1 and pos2 can be memory-mapped arrays (np.load(mmap_mode='r')) 
+    # and memory is bounded by the chunk size. Chunks are visited in random order and shuffled internally
+        tf=import_tensorflow()
+        if pos1.shape[0]!=pos2.shape[0]: raise ValueError('Pairs are not equal in size!')
+        if hasattr(pos1, 'numpy'): pos1=pos1.numpy()
+        if hasattr(pos2, 'numpy'): pos2=pos2.numpy()
+        if chunk_size is None: chunk_size=64*batch_size
+        chunk_size=max(chunk_size, batch_size)
+        
+        def generator():
+            starts=np.arange(0, pos1.shape[0], chunk_size)
+            if shuffle: np.random.shuffle(starts)
+            for start in starts:
+                chunk1=np.asarray(pos1[start:start+chunk_size], dtype=np.float32)
+                chunk2=np.asarray(pos2[start:start+chunk_size], dtype=np.float32)
+                idx=np.random.permutation(chunk1.shape[0]) if shuffle else np.arange(chunk1.shape[0])
+                for i in range(0, idx.shape[0], batch_size):
+                    yield chunk1[idx[i:i+batch_size]], chunk2[idx[i:i+batch_size]]
+                    
+        return tf.data.Dataset.from_generator(generator, output_signature=(
+            tf.TensorSpec(shape=(None,2), dtype=tf.float32), tf.TensorSpec(shape=(None,2), dtype=tf.float32)
+            )).prefetch(tf.data.experimental.AUTOTUNE)
+    
+    
+    def train_step_batch(self, model, opt, pos1, pos2):
+    # the optimization step over a single mini-batch of pairs
+        tf=import_tensorflow()
+        with tf.GradientTape() as tape: # calculate loss
+            if self.execute_linked:
+                loss=tf.reduce_sum(tf.square(pos1-model(pos2)))
+            else:
+                loss=-tf.math.log(
+                    tf.reduce_sum(tf.exp(-1*tf.reduce_sum(tf.square(pos1-model(pos2))/(1e6),axis=-1)))
+                    )
+        # calculate and apply gradients
+        grads = tape.gradient(loss, model.trainable_weights)
+        opt.apply_gradients(zip(grads, model.trainable_weights))
+        return loss
+    
+    
+    def train_step(self, model, epochs, opt, pos1, pos2, batches=None):
     # the optimization step
+        tf=import_tensorflow()
         if self.BatchOptimization:  ## work with batches of frames
             pos,loss=(0,0)
-            frame,_=tf.unique(ch1.frame) ###########
             for i in range(len(batches)): # work with batches 
                 batch=batches[i]
                 idx1=tf.range(pos, pos+batch)[:,None]
-                pos1_fr=tf.gather_nd(ch1.pos,idx1)
-                pos2_fr=tf.gather_nd(ch2.pos,idx1)
+                pos1_fr=tf.gather_nd(pos1,idx1)
+                pos2_fr=tf.gather_nd(pos2,idx1)
                 
                 with tf.GradientTape() as tape: # calculate loss
                     if self.execute_linked: 
@@ -150,11 +317,11 @@ class Registration(Plot):
         else :## take whole dataset as single batch
             with tf.GradientTape() as tape: # calculate loss
                 if self.execute_linked:
-                    loss=tf.reduce_sum(tf.square(ch1.pos-model(ch2.pos)))
+                    loss=tf.reduce_sum(tf.square(pos1-model(pos2)))
                 else:
-                    #loss=tf.reduce_sum(tf.square(ch1.pos-model(ch2.pos)))
+                    #loss=tf.reduce_sum(tf.square(pos1-model(pos2)))
                     loss=-tf.math.log(
-                        tf.reduce_sum(tf.exp(-1*tf.reduce_sum(tf.square(ch1.pos-model(ch2.pos))/(1e6),axis=-1)))
+                        tf.reduce_sum(tf.exp(-1*tf.reduce_sum(tf.square(pos1-model(pos2))/(1e6),axis=-1)))
                         )
                     #loss=-tf.reduce_sum(tf.math.log((self.Neighbours_mat @ 
                     #      tf.exp(-1*tf.reduce_sum(tf.square(ch1.pos-model(ch2.pos)),axis=-1)
@@ -169,46 +336,180 @@ class Registration(Plot):
         
             
     def Apply_Model(self, model, ch2=None):
+        tf=import_tensorflow()
         print('Applying '+model.name+' Mapping...')
         if model is None: print('Model not trained yet, will pass without Applying.')
         else: 
             if ch2 is None:
-                ch2_mapped=model(self.ch2.pos)
+                ch2_mapped=model(tf.constant(self.ch2.pos))
                 if tf.reduce_any(tf.math.is_nan( ch2_mapped )): 
                     raise ValueError('ch2 contains infinities. The mapping likely exploded.')
-                self.ch2.pos.assign(ch2_mapped)
-                
-                if self.Neighbours: 
-                    self.ch2NN.pos.assign((model(self.ch2NN.pos)))
-                    
+                # the history keeps a snapshot of the weights, such that further training leaves it intact
+                ch2=self.ch2
+                self.append_transform(('model', (model, [np.array(w) for w in model.weights])))
+                ch2.pos=ch2_mapped
+                self.ch2=ch2
             else: 
-                ch2_mapped=model(ch2)
+                ch2_mapped=model(tf.constant(ch2, dtype=tf.float32))
                 if tf.reduce_any(tf.math.is_nan( ch2_mapped )): 
                     raise ValueError('ch2 contains infinities. The mapping likely exploded.')
                 return ch2_mapped
              
         
+    def Fit_Model(self, model, **kwargs):
+    # fits a model that is linear in its coefficients (like PolynomialModel) in closed form on the linked pairs
+        if not self.linked: raise Exception('Dataset should be linked before fitting a model in closed form!')
+        print('Fitting '+model.name+' Mapping in closed form...')
+        return model.fit(self.ch2.pos, self.ch1.pos, **kwargs)
+        
+        
     #%% CatmullRom Splines
-    def Train_Splines(self, learning_rate, epochs, gridsize=3000,
-                      edge_grids=1, opt_fn=tf.optimizers.SGD, maxDistance=1000, k=1):            
+    def Train_Splines(self, learning_rate, epochs, gridsize=3000, edge_grids=1, opt_fn=None, 
+                      maxDistance=1000, k=1, batch_size=None, method='sgd', smoothness=0):            
+    # trains the splines via gradient descent (method='sgd') or, for linked datasets, by directly solving 
+    # the sparse linear least squares problem (method='lstsq') with optional smoothness regularization.
+    # opt_fn defaults to tf.optimizers.SGD
+            tf=import_tensorflow()
+            from CatmullRomSpline2D import CatmullRomSpline2D
+            if opt_fn is None: opt_fn=tf.optimizers.SGD
             # initializing and training the model
             ch1_input,ch2_input=self.InitializeSplines(gridsize=gridsize, edge_grids=edge_grids,
                                                        maxDistance=maxDistance, k=k)
-            self.SplinesModel=CatmullRomSpline2D(self.ControlPoints)
-            self.Train_Model(self.SplinesModel, lr=learning_rate, epochs=epochs, opt_fn=opt_fn, 
-                             ch1=ch1_input, ch2=ch2_input)  
+            if method=='lstsq':
+                if not self.execute_linked: raise Exception('Least squares splines can only be solved for linked datasets!')
+                self.ControlPoints=self.LstsqSplines(ch1_input.pos, ch2_input.pos, self.ControlPoints, smoothness)
+                self.SplinesModel=CatmullRomSpline2D(self.ControlPoints)
+            elif method=='sgd':
+                self.SplinesModel=CatmullRomSpline2D(self.ControlPoints)
+                self.Train_Model(self.SplinesModel, lr=learning_rate, epochs=epochs, opt_fn=opt_fn, 
+                                 ch1=ch1_input, ch2=ch2_input, batch_size=batch_size)  
+            else: raise ValueError('Invalid method '+str(method)+', choose sgd or lstsq')
             self.ControlPoints = self.SplinesModel.ControlPoints
             
-                     
+            
+    def Train_Splines_MultiRes(self, learning_rate, epochs, gridsize=12000, min_gridsize=500, factor=2, 
+                               edge_grids=1, opt_fn=None, maxDistance=1000, k=1, batch_size=None,
+                               method='sgd', smoothness=0, holdout=0.1, tol=0.01, seed=None):
+    # trains the splines coarse to fine. Starting at gridsize, every level divides the gridsize by factor and 
+    # warm starts the ControlPoints by evaluating the previous spline at the new grid nodes. A fraction holdout 
+    # of the pairs is used to calculate the error of every level, the refinement stops at min_gridsize or when
+    # the held-out error improves by less than tol (relative). The best level is then refit on all pairs,
+    # warm started from its ControlPoints. opt_fn defaults to tf.optimizers.SGD
+        if not 0<holdout<1: raise ValueError('holdout should lie between 0 and 1, got '+str(holdout))
+        tf=import_tensorflow()
+        from CatmullRomSpline2D import CatmullRomSpline2D
+        if opt_fn is None: opt_fn=tf.optimizers.SGD
+        ## the (padded) pairs, split in training and held-out rows
+        if self.execute_linked and self.linked:
+            pos1, pos2 = (self.ch1.pos[:,None], self.ch2.pos[:,None])
+            mask = np.ones(pos1.shape[:2], dtype=bool)
+        elif not self.execute_linked:
+            if not self.Neighbours: self.kNearestNeighbour(k=k, maxDistance=maxDistance)
+            pos1, pos2, mask = (self.NN_pos1, self.NN_pos2, self.NN_mask)
+        else: raise Exception('Tried to execute linked but dataset has not been linked.')
+        if method=='lstsq' and not self.execute_linked: 
+            raise Exception('Least squares splines can only be solved for linked datasets!')
+        test = np.random.default_rng(seed).random(pos1.shape[0])<holdout
+        if not np.any(test) or np.all(test): raise ValueError('holdout leaves no pairs for training or testing')
+        
+        def fit(rows):
+        # trains self.SplinesModel, starting at self.ControlPoints, on the (padded) pairs in rows
+            ch1_input = Channel(self.InputSplines(pos1[rows][mask[rows]]), np.zeros(np.sum(mask[rows])))
+            ch2_input = Channel(self.InputSplines(pos2[rows][mask[rows]]), np.zeros(np.sum(mask[rows])))
+            if method=='lstsq':
+                self.ControlPoints=self.LstsqSplines(ch1_input.pos, ch2_input.pos, self.ControlPoints, smoothness)
+                self.SplinesModel=CatmullRomSpline2D(self.ControlPoints)
+            elif method=='sgd':
+                self.SplinesModel=CatmullRomSpline2D(self.ControlPoints)
+                self.Train_Model(self.SplinesModel, lr=learning_rate, epochs=epochs, opt_fn=opt_fn, 
+                                 ch1=ch1_input, ch2=ch2_input, batch_size=batch_size) 
+            else: raise ValueError('Invalid method '+str(method)+', choose sgd or lstsq')
+        
+        history, best, ControlPoints = ([], None, None)
+        while True:
+            start=time.time()
+            print('Training Splines with gridsize',gridsize,'...')
+            ## warm start from the previous level
+            prev = None if ControlPoints is None else (self.gridsize, self.x1_min, self.x2_min, ControlPoints)
+            self.ControlPoints=self.generate_CPgrid(gridsize, edge_grids)
+            self.edge_grids = edge_grids
+            self.gridsize=gridsize
+            if prev is not None: 
+                self.ControlPoints=self.upsample_CPgrid(self.ControlPoints, *prev)
+            
+            ## train on the training pairs
+            fit(~test)
+            ControlPoints = self.SplinesModel.ControlPoints.numpy()
+            
+            ## the held-out error, per localization the closest of its neighbours
+            mapped = self.InputSplines(self.SplinesModel(tf.constant(self.InputSplines(pos2[test].reshape(-1,2)))), 
+                                       inverse=True).reshape(pos2[test].shape)
+            dist2 = np.where(mask[test], np.sum((pos1[test]-mapped)**2, axis=-1), np.inf)
+            error = np.sqrt(np.mean(np.min(dist2, axis=1)))
+            history.append({'gridsize' : gridsize, 'error' : error, 'time' : time.time()-start})
+            print('Gridsize',gridsize,'has a held-out error of',round(error,3),'nm')
+            
+            improved = best is None or error<(1-tol)*best['error']
+            if improved:
+                best = {'error' : error, 'gridsize' : gridsize, 'ControlPoints' : ControlPoints,
+                        'bounds' : (self.x1_min, self.x2_min, self.x1_max, self.x2_max)}
+            if not improved or gridsize/factor<min_gridsize: break
+            gridsize = gridsize/factor
+        
+        ## refit the best level on all pairs
+        print('Optimal gridsize',best['gridsize'],'with a held-out error of',round(best['error'],3),'nm, refitting on all pairs...')
+        self.gridsize = best['gridsize']
+        self.x1_min, self.x2_min, self.x1_max, self.x2_max = best['bounds']
+        self.ControlPoints = best['ControlPoints']
+        fit(np.ones(pos1.shape[0], dtype=bool))
+        self.ControlPoints = self.SplinesModel.ControlPoints
+        return history
+    
+    
+    def upsample_CPgrid(self, ControlPoints, gridsize, x1_min, x2_min, ControlPoints_prev):
+    # warm starts the ControlPoints of the current grid by evaluating the previous spline (with its gridsize 
+    # and borders) at the new grid nodes. Nodes outside the previous grid get the displacement of the closest node
+        shape_prev = ControlPoints_prev.shape[:2]
+        nodes = np.stack([(ControlPoints[:,:,0] + self.x1_min-1 - self.edge_grids) * self.gridsize,
+                          (ControlPoints[:,:,1] + self.x2_min-1 - self.edge_grids) * self.gridsize], axis=-1).reshape(-1,2)
+        nodes_prev = np.stack([nodes[:,0] / gridsize - x1_min+1 + self.edge_grids,
+                               nodes[:,1] / gridsize - x2_min+1 + self.edge_grids], axis=-1)
+        clipped = np.clip(nodes_prev, 1, np.array([shape_prev[1], shape_prev[0]])-2-1e-6)
+        mapped_prev = design_matrix(clipped, shape_prev) @ np.reshape(ControlPoints_prev, [-1,2]).astype(np.float64)
+        displacement = (mapped_prev - clipped) * gridsize / self.gridsize
+        return np.float32(ControlPoints + displacement.reshape(ControlPoints.shape))
+    
+    
+    def LstsqSplines(self, pos1, pos2, ControlPoints, smoothness=0, solver='normal'):
+    # Solves the ControlPoints that map pos2 onto pos1 (both normalized via InputSplines) in the least squares
+    # sense. The spline is linear in its ControlPoints, so every pair adds a row with the 16 weights of its 4x4 
+    # stencil to a sparse design matrix. The displacement of the ControlPoints from their initial grid is 
+    # solved, regularized by smoothness times its squared second order differences. 
+    # solver='normal' (default) solves the sparse normal equations directly, solver='lsqr' iterates via LSQR
+        from scipy.sparse import vstack, identity
+        from scipy.sparse.linalg import lsqr, spsolve
+        print('Solving Splines via least squares with smoothness',smoothness,'...')
+        CP0=np.asarray(ControlPoints, dtype=np.float64)
+        A=design_matrix(np.asarray(pos2), CP0.shape[:2])
+        residual=np.asarray(pos1, dtype=np.float64) - A@CP0.reshape(-1,2)
+        if smoothness>0:
+            L=np.sqrt(smoothness)*smoothness_matrix(CP0.shape[:2])
+            A=vstack([A,L]).tocsr()
+            residual=np.concatenate([residual, np.zeros((L.shape[0],2))], axis=0)
+            
+        if solver=='normal': # the small ridge fixes the ControlPoints that are not covered by any pair
+            D=spsolve((A.T@A + 1e-9*identity(A.shape[1])).tocsc(), A.T@residual)
+        elif solver=='lsqr':
+            D=np.stack([lsqr(A, residual[:,i], atol=1e-8, btol=1e-8)[0] for i in range(2)], axis=1)
+        else: raise ValueError('Invalid solver '+str(solver)+', choose normal or lsqr')
+        return np.float32(CP0 + D.reshape(CP0.shape))
+    
+    
     def Apply_Splines(self):
         self.ControlPoints = self.SplinesModel.ControlPoints
-        self.ch2.pos.assign(self.InputSplines(
-            self.Apply_Model(self.SplinesModel, ch2=self.InputSplines(self.ch2.pos)),
-            inverse=True))
-        if self.Neighbours:
-            self.ch2NN.pos.assign(self.InputSplines(
-                self.Apply_Model(self.SplinesModel, ch2=self.InputSplines(self.ch2NN.pos)),
-                inverse=True))
+        print('Applying '+self.SplinesModel.name+' Mapping...')
+        ControlPoints = np.array(self.ControlPoints, dtype=np.float64) # a snapshot, training continues on the model
+        self.append_transform(('splines', (ControlPoints, self.gridsize, self.x1_min, self.x2_min, self.edge_grids)))
 
     
     def InitializeSplines(self, gridsize=3000, edge_grids=1, maxDistance=1000, k=-1):
@@ -222,8 +523,7 @@ class Registration(Plot):
             ch1_input = Channel(self.InputSplines(self.ch1.pos), self.ch1.frame )
             ch2_input = Channel(self.InputSplines(self.ch2.pos), self.ch2.frame )
         elif not self.execute_linked:
-            if not self.Neighbours: self.kNearestNeighbour(self.ch1.pos.numpy(), self.ch2.pos.numpy(), 
-                                                                        k=k, maxDistance=maxDistance)
+            if not self.Neighbours: self.kNearestNeighbour(k=k, maxDistance=maxDistance)
             ## Create variables normalized by gridsize
             ch1_input = Channel(self.InputSplines(self.ch1NN.pos), np.zeros(self.ch1NN.pos.shape[0]) )
             ch2_input = Channel(self.InputSplines(self.ch2NN.pos), np.zeros(self.ch2NN.pos.shape[0]) )
@@ -236,36 +536,195 @@ class Registration(Plot):
     
     
     def InputSplines(self, pts, inverse=False, gridsize=None):
+        pts = np.asarray(pts, dtype=np.float32)
         if inverse:
-            return tf.Variable( tf.stack([
+            return np.stack([
                 (pts[:,0] + self.x1_min-1 - self.edge_grids) * self.gridsize,
                 (pts[:,1] + self.x2_min-1 - self.edge_grids) * self.gridsize 
-                ], axis=-1), dtype=tf.float32, trainable=False)
+                ], axis=-1).astype(np.float32)
         else:
-            return tf.Variable( tf.stack([
+            return np.stack([
                 pts[:,0] / self.gridsize - self.x1_min+1 + self.edge_grids,
                 pts[:,1] / self.gridsize - self.x2_min+1 + self.edge_grids
-                ], axis=-1), dtype=tf.float32, trainable=False)
+                ], axis=-1).astype(np.float32)
     
     
     def generate_CPgrid(self, gridsize=3000, edge_grids=1):
             ## Generate the borders of the system
-            self.x1_min = np.min([np.min(tf.reduce_min((self.ch1.pos[:,0]))),
-                                  np.min(tf.reduce_min((self.ch2.pos[:,0])))])/gridsize
-            self.x2_min = np.min([np.min(tf.reduce_min((self.ch1.pos[:,1]))),
-                                  np.min(tf.reduce_min((self.ch2.pos[:,1])))])/gridsize
-            self.x1_max = np.max([np.max(tf.reduce_max((self.ch1.pos[:,0]))),
-                                  np.max(tf.reduce_max((self.ch2.pos[:,0])))])/gridsize
-            self.x2_max = np.max([np.max(tf.reduce_max((self.ch1.pos[:,1]))),
-                                  np.max(tf.reduce_max((self.ch2.pos[:,1])))])/gridsize   
+            self.x1_min = min(np.min(self.ch1.pos[:,0]), np.min(self.ch2.pos[:,0]))/gridsize
+            self.x2_min = min(np.min(self.ch1.pos[:,1]), np.min(self.ch2.pos[:,1]))/gridsize
+            self.x1_max = max(np.max(self.ch1.pos[:,0]), np.max(self.ch2.pos[:,0]))/gridsize
+            self.x2_max = max(np.max(self.ch1.pos[:,1]), np.max(self.ch2.pos[:,1]))/gridsize
         
             ## Create grid
-            x1_grid = tf.range(0, self.x1_max+2 - self.x1_min+1 + 2*edge_grids, dtype=tf.float32)
-            x2_grid = tf.range(0, self.x2_max+2 - self.x2_min+1 + 2*edge_grids, dtype=tf.float32)
-            ControlPoints = tf.stack(tf.meshgrid(x1_grid, x2_grid), axis=-1)
+            x1_grid = np.arange(0, self.x1_max+2 - self.x1_min+1 + 2*edge_grids, dtype=np.float32)
+            x2_grid = np.arange(0, self.x2_max+2 - self.x2_min+1 + 2*edge_grids, dtype=np.float32)
+            ControlPoints = np.stack(np.meshgrid(x1_grid, x2_grid), axis=-1)
             return ControlPoints
             
         
+    #%% Transform history
+    def transform_positions(self, pos, transforms=None):
+    # maps the positions through a chain of transforms, by default through all transforms that have
+    # been applied to ch2. The affines and splines are evaluated in NumPy (see Mapping.apply_mapping), 
+    # only generic models go through TensorFlow. Every transform is a tuple (kind, parameters):
+    #   ('affine', (AffineMat, groups)), ('model', (model, weights)) or 
+    #   ('splines', (ControlPoints, gridsize, x1_min, x2_min, edge_grids)) or ('mapping', Mapping)
+        if transforms is None: transforms=self.transforms
+        pos=np.asarray(pos, dtype=np.float64)
+        affine=None   # consecutive affines are composed and fused into the evaluation of the next splines
+        for kind, params in transforms:
+            if kind=='affine' and np.ndim(params[0])==2:
+                affine=compose_affines(affine, params[0])
+                continue
+            if kind=='splines':
+                ControlPoints, gridsize, x1_min, x2_min, edge_grids = params
+                pos=apply_mapping(pos, affine, ControlPoints, gridsize, 
+                                  (x1_min-1-edge_grids, x2_min-1-edge_grids)).astype(np.float64)
+                affine=None
+                continue
+            if affine is not None: 
+                pos=pos@affine[:,:2].T + affine[:,2]
+                affine=None
+                
+            if kind=='affine':
+                AffineMat, groups = params
+                if groups is None: raise ValueError("groups should be given to apply a batch of affines")
+                if np.shape(groups)[0]!=pos.shape[0]: 
+                    raise ValueError("The batched affines can only be applied to the rows of ch2 they were fitted on")
+                AffineMat=AffineMat[np.asarray(groups)]
+                pos=np.einsum('nij,nj->ni', AffineMat[:,:,:2], pos) + AffineMat[:,:,2]
+            elif kind=='model':
+                pos=self.evaluate_snapshot(*params, pos)
+            elif kind=='mapping':
+                pos=params.apply(pos).astype(np.float64)
+            else: raise ValueError('Invalid transform '+str(kind))
+        if affine is not None: pos=pos@affine[:,:2].T + affine[:,2]
+        return pos.astype(np.float32)
+    
+    
+    def evaluate_snapshot(self, model, weights, pos):
+    # evaluates the model with the weights it had when it was applied, its current weights are restored after
+        tf=import_tensorflow()
+        current=[np.array(w) for w in model.weights]
+        for w, value in zip(model.weights, weights): w.assign(value)
+        try: mapped=model(tf.constant(pos, dtype=tf.float32))
+        finally:
+            for w, value in zip(model.weights, current): w.assign(value)
+        if tf.reduce_any(tf.math.is_nan(mapped)): raise ValueError('ch2 contains infinities. The mapping likely exploded.')
+        return np.asarray(mapped, dtype=np.float64)
+        
+        
+    def append_transform(self, transform):
+    # appends a transform to the history, ch2 and ch2NN follow when they are read next
+        self.transforms.append(transform)
+        self.invalidate_positions()
+        
+        
+    def invalidate_positions(self):
+    # marks ch2 and ch2NN as outdated, they are derived again from ch20 and the history when they are read
+        self._stale.update(['ch2', 'NN'])
+        
+        
+    def Replay_Transforms(self):
+    # recomputes ch2 and ch2NN from their original positions via the transform history, for example after 
+    # editing the history
+        self.invalidate_positions()
+        
+        
+    @property
+    def ch2(self):
+    # channel 2 at its current positions. The frames, groups and columns are those of the rows rows2 of ch20, 
+    # the positions are derived from ch20 via the transform history and kept until the history changes
+        if 'ch2' in self._stale:
+            self._stale.discard('ch2')
+            if self._ch2 is not None:
+                pos20 = self.ch20.pos if self.rows2 is None else self.ch20.pos[self.rows2]
+                self._ch2.pos = self.transform_positions(pos20) if len(self.transforms)>0 else pos20
+        return self._ch2
+    
+    @ch2.setter
+    def ch2(self, ch2):
+        self._ch2 = ch2
+        self._stale.discard('ch2')
+        
+    @ch2.deleter
+    def ch2(self):
+        self._ch2 = None
+        
+        
+    @property
+    def ch20linked(self):
+    # the original positions of the rows of ch2
+        if self.ch20 is None or self.rows2 is None: return self.ch20
+        return self.ch20.take(self.rows2)
+        
+        
+    @property
+    def NN_pos2(self):
+    # the padded Nxkx2 neighbours of NN_pos1 in ch2, taken from the rows NN_idx of the current ch2
+        if 'NN' in self._stale:
+            self._stale.discard('NN')
+            if self.NN_idx is not None:
+                self._NN_pos2 = np.where(self.NN_mask[:,:,None], self.ch2.pos[self.NN_idx,:], self.NN_pos1)
+                self._ch2NN.pos = self._NN_pos2[self.NN_mask]
+        return self._NN_pos2
+    
+    @NN_pos2.setter
+    def NN_pos2(self, NN_pos2):
+        self._NN_pos2 = NN_pos2
+        
+        
+    @property
+    def ch2NN(self):
+    # the valid neighbours of NN_pos2
+        self.NN_pos2
+        return self._ch2NN
+    
+    @ch2NN.setter
+    def ch2NN(self, ch2NN):
+        self._ch2NN = ch2NN
+        
+    @ch2NN.deleter
+    def ch2NN(self):
+        self._ch2NN = None
+        
+    
+    #%% Saving and loading mappings
+    def save_mapping(self, path):
+    # stores the transform history as a versioned .npz, see Mapping.from_registration
+        Mapping.from_registration(self).save(path)
+        
+        
+    def Apply_Mapping(self, mapping):
+    # applies a Mapping (or the path of a saved Mapping), for example the calibration of a bead dataset
+        if isinstance(mapping, str): mapping=Mapping.load(mapping)
+        print('Applying the saved Mapping...')
+        self.append_transform(('mapping', mapping))
+        
+        
+    @property
+    def SplinesModel(self):
+    # the trained splines. Splines restored from the cache are stored as ControlPoints and only built into
+    # a model (which imports TensorFlow) when the model is used
+        if self._SplinesModel is None and self._SplinesControlPoints is not None:
+            from CatmullRomSpline2D import CatmullRomSpline2D
+            self._SplinesModel = CatmullRomSpline2D(self._SplinesControlPoints)
+            self._SplinesControlPoints = None
+        return self._SplinesModel
+    
+    @SplinesModel.setter
+    def SplinesModel(self, model):
+        self._SplinesModel = model
+        self._SplinesControlPoints = None
+        
+        
+    def SplinesControlPoints(self):
+    # the ControlPoints of the trained splines as an array, without building the model
+        if self._SplinesControlPoints is not None: return self._SplinesControlPoints
+        return None if self._SplinesModel is None else np.asarray(self._SplinesModel.ControlPoints)
+        
+        
     #%% miscaleneous fn
     def copy_models(self, other):
         self.AffineMat = copy.deepcopy(other.AffineMat)
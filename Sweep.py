@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+The sweep class, which runs a grid of parameter configurations in a process pool
+"""
+import os
+import csv
+import itertools
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context, shared_memory
+
+
+#%% worker side
+_shared_arrays = {}
+_shared_blocks = []
+
+def _attach(specs):
+# initializer of the worker processes, attaches to the shared memory blocks as read-only arrays
+    for key, (name, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name=name)
+        _shared_blocks.append(block) # keep the block alive as long as the worker
+        arr = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        arr.flags.writeable = False
+        _shared_arrays[key] = arr
+
+
+def _run(fn, config):
+    return config, fn(_shared_arrays, **config)
+
+
+#%% Sweep class
+class Sweep:
+    '''
+    Runs fn for every configuration of a parameter grid in a process pool. The input is generated
+    once by the factory (for example loading, linking and filtering a dataset) and shared with the
+    workers via shared memory. Every finished configuration is directly appended to a single csv
+    results table, and configurations that are already in that table are skipped when the sweep is
+    run again. The workers are spawned, so fn and factory should be defined at the top level of a
+    module and the sweep should be run under if __name__=='__main__'
+
+    Parameters
+    ----------
+    factory : function
+        Returns a dict of np.arrays, the input of all configurations (for example ch1 and ch2 positions)
+    fn : function
+        fn(arrays, **config) runs a single configuration and returns a dict of scalar results
+    grid : dict
+        The values of every parameter, all their combinations are run
+    output : str
+        The path of the csv results table
+    processes : int, optional
+        The number of worker processes, defaults to the number of cpus
+
+    Example
+    ----------
+    def factory():
+        DS1 = dataset(path, linked=False, FrameLinking=True)
+        DS1.load_dataset_hdf5()
+        DS1.link_dataset(maxDistance=1000)
+        return {'pos1' : DS1.ch1.pos, 'pos2' : DS1.ch2.pos}
+
+    def fn(arrays, gridsize, learning_rate):
+        ...
+        return {'error' : error}
+
+    if __name__=='__main__':
+        results = Sweep(factory, fn, {'gridsize' : [1000, 2000], 'learning_rate' : [1e-3, 1e-4]},
+                        'sweep_results.csv').run()
+    '''
+    def __init__(self, factory, fn, grid, output='sweep_results.csv', processes=None):
+        self.factory = factory
+        self.fn = fn
+        self.grid = grid
+        self.output = output
+        self.processes = processes
+        self.keys = list(grid.keys())
+        self.configs = [dict(zip(self.keys, values)) for values in itertools.product(*grid.values())]
+
+
+    def finished(self):
+    # the configurations that are already in the results table, as tuples of strings
+        if not self.exists(): return set()
+        with open(self.output, newline='') as f:
+            return {tuple(row[key] for key in self.keys) for row in csv.DictReader(f)}
+
+
+    def run(self):
+    # runs the unfinished configurations and returns the complete results table
+        done = self.finished()
+        todo = [config for config in self.configs if tuple(str(config[key]) for key in self.keys) not in done]
+        print('Running',len(todo),'out of',len(self.configs),'configurations ('+str(len(self.configs)-len(todo)),'finished)')
+        if len(todo)==0: return self.results()
+
+        ## place the input in shared memory
+        blocks, specs = ([], {})
+        try:
+            for key, arr in self.factory().items():
+                arr = np.ascontiguousarray(arr)
+                block = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+                np.ndarray(arr.shape, dtype=arr.dtype, buffer=block.buf)[...] = arr
+                blocks.append(block)
+                specs[key] = (block.name, arr.shape, arr.dtype.str)
+
+            with ProcessPoolExecutor(self.processes, mp_context=get_context('spawn'),
+                                     initializer=_attach, initargs=(specs,)) as pool:
+                futures = [pool.submit(_run, self.fn, config) for config in todo]
+                for i, future in enumerate(as_completed(futures)):
+                    config, result = future.result()
+                    self.append(config, result)
+                    print('Finished configuration',i+1,'/',len(todo),':',config)
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+        return self.results()
+
+
+    def append(self, config, result):
+    # appends a single row to the results table, the header is written with the first row
+        row = {**{key : str(config[key]) for key in self.keys}, **result}
+        new = not self.exists()
+        if not new:
+            with open(self.output, newline='') as f:
+                fields = next(csv.reader(f))
+            if list(row.keys())!=fields: raise ValueError('The results of '+str(config)+' do not match the columns '+
+                                                         str(fields)+' of '+self.output)
+        with open(self.output, 'a', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(row.keys()))
+            if new: writer.writeheader()
+            writer.writerow(row)
+
+
+    def exists(self):
+    # whether the results table contains at least its header, an empty file (of a run that was stopped
+    # before the first configuration finished) is treated as missing
+        return os.path.exists(self.output) and os.path.getsize(self.output)>0
+
+
+    def results(self):
+    # the results table as a structured np.array with a field per parameter and result. When no configuration
+    # has finished yet the array is empty, with the columns of the header of an earlier table when one exists.
+    # Without a table only the parameter fields are known, as the result columns follow from the first result
+        if not self.exists(): return np.zeros(0, dtype=[(key, float) for key in self.keys])
+        with open(self.output, newline='') as f:
+            reader = csv.reader(f)
+            fields = next(reader)
+            if next(reader, None) is None: return np.zeros(0, dtype=[(key, float) for key in fields])
+        return np.atleast_1d(np.genfromtxt(self.output, delimiter=',', names=True, dtype=None, encoding=None))
@@ -9,9 +9,7 @@ import numpy as np
 import numpy.random as rnd
 import pandas as pd
 
-from photonpy import Dataset
 from dataset import dataset
-from Channel import Channel
 
 class dataset_simulation(dataset):
     def __init__(self, pix_size=1, linked=False, loc_error=10, imgshape=[512, 512], 
@@ -36,15 +34,9 @@ class dataset_simulation(dataset):
         pos1=self.generate_locerror(pos1, self.loc_error) # Generate localization error
         pos2=self.generate_locerror(pos2, self.loc_error)
         if deform is not None: pos2=deform.deform(pos2) # deform  channel
-        # load into channels
-        self.ch1 = Channel(pos=pos1, frame=np.ones(pos1.shape[0]))
-        self.ch2 = Channel(pos=pos2, frame=np.ones(pos2.shape[0]))
-        # Copy channel
-        self.ch20=copy.deepcopy(self.ch2)
-        self.ch20linked=copy.deepcopy(self.ch2)
-        self.ch10=copy.deepcopy(self.ch1)
-        self.img, self.imgsize, self.mid = self.imgparams() 
-        self.center_image()
+        # centre and load into channels
+        self.load_channels({'pos' : pos1, 'frame' : np.ones(pos1.shape[0])}, 
+                           {'pos' : pos2, 'frame' : np.ones(pos2.shape[0])})
         
         
     def generate_dataset_beads(self, N=216, deform=None):
@@ -54,15 +46,9 @@ class dataset_simulation(dataset):
         pos2=self.generate_locerror(pos2, self.loc_error)
         if deform is not None: pos2=deform.deform(pos2) # deform  channel
         #if not self.linked: pos2=self.shuffle(pos2) # if channel is not linked, shuffle indices
-        # load into channels
-        self.ch1 = Channel(pos=pos1, frame=np.ones(pos1.shape[0]))
-        self.ch2 = Channel(pos=pos2, frame=np.ones(pos2.shape[0]))
-        # Copy channel
-        self.ch20=copy.deepcopy(self.ch2)
-        self.ch20linked=copy.deepcopy(self.ch2)
-        self.ch10=copy.deepcopy(self.ch1)
-        self.img, self.imgsize, self.mid = self.imgparams() 
-        self.center_image()
+        # centre and load into channels
+        self.load_channels({'pos' : pos1, 'frame' : np.ones(pos1.shape[0])}, 
+                           {'pos' : pos2, 'frame' : np.ones(pos2.shape[0])})
         
     
     def generate_dataset_clusters(self, Nclust=600, N_per_clust=250, std_clust=25,
@@ -73,15 +59,9 @@ class dataset_simulation(dataset):
         pos2=self.generate_locerror(pos2, error)     
         if deform is not None: pos2=deform.deform(pos2) # deform  channel
         #if not self.linked: pos2=self.shuffle(pos2) # if channel is not linked, shuffle indices
-        # load into channels     
-        self.ch1 = Channel(pos=pos1, frame=np.random.choice(np.arange(0,10),(pos1.shape[0])))
-        self.ch2 = Channel(pos=pos2, frame=np.random.choice(np.arange(0,10),(pos2.shape[0])))
-        # Copy channel
-        self.ch20=copy.deepcopy(self.ch2)
-        self.ch20linked=copy.deepcopy(self.ch2)
-        self.ch10=copy.deepcopy(self.ch1)
-        self.img, self.imgsize, self.mid = self.imgparams() 
-        self.center_image() 
+        # centre and load into channels     
+        self.load_channels({'pos' : pos1, 'frame' : np.random.choice(np.arange(0,10),(pos1.shape[0]))}, 
+                           {'pos' : pos2, 'frame' : np.random.choice(np.arange(0,10),(pos2.shape[0]))})
                
         
     def generate_cluster_pos(self, Nclust=650, N_per_clust=250, std_clust=7):
@@ -156,6 +136,7 @@ class dataset_copy(dataset):
     
     
     def load_copydataset_hdf5(self, deform):
+        from photonpy import Dataset
         print('Loading dataset...')
         ds = Dataset.load(self.path,saveGroups=True)
         try: ch1 = ds[ds.group==0]
@@ -166,12 +147,7 @@ class dataset_copy(dataset):
         pos1 = self.generate_locerror(pos1, self.loc_error) # Generate localization error
         pos2 = self.generate_locerror(pos2, self.loc_error) # Generate localization error
         pos2 = deform.deform(pos2) # deform  channel
-        self.ch1 = Channel(pos = pos1, frame = ch1.frame)
-        self.ch2 = Channel(pos = pos2, frame = ch1.frame)
-        
-        self.ch20=copy.deepcopy(self.ch2)
-        self.img, self.imgsize, self.mid = self.imgparams()                     # loading the image parameters
-        self.center_image()
+        self.load_channels({'pos' : pos1, 'frame' : ch1.frame}, {'pos' : pos2, 'frame' : ch1.frame})
         
         
     #%% miscalleneous functions
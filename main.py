@@ -13,10 +13,12 @@ tf.get_logger().setLevel('ERROR')
 
 from dataset import dataset
 from dataset_simulation import dataset_simulation, dataset_copy, Deform, Affine_Deform
+from Cache import Cache
 
 
 plt.close('all')
 DS2=None
+cache=Cache('cache')  # reruns load the loaded, linked and aligned datasets from here
 #%% Load datasets
 if False: #% Load Beads
     maxDistance=None
@@ -28,7 +30,7 @@ if False: #% Load Beads
     ## optimization params
     learning_rate = 1e-2
     epochs = 300
-    pair_filter = [None, 30, 30]
+    pair_filter = [30, 30]      # the filter after the splines and the xlim of the error plots
     gridsize=4000
     
     
@@ -40,25 +42,24 @@ if True: #% Load Excel Niekamp
     DS2 = dataset('C:/Users/Mels/Documents/Supplementary-data/data/Registration/Set2/set2_beads_locs.csv',
                   pix_size=1, loc_error=1.4, mu=0.3, linked=False, 
                   FrameLinking=True, execute_linked=True)
-    DS1.load_dataset_excel()
-    DS2.load_dataset_excel()
+    DS1.Cached(cache, 'load', DS1.load_dataset_excel)
+    DS2.Cached(cache, 'load', DS2.load_dataset_excel)
     DS1.pix_size=159
     DS2.pix_size=DS1.pix_size
         
     ## optimization params
     learning_rate=1e-3
     epochs = 300
-    pair_filter = [250, 30, 15]
+    pair_filter = [30, 15]
     gridsize=6500
     
-    # linking and aligning via AffineLLS
+    # linking and aligning via the robust affine, which removes the mislinked pairs without a threshold
     maxDistance=1000
     k=1
-    DS1.link_dataset(maxDistance=maxDistance)
-    DS2.link_dataset(maxDistance=maxDistance)
-    DS1.AffineLLS(maxDistance, k)
+    DS1.Cached(cache, 'link', DS1.link_dataset, maxDistance=maxDistance)
+    DS2.Cached(cache, 'link', DS2.link_dataset, maxDistance=maxDistance)
+    DS1.Cached(cache, 'affine', DS1.RobustAffineLLS)
     DS2.Apply_Affine(DS1.AffineMat)
-    DS1.Filter(pair_filter[0]) 
 
 
 if True: #% Load FRET clusters
@@ -79,11 +80,11 @@ if True: #% Load FRET clusters
     ## optimization params
     learning_rate=5e-5
     epochs=1000
-    pair_filter=[None, None, maxDistance]
+    pair_filter=[None, maxDistance]
     gridsize=7500
     
     #% aligning clusters
-    DS1clust.AffineLLS(maxDistance, k)
+    DS1clust.RobustAffineLLS()
     DS1.copy_models(DS1clust) ## Copy all mapping parameters
     DS1.Apply_Affine(DS1clust.AffineMat)
     if DS2clust is not None:
@@ -95,7 +96,6 @@ if True: #% Load FRET clusters
     #if not DS1.Neighbours: DS1.kNearestNeighbour(k=k, maxDistance=maxDistance)
     #DS1.AffineLLS(maxDistance, k)
     #DS2.Apply_Affine(DS1.AffineMat)
-    DS1.Filter(pair_filter[0]) 
     
     
 if False: #% Load DNA-paint
@@ -115,7 +115,7 @@ if False: #% Load DNA-paint
     ## optimization params
     learning_rate=5e-5
     epochs=None
-    pair_filter=[None, None, maxDistance]
+    pair_filter=[None, maxDistance]
     gridsize=1000
     
 fig,ax=DS1.show_channel(DS1.ch1.pos, ps=7)
@@ -129,7 +129,7 @@ if epochs is not None:
                       maxDistance=maxDistance, k=k)
     DS1.Apply_Splines()
     
-DS1.Filter(pair_filter[1])
+DS1.Filter(pair_filter[0])
 print('Optimized in',round((time.time()-start)/60,1),'minutes!')
 
 if DS2 is not None:
@@ -139,7 +139,7 @@ if DS2 is not None:
 
 #%% output
 nbins=100
-xlim=pair_filter[2]
+xlim=pair_filter[1]
     
 if not DS1.linked:
     DS1.link_dataset(maxDistance=maxDistance)
@@ -156,7 +156,7 @@ if DS2 is not None:
     if not DS2.linked: 
         DS2.link_dataset(maxDistance=maxDistance)
             
-    DS2.Filter(pair_filter[1])
+    DS2.Filter(pair_filter[0])
     #DS2.ErrorPlot(nbins=nbins)
     DS2.ErrorDistribution_xy(nbins=nbins, xlim=xlim, error=DS2.coloc_error)
     DS2.ErrorDistribution_r(nbins=nbins, xlim=xlim, error=DS2.coloc_error, mu=DS2.mu)